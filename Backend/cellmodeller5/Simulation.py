@@ -28,5 +28,8 @@ class Simulator:
 	def dump_to_viz_file(self, path):
 		self.native.dump_to_viz_file(path)
 
+	def set_compression_level(self, level):
+		self.native.set_compression_level(level)
+
 	def get_step_index(self):
 		return self.step_index
\ No newline at end of file
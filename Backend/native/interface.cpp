@@ -51,6 +51,11 @@ public:
 	{
 		CM_TRY_THROW_V(writeSimulatorStateToVizFile(*m_simulator, filepath));
 	}
+
+	void setCompressionLevel(int level)
+	{
+		m_simulator->compressionLevel = level;
+	}
 };
 
 PYBIND11_MODULE(CM_MODULE_NAME, m) {
@@ -69,5 +74,6 @@ PYBIND11_MODULE(CM_MODULE_NAME, m) {
 		.def("step", &SimulatorInterface::step, py::call_guard<py::gil_scoped_release>())
 		.def("get_last_step_time", &SimulatorInterface::getLastStepTime)
 		.def("dump_to_step_file", &SimulatorInterface::dumpToStepFile)
-		.def("dump_to_viz_file", &SimulatorInterface::dumpToVizFile);
+		.def("dump_to_viz_file", &SimulatorInterface::dumpToVizFile)
+		.def("set_compression_level", &SimulatorInterface::setCompressionLevel);
 }
\ No newline at end of file
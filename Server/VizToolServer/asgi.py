@@ -13,9 +13,14 @@ import simrunner.routing
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 
+from simrunner.instances.workerpool import get_worker_pool
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'VizToolServer.settings')
 
 application = ProtocolTypeRouter({
 	"http": get_asgi_application(),
 	"websocket": URLRouter(simrunner.routing.websocket_urlpatterns),
-})
\ No newline at end of file
+})
+
+# Start the simulation workers now, so that the first simulation doesn't have to wait for them
+get_worker_pool()
\ No newline at end of file
@@ -146,5 +146,27 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 APPEND_SLASH = False
 
+# Simulation worker pool (see 'simrunner/instances/workerpool.py')
+
+SIMULATION_WORKER_POOL_SIZE = 2
+
+SIMULATION_WORKER_MAX_SIMULATIONS = 8
+
+SIMULATION_WORKER_MAX_MEMORY_GROWTH = 512 * 1024 * 1024
+
+# Simulation scheduler (see 'simrunner/instances/scheduler.py')
+
+SIMULATION_MAX_RUNNING = None
+
+SIMULATION_CORES_PER_INSTANCE = 2
+
+SIMULATION_PIN_CORES = True
+
+SIMULATION_QUEUE_POLICY = 'fifo'
+
+# Backend repository cache (see 'simrunner/instances/backendcache.py')
+
+SIMULATION_BACKEND_CACHE_MAX_AGE = 5 * 60
+
 mimetypes.add_type("application/javascript", ".js", True)
 mimetypes.add_type("application/javascript", ".js", True)
\ No newline at end of file
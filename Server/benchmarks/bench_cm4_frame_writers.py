@@ -0,0 +1,134 @@
+"""
+Compares the vectorized frame writers of 'CellModeller4Backend' with the original per-cell writers.
+
+Run from the server's root directory:
+
+	python ./benchmarks/bench_cm4_frame_writers.py
+"""
+import os
+import sys
+import io
+import random
+import struct
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from saveviewer.format import PackedCell, PackedCellWriter, PackedCellReader
+from simrunner.backends.backend import BackendParameters
+from simrunner.backends.cellmodeller4 import CellModeller4Backend
+
+class FakeCellState:
+	def __init__(self, id):
+		self.id = id
+		self.pos = [ random.uniform(-50, 50), random.uniform(-50, 50), 0.0 ]
+		self.dir = [ random.uniform(-1, 1), random.uniform(-1, 1), 0.0 ]
+		self.color = [ random.random(), random.random(), random.random() ]
+		self.radius = 0.5
+		self.length = random.uniform(2.0, 4.0)
+		self.growthRate = 1.0
+		self.cellAge = random.randint(0, 100)
+		self.effGrowth = random.random()
+		self.cellType = random.randint(0, 1)
+		self.cellAdh = 0
+		self.targetVol = random.uniform(3.5, 4.0)
+		self.volume = random.uniform(2.0, 4.0)
+		self.strainRate = random.random()
+		self.startVol = random.uniform(2.0, 3.0)
+
+class FakeSimulation:
+	def __init__(self, cell_count):
+		self.cellStates = { id: FakeCellState(id) for id in range(cell_count) }
+		self.stepNum = 0
+
+def reference_step_frame(cell_states):
+	writer = PackedCellWriter()
+	writer.write_header(len(cell_states))
+
+	for it in cell_states.keys():
+		writer.write_cell(PackedCell.from_cellmodeller4(cell_states[it]))
+
+	return writer.compress()
+
+def reference_viz_frame(cell_states):
+	byte_buffer = io.BytesIO()
+	byte_buffer.write(struct.pack("<i", len(cell_states)))
+
+	for it in cell_states.keys():
+		state = cell_states[it]
+
+		color_r = int(255.0 * min(state.color[0], 1.0))
+		color_g = int(255.0 * min(state.color[1], 1.0))
+		color_b = int(255.0 * min(state.color[2], 1.0))
+		packed_color = 0xFF000000 | (color_b << 16) | (color_g << 8) | color_r
+
+		final_length = state.length + 1.0 - 2.0 * state.radius
+
+		byte_buffer.write(struct.pack("<fff", state.pos[0], state.pos[2], state.pos[1]))
+		byte_buffer.write(struct.pack("<fff", state.dir[0], state.dir[2], state.dir[1]))
+		byte_buffer.write(struct.pack("<ffI", final_length, state.radius, packed_color))
+
+	for it in cell_states.keys():
+		byte_buffer.write(struct.pack("<Q", int(cell_states[it].id)))
+
+	return zlib.compress(byte_buffer.getbuffer(), 2)
+
+def time_call(func, repeats):
+	best = float("inf")
+
+	for _ in range(repeats):
+		start = time.perf_counter()
+		func()
+		best = min(best, time.perf_counter() - start)
+
+	return best
+
+def main():
+	# The 'pack' columns exclude compression, which costs the same for both writers
+	print(f"{'cells':>8} | {'frame':>5} | {'original (ms)':>13} | {'vectorized (ms)':>15} | {'speedup':>7} | {'pack only (ms)':>14} | {'pack speedup':>12}")
+
+	for cell_count in [ 1000, 10000, 100000 ]:
+		backend = CellModeller4Backend(BackendParameters())
+		backend.simulation = FakeSimulation(cell_count)
+
+		cell_states = backend.simulation.cellStates
+		repeats = 5 if cell_count < 100000 else 2
+
+		# The vectorized writer is split in a capture stage (simulation thread) and a pack stage
+		# (frame writer thread), but the total is what should be compared
+		def pack_step_frame():
+			return backend._pack_step_frame(backend._gather_step_cells(list(cell_states.values())))
+
+		def pack_viz_frame():
+			return backend._pack_viz_frame(backend._gather_viz_frame(list(cell_states.values())))
+
+		# Make sure that both writers produce the same frames
+		assert zlib.decompress(reference_viz_frame(cell_states)) == zlib.decompress(pack_viz_frame())
+
+		new_reader = PackedCellReader(pack_step_frame())
+		old_reader = PackedCellReader(reference_step_frame(cell_states))
+
+		for name, column in old_reader.get_columns().items():
+			assert (new_reader.get_column(name) == column).all()
+
+		# Measure how long compression takes on its own, so that it can be subtracted
+		step_frame = zlib.decompress(pack_step_frame())
+		viz_frame = zlib.decompress(pack_viz_frame())
+
+		for frame, reference, vectorized, raw_frame in [
+			("step", lambda: reference_step_frame(cell_states), pack_step_frame, step_frame),
+			("viz", lambda: reference_viz_frame(cell_states), pack_viz_frame, viz_frame),
+		]:
+			old_time = time_call(reference, repeats)
+			new_time = time_call(vectorized, repeats)
+			compress_time = time_call(lambda: zlib.compress(raw_frame, 2), repeats)
+
+			old_pack = old_time - compress_time
+			new_pack = new_time - compress_time
+
+			print(f"{cell_count:>8} | {frame:>5} | {1000 * old_time:>13.2f} | {1000 * new_time:>15.2f} | {old_time / new_time:>6.1f}x"
+				f" | {1000 * old_pack:>6.2f} -> {1000 * new_pack:>5.2f} | {old_pack / new_pack:>11.1f}x")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,96 @@
+"""
+Reports the compression ratio and the encode/decode times of every frame codec.
+
+Run from the server's root directory. If a simulation UUID is given, its frames are read from
+the save archive. Otherwise, frames are generated with a random colony.
+
+	python ./benchmarks/bench_frame_codecs.py [simulation uuid] [max frames]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from saveviewer import archiver as sv_archiver
+from saveviewer.codecs import get_codec
+from saveviewer.container import read_frame
+
+CODEC_NAMES = [ "store", "zlib-1", "zlib-2", "zlib-6", "zlib-9", "deflate-2", "deflate-6", "lzma-0", "lzma-6", "bz2-9" ]
+
+def load_archived_frames(uuid, max_frames):
+	archiver = sv_archiver.get_save_archiver()
+
+	sim_data = archiver.get_sim_index_data(uuid)
+	codec = get_codec(sim_data.get("codec", None))
+
+	frame_count = sim_data["num_frames"]
+	indices = range(max(0, frame_count - max_frames), frame_count)
+
+	frames = []
+
+	for index in indices:
+		frames.append(("step", codec.decompress(read_frame(archiver.get_sim_step_frame(uuid, index)))))
+		frames.append(("viz", codec.decompress(read_frame(archiver.get_sim_bin_frame(uuid, index)))))
+
+	return frames
+
+def generate_frames(max_frames):
+	from bench_cm4_frame_writers import FakeSimulation
+	from simrunner.backends.backend import BackendParameters
+	from simrunner.backends.cellmodeller4 import CellModeller4Backend
+
+	params = BackendParameters()
+	params.frame_codec = "store"
+
+	backend = CellModeller4Backend(params)
+	frames = []
+
+	for cell_count in [ 1000, 10000, 50000 ][:max_frames]:
+		backend.simulation = FakeSimulation(cell_count)
+
+		snapshot = backend.capture_frame()
+
+		frames.append(("step", backend._pack_step_frame(snapshot.step_data)))
+		frames.append(("viz", backend._pack_viz_frame(snapshot.viz_data)))
+
+	return frames
+
+def main():
+	if len(sys.argv) > 1:
+		max_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+		frames = load_archived_frames(sys.argv[1], max_frames)
+	else:
+		frames = generate_frames(3)
+
+	print(f"{'codec':>10} | {'frame':>5} | {'ratio':>6} | {'encode (MB/s)':>13} | {'decode (MB/s)':>13}")
+
+	for name in CODEC_NAMES:
+		codec = get_codec(name)
+
+		for frame_type in [ "step", "viz" ]:
+			raw_size = 0
+			encoded_size = 0
+			encode_time = 0.0
+			decode_time = 0.0
+
+			for _, data in filter(lambda frame: frame[0] == frame_type, frames):
+				start = time.perf_counter()
+				encoded = codec.compress(data)
+				encode_time += time.perf_counter() - start
+
+				start = time.perf_counter()
+				decoded = codec.decompress(encoded)
+				decode_time += time.perf_counter() - start
+
+				assert decoded == data
+
+				raw_size += len(data)
+				encoded_size += len(encoded)
+
+			megabytes = raw_size / (1024 * 1024)
+
+			print(f"{name:>10} | {frame_type:>5} | {raw_size / encoded_size:>6.2f} | {megabytes / encode_time:>13.1f} | {megabytes / decode_time:>13.1f}")
+
+if __name__ == "__main__":
+	main()
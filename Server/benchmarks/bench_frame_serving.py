@@ -0,0 +1,193 @@
+"""
+Load test for the frame views. Many concurrent viewers request random frames from a generated
+simulation, and the throughput of the async views is compared to the same views running as
+synchronous Django views (which ASGI runs one at a time on a single thread).
+
+Requests are sent straight to the ASGI application, so no server needs to be running. The
+simulation is written to a temporary directory.
+
+Run from the server's root directory:
+
+	python ./benchmarks/bench_frame_serving.py [cell count] [frame count]
+"""
+import os
+import sys
+import time
+import types
+import random
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "VizToolServer.settings")
+
+import django
+django.setup()
+
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.http import HttpResponse
+from django.urls import path
+
+from saveviewer import archiver as sv_archiver
+from saveviewer import views
+from saveviewer.httpcache import immutable_resource
+from simrunner.backends.backend import BackendParameters
+from simrunner.backends.cellmodeller4 import CellModeller4Backend
+
+from bench_cm4_frame_writers import FakeSimulation
+
+CONCURRENCY_LEVELS = [ 1, 4, 16, 64 ]
+REQUESTS_PER_LEVEL = 256
+
+def create_simulation(uuid, cell_count, frame_count):
+	archiver = sv_archiver.get_save_archiver()
+	paths = archiver.register_simulation(uuid, f"./{uuid}", "Benchmark", False, { "backend_version": "CellModeller4" })
+
+	params = BackendParameters()
+	params.uuid = uuid
+	params.sim_root_dir = paths.root_path
+	params.cache_dir = paths.cache_path
+	params.cache_relative_prefix = paths.relative_cache_path
+
+	backend = CellModeller4Backend(params)
+	backend.simulation = FakeSimulation(cell_count)
+
+	index_writer = sv_archiver.SimIndexWriter(paths.root_path)
+	entries = []
+
+	for step in range(frame_count):
+		backend.simulation.stepNum = step
+
+		step_frame, viz_frame = backend.write_step_files()
+		entries.append(index_writer.add_entry(step_frame, viz_frame))
+
+	archiver.update_step_data(uuid, entries)
+
+	backend.shutdown()
+	index_writer.close()
+
+# The views as they were before they were made async
+@immutable_resource(views._frame_data_validators)
+def sync_frame_data(request):
+	data, content_encoding = views._load_frame_data(request, request.GET["uuid"], request.GET["index"])
+
+	response = HttpResponse(data, content_type="application/octet-stream")
+
+	if not content_encoding is None:
+		response["Content-Encoding"] = content_encoding
+
+	return response
+
+@immutable_resource(views._cell_info_validators)
+def sync_cell_info(request):
+	return HttpResponse(views._load_cell_info(request.GET["uuid"], request.GET["frameindex"], request.GET["cellid"]), content_type="application/json")
+
+def make_urlconf():
+	urlconf = types.ModuleType("bench_urls")
+	urlconf.urlpatterns = [
+		path("async/framedata", views.frame_data),
+		path("async/cellinfoindex", views.cell_info_from_index),
+		path("sync/framedata", sync_frame_data),
+		path("sync/cellinfoindex", sync_cell_info),
+	]
+
+	return urlconf
+
+async def send_request(application, url, query):
+	scope = {
+		"type": "http",
+		"asgi": { "version": "3.0" },
+		"http_version": "1.1",
+		"method": "GET",
+		"scheme": "http",
+		"path": url,
+		"raw_path": url.encode("ascii"),
+		"query_string": query.encode("ascii"),
+		"headers": [ (b"host", b"localhost"), (b"accept-encoding", b"gzip, deflate") ],
+		"server": ("localhost", 80),
+		"client": ("127.0.0.1", 50000),
+	}
+
+	request_sent = False
+	disconnected = asyncio.Event()
+
+	async def receive():
+		nonlocal request_sent
+
+		if not request_sent:
+			request_sent = True
+			return { "type": "http.request", "body": b"", "more_body": False }
+
+		# Django listens for the client disconnecting while the response is being sent
+		await disconnected.wait()
+		return { "type": "http.disconnect" }
+
+	status = None
+
+	async def send(message):
+		nonlocal status
+
+		if message["type"] == "http.response.start":
+			status = message["status"]
+
+	await application(scope, receive, send)
+	disconnected.set()
+
+	return status
+
+async def run_load(application, make_request, concurrency):
+	remaining = REQUESTS_PER_LEVEL
+
+	async def viewer():
+		nonlocal remaining
+
+		while remaining > 0:
+			remaining -= 1
+
+			url, query = make_request()
+			status = await send_request(application, url, query)
+
+			assert status == 200, f"{url}?{query} returned {status}"
+
+	start = time.perf_counter()
+	await asyncio.gather(*[ viewer() for _ in range(concurrency) ])
+
+	return REQUESTS_PER_LEVEL / (time.perf_counter() - start)
+
+def main():
+	cell_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+	frame_count = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+
+	os.chdir(tempfile.mkdtemp(prefix="cm5-bench-"))
+
+	uuid = "bench-frame-serving"
+	create_simulation(uuid, cell_count, frame_count)
+
+	settings.ROOT_URLCONF = make_urlconf()
+	application = get_asgi_application()
+
+	def frame_request(kind):
+		return lambda: (f"/{kind}/framedata", f"uuid={uuid}&index={random.randrange(frame_count)}")
+
+	def cell_request(kind):
+		return lambda: (f"/{kind}/cellinfoindex", f"uuid={uuid}&frameindex={random.randrange(frame_count)}&cellid={random.randrange(cell_count)}")
+
+	print(f"{cell_count} cells, {frame_count} frames, {REQUESTS_PER_LEVEL} requests per run")
+	print(f"{'view':>13} | {'viewers':>7} | {'sync (req/s)':>12} | {'async (req/s)':>13} | {'speedup':>7}")
+
+	for name, make_request in [ ("framedata", frame_request), ("cellinfoindex", cell_request) ]:
+		for concurrency in CONCURRENCY_LEVELS:
+			# The frame cache would turn most cell info requests into cache hits
+			views.get_frame_cache().clear()
+			sync_rate = asyncio.run(run_load(application, make_request("sync"), concurrency))
+
+			views.get_frame_cache().clear()
+			async_rate = asyncio.run(run_load(application, make_request("async"), concurrency))
+
+			print(f"{name:>13} | {concurrency:>7} | {sync_rate:>12.1f} | {async_rate:>13.1f} | {async_rate / sync_rate:>6.1f}x")
+
+if __name__ == "__main__":
+	main()
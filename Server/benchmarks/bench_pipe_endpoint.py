@@ -0,0 +1,112 @@
+"""
+Measures how quickly messages get across a 'DuplexPipeEndpoint'. A child process (started the same
+way as the simulation processes) echoes every message back to the server's endpoint, and the
+benchmark reports the round-trip latency of single messages and the number of messages per second
+that get through when many are sent at once.
+
+Run from the server's root directory:
+
+	python ./benchmarks/bench_pipe_endpoint.py [message count]
+"""
+import os
+import sys
+import time
+import threading
+import statistics
+import multiprocessing as mp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from simrunner.instances.duplex_pipe_endpoint import DuplexPipeEndpoint
+
+ROUND_TRIPS = 500
+
+# A small message, and one the size of a NEW_FRAME message of a long simulation
+PAYLOADS = {
+	"small": { "frame_count": 1 },
+	"64 KB": { "frame_count": 1, "new_data": "x" * (64 * 1024) },
+}
+
+def echo_process(pipe):
+	stopped = threading.Event()
+
+	def echo(message):
+		endpoint.send_item(message)
+
+	endpoint = DuplexPipeEndpoint(pipe, echo, stopped.set)
+	endpoint.start()
+
+	stopped.wait()
+
+class EchoClient:
+	def __init__(self):
+		self.received_count = 0
+		self.expected_count = 0
+		self.done = threading.Event()
+		self.lock = threading.Lock()
+
+		parent_pipe, child_pipe = mp.Pipe(duplex=True)
+
+		self.process = mp.get_context("spawn").Process(target=echo_process, args=(child_pipe,), daemon=True)
+		self.process.start()
+
+		self.endpoint = DuplexPipeEndpoint(parent_pipe, self.on_message)
+		self.endpoint.start()
+
+	def on_message(self, message):
+		with self.lock:
+			self.received_count += 1
+
+			if self.received_count >= self.expected_count:
+				self.done.set()
+
+	def exchange(self, message, count):
+		with self.lock:
+			self.received_count = 0
+			self.expected_count = count
+			self.done.clear()
+
+		for _ in range(count):
+			self.endpoint.send_item(message)
+
+		self.done.wait()
+
+	def shutdown(self):
+		self.endpoint.shutdown()
+		self.process.join(timeout=5.0)
+
+def main():
+	message_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+	client = EchoClient()
+
+	# The first message has to wait for the child process to start
+	client.exchange(PAYLOADS["small"], 1)
+
+	print(f"{'payload':>8} | {'median RTT (ms)':>15} | {'p99 RTT (ms)':>12} | {'messages/s':>10}")
+
+	for name, payload in PAYLOADS.items():
+		round_trips = []
+
+		for _ in range(ROUND_TRIPS):
+			start = time.perf_counter()
+			client.exchange(payload, 1)
+			round_trips.append((time.perf_counter() - start) * 1000.0)
+
+		count = message_count if name == "small" else message_count // 10
+
+		start = time.perf_counter()
+		client.exchange(payload, count)
+		rate = count / (time.perf_counter() - start)
+
+		p99 = statistics.quantiles(round_trips, n=100)[98]
+
+		print(f"{name:>8} | {statistics.median(round_trips):>15.3f} | {p99:>12.3f} | {rate:>10.0f}")
+
+	start = time.perf_counter()
+	client.shutdown()
+
+	print(f"Shutdown handshake took {(time.perf_counter() - start) * 1000.0:.1f} ms")
+
+if __name__ == "__main__":
+	main()
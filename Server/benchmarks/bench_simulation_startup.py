@@ -0,0 +1,147 @@
+"""
+Measures the time from starting a simulation to the server receiving its first frame, once with a
+new process for every simulation and once with a pre-started worker from the worker pool.
+
+CellModeller doesn't have to be installed. A stand-in 'CellModeller.Simulator' module (which steps
+fake cells) is written to a temporary directory. The real module takes longer to import, because
+it also imports pyopencl, so the import cost argument can be used to make the stand-in take longer
+to import too.
+
+Run from the server's root directory:
+
+	python ./benchmarks/bench_simulation_startup.py [simulation count] [import cost (s)]
+"""
+import os
+import sys
+import time
+import tempfile
+import threading
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "VizToolServer.settings")
+
+import django
+django.setup()
+
+from saveviewer import archiver as sv_archiver
+from simrunner.backends.backend import BackendParameters
+from simrunner.instances import workerpool
+from simrunner.instances.manager import spawn_simulation, kill_simulation, is_simulation_running
+from simrunner.instances.siminstance import InstanceAction
+from simrunner.instances.simprocess import SimulationProcess
+
+CELL_COUNT = 1000
+
+STAND_IN_SIMULATOR = """
+import time
+time.sleep({import_cost})
+
+from bench_cm4_frame_writers import FakeSimulation
+
+class Simulator(FakeSimulation):
+	def __init__(self, name, delta_time, moduleStr=None, **kwargs):
+		super().__init__({cell_count})
+		self.moduleStr = moduleStr
+
+	def step(self):
+		self.stepNum += 1
+"""
+
+class TimedSimulationProcess(SimulationProcess):
+	def __init__(self, params, first_frame):
+		self.first_frame = first_frame
+		super().__init__(params)
+
+	def on_message_from_instance(self, message):
+		super().on_message_from_instance(message)
+
+		if message.action == InstanceAction.NEW_FRAME:
+			self.first_frame.set()
+
+def write_stand_in_backend(import_cost):
+	package_dir = os.path.join(os.getcwd(), "stand-in", "CellModeller")
+	os.makedirs(package_dir)
+
+	with open(os.path.join(package_dir, "__init__.py"), "w") as init_file:
+		init_file.write("")
+
+	with open(os.path.join(package_dir, "Simulator.py"), "w") as simulator_file:
+		simulator_file.write(STAND_IN_SIMULATOR.format(import_cost=import_cost, cell_count=CELL_COUNT))
+
+	# The simulation processes are started with the same 'sys.path' as the server
+	sys.path.insert(0, os.path.dirname(package_dir))
+
+def wait_until(predicate, timeout=60.0):
+	start = time.perf_counter()
+
+	while not predicate():
+		if time.perf_counter() - start > timeout:
+			raise TimeoutError("Timed out waiting for the simulation")
+
+		time.sleep(0.01)
+
+def time_to_first_frame(uuid):
+	archiver = sv_archiver.get_save_archiver()
+	paths = archiver.register_simulation(uuid, f"./{uuid}", "Benchmark", False, { "backend_version": "CellModeller4" })
+
+	params = BackendParameters()
+	params.uuid = uuid
+	params.name = "Benchmark"
+	params.source = "# Stand-in model"
+	params.sim_root_dir = paths.root_path
+	params.cache_dir = paths.cache_path
+	params.cache_relative_prefix = paths.relative_cache_path
+	params.backend_version = "CellModeller4"
+
+	first_frame = threading.Event()
+
+	start = time.perf_counter()
+	spawn_simulation(uuid, TimedSimulationProcess, (params, first_frame))
+
+	if not first_frame.wait(timeout=60.0):
+		raise TimeoutError("Timed out waiting for the first frame")
+
+	elapsed = time.perf_counter() - start
+
+	kill_simulation(uuid)
+	wait_until(lambda: not is_simulation_running(uuid))
+
+	return elapsed * 1000.0
+
+def run(name, pool, simulation_count):
+	workerpool.global__worker_pool = pool
+	pool.start()
+
+	times = []
+
+	for index in range(simulation_count):
+		# Simulations are usually started long after the previous one, so the pool has had time
+		# to replace the worker that was taken
+		wait_until(lambda: len(pool.idle_workers) >= pool.size)
+
+		times.append(time_to_first_frame(f"bench-startup-{name}-{index}"))
+
+	pool.close()
+
+	return times
+
+def main():
+	simulation_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	import_cost = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+
+	os.chdir(tempfile.mkdtemp(prefix="cm5-bench-"))
+	write_stand_in_backend(import_cost)
+
+	print(f"{simulation_count} simulations, {CELL_COUNT} cells, {import_cost:.2f} s stand-in import cost")
+	print(f"{'start':>12} | {'median (ms)':>11} | {'min (ms)':>8} | {'max (ms)':>8}")
+
+	for name, pool in [ ("new process", workerpool.SimulationWorkerPool(0)), ("worker pool", workerpool.SimulationWorkerPool(1, max_simulations=4)) ]:
+		times = run(name.replace(" ", "-"), pool, simulation_count)
+
+		print(f"{name:>12} | {statistics.median(times):>11.1f} | {min(times):>8.1f} | {max(times):>8.1f}")
+
+if __name__ == "__main__":
+	main()
@@ -1,6 +1,23 @@
 import os
 import json
 import pathlib
+import sqlite3
+import threading
+import collections
+import shutil
+import time
+
+from .container import FrameLocation, STEP_CONTAINER_FILE, VIZ_CONTAINER_FILE, close_container_reader
+from .codecs import DEFAULT_CODEC
+from .framecache import invalidate_simulation
+from .vizdelta import drop_reconstructor
+
+# Each simulation directory contains a small header file ('index.json') and an append-only
+# frame log ('frames.jsonl'). The header is only written when the simulation is registered,
+# while the frame log gets one JSON line per frame. This way, adding a frame doesn't require
+# rewriting an index that keeps on growing with the length of the simulation.
+SIM_HEADER_FILE = "index.json"
+FRAME_LOG_FILE = "frames.jsonl"
 
 class ArchivePaths:
 	def __init__(self):
@@ -11,43 +28,133 @@ class ArchivePaths:
 		self.relative_backend_path = None
 
 class SaveArchiver:
+	# Maximum number of simulation headers that are kept in memory at once
+	SIM_CACHE_SIZE = 64
+
 	def __init__(self):
 		self.archive_root = "./save-archive/"
-		self.master_path = os.path.join(self.archive_root, "index.json")
-		self.sim_data = {}
+		self.database_path = os.path.join(self.archive_root, "archive.sqlite3")
+		self.legacy_master_path = os.path.join(self.archive_root, "index.json")
 
 		pathlib.Path(self.archive_root).mkdir(parents=False, exist_ok=True)
 
-		# We may want to move the index file to a database
-		if not os.path.exists(self.master_path):
-			with open(self.master_path, "w") as master_file:
-				master_file.write("{ \"saved_simulations\": {} }")
-
-		with open(self.master_path, "r") as master_file:
-			self.master_data = json.loads(master_file.read())
-
-		for uuid, relative_path in self.master_data["saved_simulations"].items():
-			index_path = os.path.join(self.archive_root, relative_path, "index.json")
-
-			if not os.path.isfile(index_path):
-				print(f"Could not find simulation: {uuid}")
-				continue
-
-			with open(index_path, "r") as index_file:
-				self.sim_data[str(uuid)] = json.loads(index_file.read())
-
-		return
-
-	def update_master_file(self):
-		with open(self.master_path, "w") as master_file:
-			master_file.seek(0)
-			master_file.write(json.dumps(self.master_data))
-			master_file.truncate()
+		# The archiver is shared by the request threads and the simulation communication threads,
+		# so all access to the database connection (and the cache) needs to go through this lock
+		self.lock = threading.RLock()
+		self.sim_cache = collections.OrderedDict()
+
+		self.connection = sqlite3.connect(self.database_path, check_same_thread=False)
+		self.connection.row_factory = sqlite3.Row
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+
+		self._create_tables()
+		self._import_legacy_master_file()
+
+	def _create_tables(self):
+		with self.lock, self.connection:
+			self.connection.execute("""
+				CREATE TABLE IF NOT EXISTS simulations (
+					uuid TEXT PRIMARY KEY,
+					path TEXT NOT NULL,
+					name TEXT NOT NULL,
+					header TEXT NOT NULL,
+					num_frames INTEGER NOT NULL,
+					created REAL NOT NULL
+				)""")
+			self.connection.execute("CREATE INDEX IF NOT EXISTS simulations_by_created ON simulations (created)")
+
+			# A NULL size means that the frame is stored in a file of its own, rather than inside
+			# one of the simulation's frame containers
+			self.connection.execute("""
+				CREATE TABLE IF NOT EXISTS frames (
+					uuid TEXT NOT NULL,
+					frame_index INTEGER NOT NULL,
+					step_file TEXT NOT NULL,
+					viz_file TEXT NOT NULL,
+					step_offset INTEGER NOT NULL DEFAULT 0,
+					step_size INTEGER,
+					viz_offset INTEGER NOT NULL DEFAULT 0,
+					viz_size INTEGER,
+					PRIMARY KEY (uuid, frame_index)
+				) WITHOUT ROWID""")
+
+			# Databases created before frame containers were introduced don't have the offset columns
+			frame_columns = [ row["name"] for row in self.connection.execute("PRAGMA table_info(frames)") ]
+
+			for column in [ "step_offset INTEGER NOT NULL DEFAULT 0", "step_size INTEGER", "viz_offset INTEGER NOT NULL DEFAULT 0", "viz_size INTEGER" ]:
+				if not column.split(" ")[0] in frame_columns:
+					self.connection.execute(f"ALTER TABLE frames ADD COLUMN {column}")
+
+	def _import_legacy_master_file(self):
+		# Archives created before the database was introduced keep their catalogue in 'index.json'.
+		# This only needs to happen once, after which the old catalogue is renamed so that it
+		# doesn't get imported again.
+		if not os.path.isfile(self.legacy_master_path):
+			return
+
+		with open(self.legacy_master_path, "r") as master_file:
+			master_data = json.loads(master_file.read())
+
+		with self.lock:
+			for uuid, relative_path in master_data["saved_simulations"].items():
+				header_path = os.path.join(self.archive_root, relative_path, SIM_HEADER_FILE)
+
+				if not os.path.isfile(header_path):
+					print(f"Could not find simulation: {uuid}")
+					continue
+
+				with self.connection:
+					self.connection.execute("INSERT OR IGNORE INTO simulations VALUES (?, ?, ?, ?, ?, ?)",
+						(str(uuid), relative_path, "", "{}", 0, os.path.getmtime(header_path)))
+
+				self._import_frames_from_disk(str(uuid), relative_path)
+
+		os.replace(self.legacy_master_path, self.legacy_master_path + ".imported")
+
+	def _import_frames_from_disk(self, uuid: str, relative_path: str):
+		# Anything cached for this simulation might not match the frames on disk anymore
+		invalidate_simulation(uuid)
+
+		sim_data = load_sim_index(os.path.join(self.archive_root, relative_path))
+		num_frames = sim_data.pop("num_frames")
+
+		frames = zip(range(num_frames), sim_data.pop("stepframes"), sim_data.pop("vizframes"))
+
+		with self.connection:
+			self.connection.executemany(INSERT_FRAME_QUERY, (_make_frame_row(uuid, index, step_frame, viz_frame) for index, step_frame, viz_frame in frames))
+			self.connection.execute("UPDATE simulations SET name = ?, header = ?, num_frames = ? WHERE uuid = ?",
+				(sim_data.get("name", ""), json.dumps(sim_data), num_frames, uuid))
+
+	def _load_sim_data(self, uuid: str):
+		# NOTE: This has to be called with the lock acquired
+		sim_data = self.sim_cache.get(uuid, None)
+
+		if not sim_data is None:
+			self.sim_cache.move_to_end(uuid)
+			return sim_data
+
+		row = self.connection.execute("SELECT * FROM simulations WHERE uuid = ?", (uuid,)).fetchone()
+
+		if row is None:
+			raise KeyError(f"Simulation '{uuid}' does not exist")
+
+		sim_data = json.loads(row["header"])
+		sim_data.update({ "uuid": uuid, "path": row["path"], "name": row["name"], "num_frames": row["num_frames"], "created": row["created"] })
+
+		self.sim_cache[uuid] = sim_data
+
+		if len(self.sim_cache) > self.SIM_CACHE_SIZE:
+			self.sim_cache.popitem(last=False)
+
+		# The frames are only added to the database as the server hears about them, so if the
+		# server was restarted while the simulation was running (or a message got lost), the
+		# database can be behind the frame log
+		self._sync_frames_with_log(uuid, sim_data)
+
+		return sim_data
 
 	def register_simulation(self, uuid: str, path: str, name: str, create_backend_dir: bool, extra_init_vars: object=None):
-		self.master_data["saved_simulations"][uuid] = path
-		self.update_master_file()
-
 		root_path = os.path.join(self.archive_root, path)
 
 		relative_cache_path = "./cache"
@@ -62,15 +169,23 @@ class SaveArchiver:
 		if create_backend_dir:
 			os.mkdir(backend_path)
 
-		self.sim_data[uuid] = { "vizframes": {}, "stepframes": {}, "name": name, "num_frames": 0 }
+		header = { "name": name, "frame_log": FRAME_LOG_FILE, "codec": DEFAULT_CODEC }
 
 		if not extra_init_vars is None:
-			self.sim_data[uuid].update(extra_init_vars)
+			header.update(extra_init_vars)
 		
-		with open(os.path.join(root_path, "index.json"), "w+") as index_file:
-			index_file.seek(0)
-			index_file.write(json.dumps(self.sim_data[uuid]))
-			index_file.truncate()
+		with open(os.path.join(root_path, SIM_HEADER_FILE), "w") as index_file:
+			index_file.write(json.dumps(header))
+
+		# Create an empty frame log so that readers don't have to special-case simulations
+		# that haven't produced any frames yet
+		open(os.path.join(root_path, FRAME_LOG_FILE), "wb").close()
+
+		with self.lock, self.connection:
+			self.connection.execute("INSERT INTO simulations VALUES (?, ?, ?, ?, ?, ?)",
+				(uuid, path, name, json.dumps(header), 0, time.time()))
+
+		invalidate_simulation(uuid)
 
 		paths = ArchivePaths()
 		paths.root_path = root_path
@@ -86,46 +201,276 @@ class SaveArchiver:
 
 		return paths
 
-	def update_step_data(self, uuid: str, step_data: object):
-		self.sim_data[uuid] = step_data
+	def update_step_data(self, uuid: str, new_frames: list):
+		"""
+		Adds frames to a simulation that is running. 'new_frames' are frame log entries (see
+		'SimIndexWriter.add_entry'), usually just the frame that was written last. Frames that are
+		already known are ignored. If there is a gap between the known frames and the new ones
+		(e.g. because a message from the simulation got lost), the frames are resynced from the
+		simulation's frame log instead.
+		"""
+		with self.lock:
+			sim_data = self._load_sim_data(uuid)
+
+			new_frames = [ entry for entry in new_frames if entry["index"] >= sim_data["num_frames"] ]
+
+			if len(new_frames) == 0:
+				return
+
+			if new_frames[0]["index"] != sim_data["num_frames"]:
+				self.resync_step_data(uuid)
+				return
+
+			self._insert_frames(uuid, new_frames)
+
+	def resync_step_data(self, uuid: str):
+		"""
+		Reads the frame log of a simulation and adds every frame that the archive doesn't know about.
+		This is slower than 'update_step_data', since it goes through the whole frame log.
+		"""
+		with self.lock:
+			self._sync_frames_with_log(uuid, self._load_sim_data(uuid))
+
+	def _sync_frames_with_log(self, uuid: str, sim_data: dict):
+		# NOTE: This has to be called with the lock acquired, and the simulation has to be cached
+		entries, _ = read_frame_log(os.path.join(self.archive_root, sim_data["path"], sim_data.get("frame_log", FRAME_LOG_FILE)))
 
-	def get_all_sim_data(self):
-		return self.sim_data
+		self._insert_frames(uuid, entries[sim_data["num_frames"]:])
+
+	def _insert_frames(self, uuid: str, entries: list):
+		# NOTE: This has to be called with the lock acquired. The entries have to directly follow
+		# the frames that are already in the archive.
+		if len(entries) == 0:
+			return
+
+		sim_data = self._load_sim_data(uuid)
+		num_frames = entries[-1]["index"] + 1
+
+		with self.connection:
+			self.connection.executemany(INSERT_FRAME_QUERY,
+				(_make_frame_row(uuid, entry["index"], entry["stepframe"], entry["vizframe"]) for entry in entries))
+			self.connection.execute("UPDATE simulations SET num_frames = ? WHERE uuid = ?", (num_frames, uuid))
+
+		sim_data["num_frames"] = num_frames
+
+	def delete_simulation(self, uuid: str, delete_files: bool=True):
+		"""
+		Removes a simulation from the archive, along with everything that was cached for it. The
+		simulation directory is deleted too, unless 'delete_files' is False. The simulation should
+		not be running when it gets deleted.
+		"""
+		with self.lock:
+			sim_data = self._load_sim_data(uuid)
+
+			with self.connection:
+				self.connection.execute("DELETE FROM frames WHERE uuid = ?", (uuid,))
+				self.connection.execute("DELETE FROM simulations WHERE uuid = ?", (uuid,))
+
+			self.sim_cache.pop(uuid, None)
+
+		root_path = os.path.join(self.archive_root, sim_data["path"])
+
+		close_container_reader(os.path.join(root_path, STEP_CONTAINER_FILE))
+		close_container_reader(os.path.join(root_path, "./cache", VIZ_CONTAINER_FILE))
+
+		invalidate_simulation(uuid)
+		drop_reconstructor(uuid)
+
+		if delete_files:
+			shutil.rmtree(root_path, ignore_errors=True)
+
+	def has_simulation(self, uuid: str):
+		with self.lock:
+			row = self.connection.execute("SELECT 1 FROM simulations WHERE uuid = ?", (uuid,)).fetchone()
+
+		return not row is None
+
+	def get_all_sim_data(self, offset: int=0, limit: int=50):
+		with self.lock:
+			rows = self.connection.execute("SELECT uuid, name, num_frames, created FROM simulations ORDER BY created DESC LIMIT ? OFFSET ?",
+				(int(limit), int(offset))).fetchall()
+
+		return [ dict(row) for row in rows ]
 
 	def get_sim_index_data(self, uuid: str):
-		return self.sim_data[uuid]
+		with self.lock:
+			return self._load_sim_data(uuid)
+
+	def _get_frame_location(self, uuid: str, index: int, prefix: str):
+		with self.lock:
+			sim_data = self._load_sim_data(uuid)
+
+			row = self.connection.execute(f"SELECT {prefix}_file, {prefix}_offset, {prefix}_size FROM frames WHERE uuid = ? AND frame_index = ?",
+				(uuid, int(index))).fetchone()
 
-	def get_sim_step_file(self, uuid: str, index: int):
-		simulation_root = self.master_data["saved_simulations"][uuid]
-		frame_relative_path = self.sim_data[uuid]["stepframes"][index]
+		if row is None:
+			raise IndexError(f"Frame {index} does not exist in simulation '{uuid}'")
 
-		return os.path.join(self.archive_root, simulation_root, frame_relative_path)
+		return FrameLocation(os.path.join(self.archive_root, sim_data["path"], row[0]), row[1], row[2])
 
-	def get_sim_bin_file(self, uuid: str, index: int):
-		simulation_root = self.master_data["saved_simulations"][uuid]
-		frame_relative_path = self.sim_data[uuid]["vizframes"][index]
+	def get_sim_step_frame(self, uuid: str, index: int):
+		return self._get_frame_location(uuid, index, "step")
 
-		return os.path.join(self.archive_root, simulation_root, frame_relative_path)
+	def get_sim_bin_frame(self, uuid: str, index: int):
+		return self._get_frame_location(uuid, index, "viz")
 
-def add_entry_to_sim_index(index_path, step_file: str, viz_bin_file: str):
-	with open(index_path, "r+") as index_file:
+	def _get_frame_location_range(self, uuid: str, start: int, end: int, stride: int, prefix: str):
+		with self.lock:
+			sim_data = self._load_sim_data(uuid)
+
+			rows = self.connection.execute(f"""
+				SELECT frame_index, {prefix}_file, {prefix}_offset, {prefix}_size FROM frames
+				WHERE uuid = ? AND frame_index >= ? AND frame_index < ? AND (frame_index - ?) % ? = 0
+				ORDER BY frame_index""", (uuid, int(start), int(end), int(start), int(stride))).fetchall()
+
+		sim_path = os.path.join(self.archive_root, sim_data["path"])
+
+		return [ (row[0], FrameLocation(os.path.join(sim_path, row[1]), row[2], row[3])) for row in rows ]
+
+	def get_sim_step_frame_range(self, uuid: str, start: int, end: int, stride: int=1):
+		"""
+		Returns the index and location of every step frame in '[start, end)', skipping 'stride' frames
+		at a time. Frames past the end of the simulation are left out.
+		"""
+		return self._get_frame_location_range(uuid, start, end, stride, "step")
+
+	def get_sim_bin_frame_range(self, uuid: str, start: int, end: int, stride: int=1):
+		"""
+		Same as 'get_sim_step_frame_range', but for viz frames.
+		"""
+		return self._get_frame_location_range(uuid, start, end, stride, "viz")
+
+INSERT_FRAME_QUERY = """
+	INSERT OR IGNORE INTO frames (uuid, frame_index, step_file, step_offset, step_size, viz_file, viz_offset, viz_size)
+	VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+def _make_frame_row(uuid: str, index: int, step_frame, viz_frame):
+	step_location = FrameLocation.from_entry(step_frame)
+	viz_location = FrameLocation.from_entry(viz_frame)
+
+	return (uuid, index,
+		step_location.path, step_location.offset, step_location.size,
+		viz_location.path, viz_location.offset, viz_location.size)
+
+def read_frame_log(log_path: str):
+	"""
+	Reads all the complete entries from a frame log. Returns the entries and the number of bytes
+	that they occupy. If the writer crashed while appending a frame, the log may end with a partial
+	line. That line (and anything after it) is ignored, so the byte count can be used to cut it off.
+	This works for any log with one entry per frame, which is why the stats log uses it too.
+	"""
+	entries = []
+	valid_length = 0
+
+	if not os.path.isfile(log_path):
+		return entries, valid_length
+
+	with open(log_path, "rb") as log_file:
+		for line in log_file:
+			if not line.endswith(b"\n"):
+				break
+
+			try:
+				entry = json.loads(line)
+			except ValueError:
+				break
+
+			# Entries are always appended in order, so an out-of-order index means that the
+			# log is corrupted from this point onwards
+			if entry.get("index", -1) != len(entries):
+				break
+
+			entries.append(entry)
+			valid_length += len(line)
+
+	return entries, valid_length
+
+def _get_legacy_frames(sim_data: dict):
+	# Older simulations store every frame inside the header file itself, keyed by the frame index
+	frame_keys = sorted(sim_data["vizframes"].keys(), key=int)
+
+	return [ sim_data["stepframes"][key] for key in frame_keys ], [ sim_data["vizframes"][key] for key in frame_keys ]
+
+def load_sim_index(sim_root: str):
+	with open(os.path.join(sim_root, SIM_HEADER_FILE), "r") as index_file:
 		sim_data = json.loads(index_file.read())
 
-		frame_count = len(sim_data["vizframes"])
-		sim_data["vizframes"][frame_count] = viz_bin_file
-		sim_data["stepframes"][frame_count] = step_file
-		sim_data["num_frames"] = frame_count + 1
+	entries, _ = read_frame_log(os.path.join(sim_root, sim_data.get("frame_log", FRAME_LOG_FILE)))
+
+	# If an older simulation was continued, its frames were copied into the frame log before the
+	# new ones (see 'SimIndexWriter'), so the log is only used once it has all of them
+	if "vizframes" in sim_data and len(entries) < len(sim_data["vizframes"]):
+		sim_data["stepframes"], sim_data["vizframes"] = _get_legacy_frames(sim_data)
+		sim_data["num_frames"] = len(sim_data["vizframes"])
+
+		return sim_data
+
+	sim_data["vizframes"] = [ entry["vizframe"] for entry in entries ]
+	sim_data["stepframes"] = [ entry["stepframe"] for entry in entries ]
+	sim_data["num_frames"] = len(entries)
+
+	return sim_data
+
+class SimIndexWriter:
+	"""
+	Appends frames to the frame log of a simulation. Only the simulation instance that owns the
+	simulation directory should create one of these.
+	"""
+	def __init__(self, sim_root: str):
+		with open(os.path.join(sim_root, SIM_HEADER_FILE), "r") as index_file:
+			sim_data = json.loads(index_file.read())
+
+		# The entries are only ever appended to the log, so there's no need to keep them in memory.
+		# Only the number of frames is needed, to know the index of the next one.
+		log_path = os.path.join(sim_root, sim_data.get("frame_log", FRAME_LOG_FILE))
+		entries, valid_length = read_frame_log(log_path)
+
+		self.num_frames = len(entries)
+
+		self.log_file = open(log_path, "ab")
 
-		sim_data_str = json.dumps(sim_data)
+		# Drop any partially written entry left behind by a crash, so that new entries
+		# start on a fresh line
+		if self.log_file.tell() != valid_length:
+			self.log_file.truncate(valid_length)
+			self.log_file.seek(valid_length)
 
-		index_file.seek(0)
-		index_file.write(sim_data_str)
-		index_file.truncate()
+		# The log has to start at frame 0, so the frames of older simulations (which are stored in
+		# the header) are copied into it before any new frames are added
+		if "vizframes" in sim_data:
+			step_frames, viz_frames = _get_legacy_frames(sim_data)
 
-	return (sim_data_str, frame_count)
+			for step_frame, viz_frame in zip(step_frames[self.num_frames:], viz_frames[self.num_frames:]):
+				self.add_entry(step_frame, viz_frame)
 
-global__save_archiver = SaveArchiver()
+	# The frames can either be paths to standalone files or the locations returned by a
+	# 'FrameContainerWriter' (i.e. '{ "file": ..., "offset": ..., "size": ... }'). Returns the
+	# entry that was added to the log, which can be passed to 'SaveArchiver.update_step_data'.
+	def add_entry(self, step_frame, viz_frame):
+		frame_index = self.num_frames
+
+		entry = { "index": frame_index, "stepframe": step_frame, "vizframe": viz_frame }
+
+		self.log_file.write((json.dumps(entry) + "\n").encode("utf-8"))
+		self.log_file.flush()
+
+		self.num_frames = frame_index + 1
+
+		return entry
+
+	def close(self):
+		self.log_file.close()
+
+# The archiver is created the first time it is needed, rather than when this module is imported
+global__save_archiver = None
+global__save_archiver_lock = threading.Lock()
 
 def get_save_archiver():
 	global global__save_archiver
+	global global__save_archiver_lock
+
+	with global__save_archiver_lock:
+		if global__save_archiver is None:
+			global__save_archiver = SaveArchiver()
+
 	return global__save_archiver
\ No newline at end of file
@@ -0,0 +1,89 @@
+import zlib
+import lzma
+import bz2
+
+# Frames are compressed with one of the codecs below. The name of the codec is stored in the header
+# of every simulation, so that the frames can be decoded correctly. Simulations created before the
+# codec was stored always use 'DEFAULT_CODEC'.
+#
+# Codec names can have a level suffix (e.g. 'zlib-6'), which is passed to the compressor.
+DEFAULT_CODEC = "zlib-2"
+
+class FrameCodec:
+	def __init__(self, name, level, compress, decompress, content_encoding=None):
+		self.name = name
+		self.level = level
+		self.compress = compress
+		self.decompress = decompress
+
+		# The HTTP 'Content-Encoding' that browsers can decode by themselves, if there is one
+		self.content_encoding = content_encoding
+
+def is_zlib_codec(codec):
+	return codec.name.partition("-")[0] == "zlib"
+
+def _make_zlib_codec(name, level):
+	return FrameCodec(name, level, lambda data: zlib.compress(data, level), zlib.decompress, "deflate")
+
+def _make_deflate_codec(name, level):
+	# Raw deflate streams (without the zlib header and checksum)
+	def compress(data):
+		compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+		return compressor.compress(data) + compressor.flush()
+
+	return FrameCodec(name, level, compress, lambda data: zlib.decompress(data, -zlib.MAX_WBITS))
+
+def _make_lzma_codec(name, level):
+	return FrameCodec(name, level, lambda data: lzma.compress(data, preset=level), lzma.decompress)
+
+def _make_bz2_codec(name, level):
+	return FrameCodec(name, level, lambda data: bz2.compress(data, level), bz2.decompress)
+
+def _make_store_codec(name, level):
+	return FrameCodec(name, level, bytes, bytes)
+
+# Codec factories and the level each codec uses by default
+CODEC_FACTORIES = {
+	"zlib": (_make_zlib_codec, 2),
+	"deflate": (_make_deflate_codec, 2),
+	"lzma": (_make_lzma_codec, 6),
+	"bz2": (_make_bz2_codec, 9),
+	"store": (_make_store_codec, 0),
+}
+
+global__codec_cache = {}
+
+def get_codec(name: str=None):
+	global global__codec_cache
+
+	if name is None:
+		name = DEFAULT_CODEC
+
+	codec = global__codec_cache.get(name, None)
+
+	if not codec is None:
+		return codec
+
+	base_name, _, level = name.partition("-")
+
+	if not base_name in CODEC_FACTORIES:
+		raise ValueError(f"Unknown frame codec: {name}")
+
+	factory, default_level = CODEC_FACTORIES[base_name]
+
+	try:
+		level = int(level) if level else default_level
+	except ValueError:
+		raise ValueError(f"Invalid level for frame codec: {name}")
+
+	codec = factory(name, level)
+
+	# Make sure that the level is actually supported by the compressor
+	try:
+		codec.compress(b"")
+	except Exception:
+		raise ValueError(f"Invalid level for frame codec: {name}")
+
+	global__codec_cache[name] = codec
+
+	return codec
@@ -0,0 +1,134 @@
+import os
+import mmap
+import struct
+import threading
+import collections
+
+# Frames are appended one after the other to a single container file per simulation (one for the
+# step frames and one for the viz frames). Every frame is preceded by a small record header, which
+# isn't needed for reading, but it makes it possible to recover the offset table by scanning the
+# file if the frame log ever gets lost. The offset table itself is the simulation's frame log.
+STEP_CONTAINER_FILE = "frames.cm5_steps"
+VIZ_CONTAINER_FILE = "frames.cm5_vizs"
+
+RECORD_MAGIC = b"CMFR"
+RECORD_HEADER = struct.Struct("<4sII")
+
+class FrameLocation:
+	def __init__(self, path, offset=0, size=None):
+		self.path = path
+		self.offset = offset
+		# A size of 'None' means that the frame is stored in its own file (i.e. it was written
+		# before containers were introduced)
+		self.size = size
+
+	def is_standalone_file(self):
+		return self.size is None
+
+	@staticmethod
+	def from_entry(entry):
+		if isinstance(entry, str):
+			return FrameLocation(entry)
+
+		return FrameLocation(entry["file"], entry["offset"], entry["size"])
+
+class FrameContainerWriter:
+	def __init__(self, path):
+		self.file = open(path, "ab")
+
+	def append(self, step_index, data):
+		header = RECORD_HEADER.pack(RECORD_MAGIC, int(step_index), len(data))
+
+		offset = self.file.tell() + len(header)
+
+		self.file.write(header)
+		self.file.write(data)
+		self.file.flush()
+
+		return offset, len(data)
+
+	def close(self):
+		self.file.close()
+
+class FrameContainerReader:
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+
+		self.file = open(path, "rb")
+		self.mapping = None
+		self.mapped_size = 0
+
+	def _remap(self):
+		# The container keeps on growing while the simulation is running, so we need to map it
+		# again whenever a frame past the end of the current mapping is requested
+		size = os.fstat(self.file.fileno()).st_size
+
+		if not self.mapping is None:
+			self.mapping.close()
+
+		self.mapping = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ) if size > 0 else None
+		self.mapped_size = size
+
+	def read(self, offset, size):
+		with self.lock:
+			if offset + size > self.mapped_size:
+				self._remap()
+
+			if offset + size > self.mapped_size:
+				raise IndexError(f"Frame at offset {offset} (size: {size}) is outside of container: {self.path}")
+
+			return self.mapping[offset:offset + size]
+
+	def close(self):
+		with self.lock:
+			if not self.mapping is None:
+				self.mapping.close()
+
+			self.file.close()
+
+# Open containers are shared between all requests. We don't want to keep every container that
+# was ever accessed mapped, so only the most recently used ones are kept around.
+MAX_OPEN_CONTAINERS = 32
+
+global__open_containers = collections.OrderedDict()
+global__container_lock = threading.Lock()
+
+def get_container_reader(path):
+	global global__open_containers
+	global global__container_lock
+
+	path = os.path.normpath(path)
+
+	with global__container_lock:
+		reader = global__open_containers.get(path, None)
+
+		if reader is None:
+			reader = FrameContainerReader(path)
+			global__open_containers[path] = reader
+
+			# NOTE: The evicted reader isn't closed explicitly because another thread might still
+			# be reading from it. It will be closed once the last reference to it is dropped.
+			if len(global__open_containers) > MAX_OPEN_CONTAINERS:
+				global__open_containers.popitem(last=False)
+		else:
+			global__open_containers.move_to_end(path)
+
+	return reader
+
+def close_container_reader(path):
+	global global__open_containers
+	global global__container_lock
+
+	with global__container_lock:
+		reader = global__open_containers.pop(os.path.normpath(path), None)
+
+	if not reader is None:
+		reader.close()
+
+def read_frame(location: FrameLocation):
+	if location.is_standalone_file():
+		with open(location.path, "rb") as frame_file:
+			return frame_file.read()
+
+	return get_container_reader(location.path).read(location.offset, location.size)
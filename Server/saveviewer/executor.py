@@ -0,0 +1,44 @@
+import os
+import asyncio
+import functools
+import threading
+import concurrent.futures
+
+# Django runs synchronous views on a single thread when it is served through ASGI, so a couple of
+# viewers decompressing frames at the same time would block each other (and every other request).
+# The async views hand their blocking work (reading frames, decompressing them, database lookups)
+# to this executor instead. The number of workers is bounded, so a lot of viewers scrubbing at once
+# queue up here rather than starting an unbounded number of threads.
+FRAME_IO_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+global__frame_executor = None
+global__frame_executor_lock = threading.Lock()
+
+def get_frame_executor():
+	global global__frame_executor
+	global global__frame_executor_lock
+
+	with global__frame_executor_lock:
+		if global__frame_executor is None:
+			global__frame_executor = concurrent.futures.ThreadPoolExecutor(max_workers=FRAME_IO_WORKERS, thread_name_prefix="frame-io")
+
+	return global__frame_executor
+
+async def run_blocking(func, *args, **kwargs):
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(get_frame_executor(), functools.partial(func, *args, **kwargs))
+
+# Size of the chunks that response bodies are streamed in. Bodies smaller than the threshold are
+# sent in one go, since streaming them only adds overhead.
+STREAM_CHUNK_SIZE = 256 * 1024
+STREAM_THRESHOLD = 1024 * 1024
+
+async def stream_bytes(data):
+	"""
+	Yields a bytes-like object in chunks, so large frames can be sent without copying them into a
+	single response body first.
+	"""
+	view = memoryview(data)
+
+	for offset in range(0, len(view), STREAM_CHUNK_SIZE):
+		yield bytes(view[offset:offset + STREAM_CHUNK_SIZE])
@@ -1,4 +1,83 @@
-import struct, io, zlib
+import struct, io
+
+import numpy as np
+
+from .codecs import get_codec
+
+# Step frames used to be stored row-by-row (one 'PackedCell' after another). Newer frames store
+# every attribute in a contiguous column instead, which allows whole-frame analysis to be done
+# with NumPy. Columnar frames start with 'STEP_FORMAT_MAGIC', which cannot be confused with the
+# cell count at the start of row-based frames (unless there are more than a billion cells).
+STEP_FORMAT_MAGIC = b"CM5S"
+STEP_FORMAT_VERSION = 2
+
+# Magic, Version, Cell count, Flags
+COLUMNAR_HEADER = struct.Struct("<4sIII")
+
+# The attributes of a cell, in the order in which they are stored. In columnar frames, each field
+# is stored as a separate array. In row-based frames, each cell is stored as one (packed) element.
+CELL_DTYPE = np.dtype([
+	("id", "<u8"),
+	("radius", "<f4"),
+	("length", "<f4"),
+	("growth_rate", "<f4"),
+	("cell_age", "<i4"),
+	("eff_growth", "<f4"),
+	("cell_type", "<i4"),
+	("cell_adhesion", "<i4"),
+	("target_volume", "<f4"),
+	("volume", "<f4"),
+	("strain_rate", "<f4"),
+	("start_volume", "<f4"),
+])
+
+# Set when the rows of a columnar frame are sorted by cell id, which allows cells to be found with
+# a binary search
+STEP_FLAG_SORTED_BY_ID = 1
+
+# Columns are padded so that every one of them starts at an 8-byte boundary
+COLUMN_ALIGNMENT = 8
+
+def _align_column_offset(offset):
+	return (offset + COLUMN_ALIGNMENT - 1) & ~(COLUMN_ALIGNMENT - 1)
+
+# Viz frames contain a cell count, followed by one 'VIZ_CELL_DTYPE' element for every cell, followed
+# by the id of every cell. This is the layout expected by the viewer (and written by the native module).
+# Note that the vectors are stored with the Y and Z axes swapped.
+VIZ_CELL_DTYPE = np.dtype([
+	("pos", "<f4", (3,)),
+	("dir", "<f4", (3,)),
+	("length", "<f4"),
+	("radius", "<f4"),
+	("color", "<u4"),
+])
+
+def allocate_viz_frame(cell_count):
+	"""
+	Allocates the buffer for an (uncompressed) viz frame and returns it, along with views of the
+	cell array and id array inside it. The cell count is already written to the buffer.
+	"""
+	cells_offset = 4
+	ids_offset = cells_offset + VIZ_CELL_DTYPE.itemsize * cell_count
+
+	buffer = np.empty(ids_offset + 8 * cell_count, dtype=np.uint8)
+	buffer[:cells_offset].view("<i4")[0] = cell_count
+
+	cells = buffer[cells_offset:ids_offset].view(VIZ_CELL_DTYPE)
+	ids = buffer[ids_offset:].view("<u8")
+
+	return buffer, cells, ids
+
+def unpack_viz_frame(data):
+	"""
+	Returns views of the cell array and the id array of an (uncompressed) viz frame.
+	"""
+	(cell_count,) = struct.unpack_from("<i", data, 0)
+
+	cells = np.frombuffer(data, dtype=VIZ_CELL_DTYPE, count=cell_count, offset=4)
+	ids = np.frombuffer(data, dtype="<u8", count=cell_count, offset=4 + VIZ_CELL_DTYPE.itemsize * cell_count)
+
+	return cells, ids
 
 class PackedCell:
 	def __init__(self):
@@ -33,6 +112,15 @@ class PackedCell:
 
 		return packed_cell
 
+	@staticmethod
+	def from_columns(columns, index):
+		packed_cell = PackedCell()
+
+		for name in CELL_DTYPE.names:
+			setattr(packed_cell, name, columns[name][index].item())
+
+		return packed_cell
+
 	@staticmethod
 	def byte_size():
 		return 8 + 4 * 11
@@ -84,30 +172,153 @@ class PackedCellWriter:
 	def write_cell(self, cell):
 		PackedCell.write_to_bytesio(cell, self.byte_buffer)
 
-	def flush_to_file(self, file):
-		file.write(zlib.compress(self.byte_buffer.getbuffer(), 2))
+	def compress(self, codec=None):
+		return (codec or get_codec()).compress(self.byte_buffer.getbuffer())
+
+	def flush_to_file(self, file, codec=None):
+		file.write(self.compress(codec))
+
+class ColumnarCellWriter:
+	"""
+	Writes step frames in the columnar format. The cells are passed in as a structured array
+	with the 'CELL_DTYPE' data type (or anything that can be converted to one).
+	"""
+	def __init__(self, cells):
+		cells = np.asarray(cells, dtype=CELL_DTYPE)
+
+		# Cells are stored sorted by their id so that readers can look them up with a binary search
+		ids = cells["id"]
+
+		if len(ids) > 1 and not np.all(ids[:-1] <= ids[1:]):
+			cells = cells[np.argsort(ids, kind="stable")]
+
+		self.cells = cells
+
+	def to_bytes(self):
+		cell_count = len(self.cells)
+
+		parts = [ COLUMNAR_HEADER.pack(STEP_FORMAT_MAGIC, STEP_FORMAT_VERSION, cell_count, STEP_FLAG_SORTED_BY_ID) ]
+		offset = COLUMNAR_HEADER.size
+
+		for name in CELL_DTYPE.names:
+			padding = _align_column_offset(offset) - offset
+
+			column = np.ascontiguousarray(self.cells[name]).tobytes()
+
+			parts.append(b"\0" * padding)
+			parts.append(column)
+
+			offset += padding + len(column)
+
+		return b"".join(parts)
+
+	def compress(self, codec=None):
+		return (codec or get_codec()).compress(self.to_bytes())
 
 class PackedCellReader:
-	def __init__(self, file):
-		self.byte_buffer = zlib.decompress(file.read())
+	def __init__(self, compressed_data, codec=None):
+		self.byte_buffer = (codec or get_codec()).decompress(compressed_data)
 		self._read_header()
 		
 	def _read_header(self):
-		(cell_count,) = struct.unpack_from("<i", self.byte_buffer, 0)
+		if self.byte_buffer[:len(STEP_FORMAT_MAGIC)] == STEP_FORMAT_MAGIC:
+			(_, version, cell_count, flags) = COLUMNAR_HEADER.unpack_from(self.byte_buffer, 0)
+
+			if version != STEP_FORMAT_VERSION:
+				raise ValueError(f"Unsupported step frame version: {version}")
+
+			self.version = version
+			self.cell_count = cell_count
+			self.sorted_by_id = (flags & STEP_FLAG_SORTED_BY_ID) != 0
+		else:
+			(cell_count,) = struct.unpack_from("<i", self.byte_buffer, 0)
+
+			self.version = 1
+			self.cell_count = cell_count
+			self.sorted_by_id = False
+
+		self.columns = None
+		self.id_index = None
+
+	def get_byte_size(self):
+		"""
+		Returns (roughly) how much memory the reader needs, including the id index that gets
+		built when looking up cells by id.
+		"""
+		id_index_size = 0 if self.sorted_by_id else 16 * self.cell_count
+
+		return len(self.byte_buffer) + id_index_size
+
+	def get_columns(self):
+		"""
+		Returns a dictionary with a NumPy array for every cell attribute. The arrays are views
+		into the decompressed frame, so they are read-only and nothing gets copied.
+		"""
+		if not self.columns is None:
+			return self.columns
+
+		if self.version == 1:
+			# Row-based frames are just a packed array of structures, so the columns can be viewed
+			# as strided arrays over the rows
+			rows = np.frombuffer(self.byte_buffer, dtype=CELL_DTYPE, count=self.cell_count, offset=4)
+
+			self.columns = { name: rows[name] for name in CELL_DTYPE.names }
+		else:
+			self.columns = {}
 
-		self.cell_count = cell_count
+			offset = COLUMNAR_HEADER.size
+
+			for name in CELL_DTYPE.names:
+				column_dtype = CELL_DTYPE.fields[name][0]
+				offset = _align_column_offset(offset)
+
+				self.columns[name] = np.frombuffer(self.byte_buffer, dtype=column_dtype, count=self.cell_count, offset=offset)
+
+				offset += column_dtype.itemsize * self.cell_count
+
+		return self.columns
+
+	def get_column(self, name):
+		return self.get_columns()[name]
 	
 	def read_cell_at_index(self, index):
 		if self.cell_count <= index:
 			raise IndexError(f"Cell index ({index}) is out of bounds. Acceptable range is 0 to {self.cell_count - 1}")
 
-		return PackedCell.read_from_bytesio(self.byte_buffer, 4 + PackedCell.byte_size() * index)
+		if self.version == 1:
+			return PackedCell.read_from_bytesio(self.byte_buffer, 4 + PackedCell.byte_size() * index)
+
+		return PackedCell.from_columns(self.get_columns(), index)
+
+	def find_row_with_id(self, id):
+		"""
+		Returns the row of the cell with the given id, or -1 if there is no such cell.
+		"""
+		ids = self.get_column("id")
+
+		if self.sorted_by_id:
+			sorted_ids, order = ids, None
+		else:
+			# Frames that aren't sorted by id (e.g. row-based frames) need an index, which requires
+			# sorting all the ids. The index is kept on the reader, so readers that are kept in the
+			# frame cache only build it once.
+			if self.id_index is None:
+				order = np.argsort(ids, kind="stable")
+				self.id_index = (ids[order], order)
+
+			sorted_ids, order = self.id_index
+
+		position = int(np.searchsorted(sorted_ids, id))
+
+		if position >= len(sorted_ids) or sorted_ids[position] != id:
+			return -1
+
+		return position if order is None else int(order[position])
 
 	def find_cell_with_id(self, id):
-		for i in range(0, self.cell_count):
-			cell = self.read_cell_at_index(i)
+		row = self.find_row_with_id(id)
 
-			if cell.id == id:
-				return cell
-		
-		return None
\ No newline at end of file
+		if row < 0:
+			return None
+
+		return self.read_cell_at_index(row)
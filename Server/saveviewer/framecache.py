@@ -0,0 +1,112 @@
+import threading
+import collections
+
+# Decompressing a step frame takes much longer than reading a cell from it, and the viewer asks for
+# the selected cell every time the frame changes, so the same frames get decompressed over and over.
+# The frame cache keeps the most recently used decoded frames around (across all requests), up to a
+# total number of bytes.
+#
+# Entries are keyed by '(uuid, kind, frame index)'. Frames never change once they are written, so
+# entries only need to be dropped when a simulation is deleted or its frames are rewritten.
+FRAME_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+class FrameCache:
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+
+		self.entries = collections.OrderedDict()
+		self.total_bytes = 0
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.get(key, None)
+
+			if entry is None:
+				self.misses += 1
+				return None
+
+			self.entries.move_to_end(key)
+			self.hits += 1
+
+			return entry[0]
+
+	def peek(self, key):
+		"""
+		Same as 'get', but doesn't count towards the hits and misses. This is meant for readers that
+		go through a lot of frames once, and only use the cache when a frame happens to be in it.
+		"""
+		with self.lock:
+			entry = self.entries.get(key, None)
+
+			return None if entry is None else entry[0]
+
+	def put(self, key, value, size):
+		with self.lock:
+			# Values that would push everything else out aren't worth caching
+			if size > self.max_bytes:
+				return
+
+			previous = self.entries.pop(key, None)
+
+			if not previous is None:
+				self.total_bytes -= previous[1]
+
+			self.entries[key] = (value, size)
+			self.total_bytes += size
+
+			while self.total_bytes > self.max_bytes:
+				_, (_, evicted_size) = self.entries.popitem(last=False)
+
+				self.total_bytes -= evicted_size
+				self.evictions += 1
+
+	def get_or_load(self, key, load, get_size):
+		"""
+		Returns the cached value for 'key', or calls 'load' and caches its result. Two threads that
+		miss on the same key at the same time will both load it, which is cheaper than holding the
+		lock while decompressing.
+		"""
+		value = self.get(key)
+
+		if value is None:
+			value = load()
+			self.put(key, value, get_size(value))
+
+		return value
+
+	def invalidate_simulation(self, uuid: str):
+		with self.lock:
+			keys = [ key for key in self.entries.keys() if key[0] == uuid ]
+
+			for key in keys:
+				_, size = self.entries.pop(key)
+				self.total_bytes -= size
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.total_bytes = 0
+
+	def get_stats(self):
+		with self.lock:
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+				"entries": len(self.entries),
+				"bytes": self.total_bytes,
+				"max_bytes": self.max_bytes,
+			}
+
+global__frame_cache = FrameCache(FRAME_CACHE_MAX_BYTES)
+
+def get_frame_cache():
+	return global__frame_cache
+
+def invalidate_simulation(uuid: str):
+	global__frame_cache.invalidate_simulation(uuid)
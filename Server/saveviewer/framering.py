@@ -0,0 +1,184 @@
+import struct
+import threading
+
+from multiprocessing import shared_memory
+
+# Simulation processes write every new viz frame to a ring buffer in shared memory, in the form that is
+# sent to the viewers (a zlib stream of the full frame, see 'SimulationBackend.get_wire_viz_frame').
+# Only the sequence number of the frame is sent over the pipe, and the server reads the frame straight
+# from shared memory instead of reading it back from the frame container on disk.
+#
+# The server creates the ring buffer and owns it: it is the only one that unlinks it, which happens when
+# the simulation process's pipe is closed (including when the process dies without closing it).
+#
+# The ring buffer has 'FRAME_RING_SLOTS' slots, each of which can hold a frame of up to
+# 'FRAME_RING_SLOT_SIZE' bytes. Frames that don't fit aren't written to the ring buffer, and the server
+# reads those from disk like it always has.
+FRAME_RING_SLOTS = 4
+FRAME_RING_SLOT_SIZE = 16 * 1024 * 1024
+
+# Header: slot count and slot size. Every slot has a header with the sequence number of the frame
+# that is in the slot (0 while the slot is empty or being written), the frame's index and its size.
+RING_HEADER = struct.Struct("<II")
+SLOT_HEADER = struct.Struct("<QII")
+
+def _get_slot_offset(slot_count, slot_size, slot):
+	return RING_HEADER.size + slot_count * SLOT_HEADER.size + slot * slot_size
+
+def _get_ring_size(slot_count, slot_size):
+	return _get_slot_offset(slot_count, slot_size, slot_count)
+
+def attach_shared_memory(name):
+	"""
+	Opens an existing shared memory block without taking ownership of it (only the server should
+	unlink the ring buffer).
+	"""
+	try:
+		return shared_memory.SharedMemory(name=name, track=False)
+	except TypeError:
+		# NOTE: Python < 3.13 doesn't have 'track', so the block gets registered with the
+		# resource tracker again. Processes started with "spawn" share the server's resource tracker,
+		# which already knows about the block, so this doesn't change anything. Unregistering it here
+		# would remove the server's registration too.
+		return shared_memory.SharedMemory(name=name)
+
+class FrameRingWriter:
+	"""
+	The simulation process's side of the ring buffer. There must only be one writer per ring buffer.
+	"""
+	def __init__(self, name):
+		self.memory = attach_shared_memory(name)
+		self.slot_count, self.slot_size = RING_HEADER.unpack_from(self.memory.buf, 0)
+
+		self.sequence = 0
+
+	def write_frame(self, frame_index, data):
+		"""
+		Writes a frame to the next slot, replacing the oldest frame. Returns the frame's sequence
+		number, or 'None' if the frame is too large for the ring buffer.
+		"""
+		if data is None or len(data) > self.slot_size:
+			return None
+
+		self.sequence += 1
+
+		slot = self.sequence % self.slot_count
+		header_offset = RING_HEADER.size + slot * SLOT_HEADER.size
+		data_offset = _get_slot_offset(self.slot_count, self.slot_size, slot)
+
+		# The slot is marked as empty while it is being written, so that the server doesn't read a
+		# frame that is only half written (see 'FrameRingReader.read_slot')
+		SLOT_HEADER.pack_into(self.memory.buf, header_offset, 0, 0, 0)
+
+		self.memory.buf[data_offset:data_offset + len(data)] = data
+
+		SLOT_HEADER.pack_into(self.memory.buf, header_offset, self.sequence, frame_index, len(data))
+
+		return self.sequence
+
+	def close(self):
+		self.memory.close()
+
+class FrameRingReader:
+	"""
+	The server's side of the ring buffer. This creates the shared memory block, which is passed to
+	the simulation process by name.
+	"""
+	def __init__(self, slot_count=FRAME_RING_SLOTS, slot_size=FRAME_RING_SLOT_SIZE):
+		self.memory = shared_memory.SharedMemory(create=True, size=_get_ring_size(slot_count, slot_size))
+		self.name = self.memory.name
+
+		self.slot_count = slot_count
+		self.slot_size = slot_size
+
+		RING_HEADER.pack_into(self.memory.buf, 0, slot_count, slot_size)
+
+		# NOTE: Closing the shared memory while a view of it exists raises an exception, so
+		# frames are only copied out of it (and the memory is only closed) while holding the lock
+		self.lock = threading.Lock()
+		self.is_closed = False
+
+	def _read_slot(self, slot, sequence=None, frame_index=None):
+		# NOTE: This has to be called with the lock acquired
+		header_offset = RING_HEADER.size + slot * SLOT_HEADER.size
+		slot_sequence, slot_frame_index, size = SLOT_HEADER.unpack_from(self.memory.buf, header_offset)
+
+		if slot_sequence == 0:
+			return None
+
+		if (not sequence is None and slot_sequence != sequence) or (not frame_index is None and slot_frame_index != frame_index):
+			return None
+
+		data_offset = _get_slot_offset(self.slot_count, self.slot_size, slot)
+		data = bytes(self.memory.buf[data_offset:data_offset + size])
+
+		# The simulation could have started overwriting the slot while we were copying it
+		if SLOT_HEADER.unpack_from(self.memory.buf, header_offset)[0] != slot_sequence:
+			return None
+
+		return data
+
+	def read_frame(self, sequence):
+		"""
+		Returns the frame with the given sequence number, or 'None' if it has been overwritten.
+		"""
+		with self.lock:
+			if self.is_closed or sequence is None:
+				return None
+
+			return self._read_slot(sequence % self.slot_count, sequence=sequence)
+
+	def find_frame(self, frame_index):
+		"""
+		Returns the frame with the given index if it is one of the frames in the ring buffer.
+		"""
+		with self.lock:
+			if self.is_closed:
+				return None
+
+			for slot in range(self.slot_count):
+				data = self._read_slot(slot, frame_index=frame_index)
+
+				if not data is None:
+					return data
+
+		return None
+
+	def close(self):
+		with self.lock:
+			if self.is_closed:
+				return
+
+			self.is_closed = True
+
+			self.memory.close()
+
+			try:
+				self.memory.unlink()
+			except FileNotFoundError:
+				pass
+
+# The ring buffers of the running simulations, so that views can serve frames from them
+global__frame_rings = {}
+global__frame_ring_lock = threading.Lock()
+
+def register_frame_ring(uuid, ring):
+	global global__frame_rings
+	global global__frame_ring_lock
+
+	with global__frame_ring_lock:
+		global__frame_rings[str(uuid)] = ring
+
+def unregister_frame_ring(uuid):
+	global global__frame_rings
+	global global__frame_ring_lock
+
+	with global__frame_ring_lock:
+		return global__frame_rings.pop(str(uuid), None)
+
+def get_frame_ring(uuid):
+	global global__frame_rings
+	global global__frame_ring_lock
+
+	with global__frame_ring_lock:
+		return global__frame_rings.get(str(uuid), None)
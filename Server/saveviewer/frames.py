@@ -0,0 +1,58 @@
+from . import archiver as sv_archiver
+from .container import read_frame
+from .codecs import get_codec
+from .vizdelta import is_delta_frame, get_reconstructor
+from .framering import get_frame_ring
+
+import zlib
+
+def get_frame_codec(sim_id):
+	return get_codec(sv_archiver.get_save_archiver().get_sim_index_data(sim_id).get("codec", None))
+
+def read_viz_frame(sim_id, index, codec, stored_frame=None):
+	"""
+	Returns the decoded viz frame. Delta frames are turned back into full frames. If the frame
+	was already read from the archive, it can be passed in 'stored_frame'.
+	"""
+	archiver = sv_archiver.get_save_archiver()
+
+	def read_stored_frame(frame_index):
+		return codec.decompress(read_frame(archiver.get_sim_bin_frame(sim_id, frame_index)))
+
+	data = read_stored_frame(index) if stored_frame is None else codec.decompress(stored_frame)
+
+	if not is_delta_frame(data):
+		return data
+
+	return get_reconstructor(sim_id, read_stored_frame).reconstruct(int(index), data)
+
+def read_ring_frame(sim_id, index):
+	# The newest frames of a running simulation are kept in shared memory (see 'framering')
+	ring = get_frame_ring(sim_id)
+	return ring.find_frame(int(index)) if not ring is None else None
+
+def read_deflated_viz_frame(sim_id, index, codec=None, stored_frame=None):
+	"""
+	Returns a viz frame as a zlib stream, which is what browsers can decode by themselves. Frames
+	that were stored that way are returned as they are, everything else is decoded and compressed.
+	"""
+	if stored_frame is None:
+		data = read_ring_frame(sim_id, index)
+
+		if not data is None:
+			return data
+
+		stored_frame = read_frame(sv_archiver.get_save_archiver().get_sim_bin_frame(sim_id, index))
+
+	if codec is None:
+		codec = get_frame_codec(sim_id)
+
+	if can_send_stored_frame(stored_frame, codec):
+		return stored_frame
+
+	return zlib.compress(read_viz_frame(sim_id, index, codec, stored_frame), 1)
+
+def can_send_stored_frame(frame, codec):
+	# The only codec that browsers support is zlib ("deflate"), so the frame can be peeked with
+	# zlib. Delta frames have to be reconstructed before they can be sent.
+	return codec.content_encoding == "deflate" and not is_delta_frame(zlib.decompressobj().decompress(frame, 4))
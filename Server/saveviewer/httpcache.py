@@ -0,0 +1,68 @@
+import datetime
+import functools
+import inspect
+
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+from .executor import run_blocking
+
+# Frames never change once they have been written, so browsers (and any proxy in front of the
+# server) are allowed to keep them for as long as they want
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+class ResourceValidators:
+	def __init__(self, etag=None, last_modified=None):
+		self.etag = etag
+		self.last_modified = last_modified
+
+def timestamp_to_datetime(timestamp):
+	return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+
+def immutable_resource(get_validators):
+	"""
+	Decorator for views that return data which never changes once it exists. 'get_validators' takes
+	the request and returns its 'ResourceValidators' (with a 'None' ETag if the resource doesn't
+	exist, in which case the view is left to report the error). Conditional requests are answered
+	with a 304 and successful responses are marked as immutable.
+	"""
+	def decorator(view):
+		# 'condition' calls the ETag and last modified functions separately, so the validators
+		# are stored on the request to avoid looking up the resource twice
+		def get_etag(request, *args, **kwargs):
+			return request.resource_validators.etag
+
+		def get_last_modified(request, *args, **kwargs):
+			validators = request.resource_validators
+			return validators.last_modified if not validators.etag is None else None
+
+		conditional_view = condition(etag_func=get_etag, last_modified_func=get_last_modified)(view)
+
+		def add_cache_headers(request, response):
+			if response.status_code in [ 200, 304 ] and not request.resource_validators.etag is None:
+				patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+
+				# The same frame can be sent compressed or uncompressed, depending on the client
+				patch_vary_headers(response, [ "Accept-Encoding" ])
+
+			return response
+
+		if inspect.iscoroutinefunction(view):
+			# Looking up the validators hits the archive, so async views do it on the frame executor
+			@functools.wraps(view)
+			async def async_wrapper(request, *args, **kwargs):
+				request.resource_validators = await run_blocking(get_validators, request)
+
+				return add_cache_headers(request, await conditional_view(request, *args, **kwargs))
+
+			return async_wrapper
+
+		@functools.wraps(view)
+		def wrapper(request, *args, **kwargs):
+			request.resource_validators = get_validators(request)
+
+			return add_cache_headers(request, conditional_view(request, *args, **kwargs))
+
+		return wrapper
+
+	return decorator
@@ -0,0 +1,290 @@
+import numpy as np
+
+# A uniform grid over the cells of a viz frame, which makes it possible to find the cells inside a
+# region without testing every cell in the frame. The grid is stored like a sparse matrix: the rows
+# of the frame are sorted by the bucket they are in, and 'bucket_starts' has the position (in the
+# sorted rows) where each bucket begins.
+#
+# Cells are put in the bucket that contains their center, so queries have to be padded by the size
+# of the largest cell to catch cells that stick out of their bucket.
+TARGET_CELLS_PER_BUCKET = 16
+MAX_BUCKETS_PER_AXIS = 1024
+
+# How many buckets of the grid are walked at a time when picking with a ray
+PICK_STEP_BUCKETS = 4
+
+class SpatialGrid:
+	def __init__(self, cells):
+		self.cell_count = len(cells)
+
+		positions = cells["pos"].astype(np.float64)
+
+		# Every point of a capsule is within its radius of the segment between its two ends
+		self.axes = get_capsule_axes(cells)
+		self.radii = np.abs(cells["radius"].astype(np.float64))
+		self.extents = np.linalg.norm(self.axes, axis=1) + self.radii
+		self.max_extent = float(self.extents.max()) if self.cell_count > 0 else 0.0
+
+		if self.cell_count > 0:
+			self.origin = positions.min(axis=0)
+			size = positions.max(axis=0) - self.origin
+		else:
+			self.origin = np.zeros(3)
+			size = np.zeros(3)
+
+		self.bucket_size, self.dimensions = _choose_bucket_size(size, self.cell_count)
+
+		coords = self._get_bucket_coords(positions)
+		keys = self._get_bucket_keys(coords)
+
+		self.order = np.argsort(keys, kind="stable")
+		self.bucket_starts = np.searchsorted(keys[self.order], np.arange(np.prod(self.dimensions) + 1))
+
+		self.positions = positions
+
+	def get_byte_size(self):
+		return self.order.nbytes + self.bucket_starts.nbytes + self.positions.nbytes + self.axes.nbytes + self.radii.nbytes + self.extents.nbytes
+
+	def _get_bucket_coords(self, positions):
+		coords = np.floor((positions - self.origin) / self.bucket_size).astype(np.int64)
+		return np.clip(coords, 0, self.dimensions - 1)
+
+	def _get_bucket_keys(self, coords):
+		return (coords[..., 0] * self.dimensions[1] + coords[..., 1]) * self.dimensions[2] + coords[..., 2]
+
+	def query_box(self, box_min, box_max):
+		"""
+		Returns the rows of every cell that overlaps the box (in the order in which they are stored
+		in the grid, which keeps cells that are close to each other together).
+		"""
+		if self.cell_count == 0:
+			return np.empty(0, dtype=np.int64)
+
+		box_min = np.asarray(box_min, dtype=np.float64)
+		box_max = np.asarray(box_max, dtype=np.float64)
+
+		grid_max = self.origin + self.bucket_size * self.dimensions
+
+		if np.any(box_max + self.max_extent < self.origin) or np.any(box_min - self.max_extent > grid_max):
+			return np.empty(0, dtype=np.int64)
+
+		# The padded box is clamped to the grid before it is turned into bucket coordinates, since
+		# casting infinite (or very large) values to integers wraps them around
+		low = self._get_bucket_coords(np.clip(box_min - self.max_extent, self.origin, grid_max))
+		high = self._get_bucket_coords(np.clip(box_max + self.max_extent, self.origin, grid_max))
+
+		# Every bucket in the (padded) box is visited, and its rows are gathered in one go
+		ranges = np.meshgrid(*[ np.arange(low[axis], high[axis] + 1) for axis in range(3) ], indexing="ij")
+		keys = self._get_bucket_keys(np.stack(ranges, axis=-1)).ravel()
+
+		starts = self.bucket_starts[keys]
+		counts = self.bucket_starts[keys + 1] - starts
+
+		total = int(counts.sum())
+
+		if total == 0:
+			return np.empty(0, dtype=np.int64)
+
+		offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+		candidates = self.order[offsets + np.arange(total)]
+
+		# The buckets are only an approximation, so the candidates still need an exact test
+		extents = self.extents[candidates, np.newaxis]
+		positions = self.positions[candidates]
+
+		inside = np.all((positions + extents >= box_min) & (positions - extents <= box_max), axis=1)
+
+		return candidates[inside]
+
+	def pick_ray(self, origin, direction):
+		"""
+		Returns the row of the first cell hit by the ray and the distance to it along the ray, or
+		'(-1, None)' if the ray doesn't hit anything.
+
+		The ray is walked through the grid a few buckets at a time. The cells near each part of the
+		ray are tested together, and once a hit is found within the part that was walked, no cell
+		further along the ray can be closer.
+		"""
+		origin = np.asarray(origin, dtype=np.float64)
+		direction = np.asarray(direction, dtype=np.float64)
+
+		length = np.linalg.norm(direction)
+
+		if self.cell_count == 0 or length == 0.0:
+			return -1, None
+
+		direction = direction / length
+
+		# Clip the ray to the bounds of the grid, which includes every part of every cell
+		t_near, t_far = _intersect_box(origin, direction, self.origin - self.max_extent,
+			self.origin + self.bucket_size * self.dimensions + self.max_extent)
+
+		if t_near is None:
+			return -1, None
+
+		step = PICK_STEP_BUCKETS * float(np.min(self.bucket_size))
+		t_start = max(t_near, 0.0)
+
+		while t_start <= t_far:
+			t_end = min(t_start + step, t_far)
+
+			start_point = origin + t_start * direction
+			end_point = origin + t_end * direction
+
+			candidates = self.query_box(np.minimum(start_point, end_point), np.maximum(start_point, end_point))
+
+			if len(candidates) > 0:
+				distances = self._intersect_candidates(origin, direction, candidates)
+				closest = int(np.argmin(distances))
+
+				if distances[closest] <= t_end:
+					return int(candidates[closest]), float(distances[closest])
+
+			t_start = t_end + 1e-9
+
+			if t_end >= t_far:
+				break
+
+		return -1, None
+
+	def pick_point(self, x, z):
+		"""
+		Picks the top-most cell at a point on the ground plane (the viewer uses Y as the up axis).
+		"""
+		top = float(self.origin[1] + self.bucket_size[1] * self.dimensions[1] + self.max_extent) + 1.0
+
+		return self.pick_ray([ x, top, z ], [ 0.0, -1.0, 0.0 ])
+
+	def _intersect_candidates(self, origin, direction, candidates):
+		positions = self.positions[candidates]
+		axes = self.axes[candidates]
+
+		return intersect_capsules(origin, direction, positions + axes, positions - axes, self.radii[candidates])
+
+def get_capsule_axes(cells):
+	"""
+	Returns the vector from the center of each cell to one of its ends (the other end is in the
+	opposite direction). This has to match how 'cell_shader.vert' places the cells.
+	"""
+	direction = cells["dir"].astype(np.float64)
+	radius = cells["radius"].astype(np.float64)
+	length = cells["length"].astype(np.float64)
+
+	yaw = np.arctan2(direction[:, 0], direction[:, 2])
+	pitch = np.arccos(np.clip(direction[:, 1], -1.0, 1.0))
+
+	axes = np.stack([
+		radius * np.sin(yaw) * np.sin(pitch),
+		0.5 * np.cos(pitch),
+		radius * np.cos(yaw) * np.sin(pitch),
+	], axis=1)
+
+	return axes * length[:, np.newaxis]
+
+def intersect_capsules(origin, direction, end0, end1, radius):
+	"""
+	Intersects a ray with many capsules at once. Returns the distance along the ray to each capsule
+	(or infinity where the ray misses). Based on: https://iquilezles.org/articles/intersectors/
+	"""
+	ba = end1 - end0
+	oa = origin - end0
+
+	baba = np.einsum("ij,ij->i", ba, ba)
+	bard = ba @ direction
+	baoa = np.einsum("ij,ij->i", ba, oa)
+	rdoa = oa @ direction
+	oaoa = np.einsum("ij,ij->i", oa, oa)
+
+	a = baba - bard * bard
+	b = baba * rdoa - baoa * bard
+	c = baba * oaoa - baoa * baoa - radius * radius * baba
+	h = b * b - a * c
+
+	distances = np.full(len(radius), np.inf)
+
+	with np.errstate(divide="ignore", invalid="ignore"):
+		# Body
+		t = (-b - np.sqrt(h)) / a
+		y = baoa + t * bard
+
+		body_hit = (h >= 0.0) & (a > 0.0) & (y > 0.0) & (y < baba)
+		distances[body_hit] = t[body_hit]
+
+		# Caps (the ray can only hit the cap on the side where it hit the infinite cylinder, or the
+		# cap that it reaches first if it runs parallel to the capsule)
+		near_cap = np.where(a > 0.0, y <= 0.0, bard > 0.0)
+		oc = np.where(near_cap[:, np.newaxis], oa, origin - end1)
+
+		cap_b = oc @ direction
+		cap_c = np.einsum("ij,ij->i", oc, oc) - radius * radius
+		cap_h = cap_b * cap_b - cap_c
+
+		cap_hit = ~body_hit & (cap_h > 0.0) & ((h >= 0.0) | (a <= 0.0))
+		distances[cap_hit] = (-cap_b - np.sqrt(cap_h))[cap_hit]
+
+	# Capsules behind the ray (or that the ray starts inside of) don't count
+	distances[distances < 0.0] = np.inf
+
+	return distances
+
+def _intersect_box(origin, direction, box_min, box_max):
+	with np.errstate(divide="ignore", invalid="ignore"):
+		t0 = (box_min - origin) / direction
+		t1 = (box_max - origin) / direction
+
+	# Axes that the ray is parallel to either contain the ray or don't
+	parallel = direction == 0.0
+	outside = parallel & ((origin < box_min) | (origin > box_max))
+
+	if np.any(outside):
+		return None, None
+
+	t_near = np.max(np.where(parallel, -np.inf, np.minimum(t0, t1)))
+	t_far = np.min(np.where(parallel, np.inf, np.maximum(t0, t1)))
+
+	if t_near > t_far or t_far < 0.0:
+		return None, None
+
+	return float(t_near), float(t_far)
+
+def _choose_bucket_size(size, cell_count):
+	# Colonies are often flat, so axes without any extent get a single bucket
+	buckets = max(cell_count / TARGET_CELLS_PER_BUCKET, 1.0)
+
+	used_axes = size > 1e-6
+	axis_count = int(np.count_nonzero(used_axes))
+
+	if axis_count == 0:
+		return np.ones(3), np.ones(3, dtype=np.int64)
+
+	volume = float(np.prod(size[used_axes]))
+	bucket_size = (volume / buckets) ** (1.0 / axis_count)
+
+	dimensions = np.where(used_axes, np.ceil(size / bucket_size), 1).astype(np.int64)
+
+	# Axes that are much thinner than the others round up to a whole bucket, which can multiply
+	# the number of buckets, so the buckets are grown until there aren't too many of them
+	while np.prod(dimensions) > 4 * buckets + 8:
+		bucket_size *= 1.25
+		dimensions = np.where(used_axes, np.ceil(size / bucket_size), 1).astype(np.int64)
+
+	# Very elongated colonies could otherwise end up with an absurd number of buckets on one axis
+	dimensions = np.clip(dimensions, 1, MAX_BUCKETS_PER_AXIS)
+	bucket_sizes = np.where(used_axes, np.maximum(size / dimensions, bucket_size), 1.0)
+
+	return bucket_sizes, dimensions
+
+def decimate_rows(rows, budget):
+	"""
+	Picks at most 'budget' of the rows, spread evenly over them. Since the grid returns the rows in
+	bucket order, this thins out the cells evenly over space rather than dropping whole regions.
+	"""
+	if len(rows) <= budget:
+		return rows
+
+	if budget <= 0:
+		return rows[:0]
+
+	picks = np.linspace(0, len(rows) - 1, budget).astype(np.int64)
+
+	return rows[picks]
@@ -0,0 +1,108 @@
+import os
+import json
+
+import numpy as np
+
+from .archiver import read_frame_log
+
+# A small summary of every frame is written next to the frame log ('stats.jsonl'), so that the way a
+# colony evolves can be plotted without decoding every frame. Like the frame log, the file is
+# append-only and has one JSON line per frame, so it is read with the same function.
+STATS_LOG_FILE = "stats.jsonl"
+
+# Step frame attributes that get a full summary (mean, min, max and percentiles)
+SUMMARY_ATTRIBUTES = [ "radius", "length", "growth_rate", "eff_growth", "cell_age", "target_volume", "volume", "strain_rate" ]
+SUMMARY_PERCENTILES = [ 10, 50, 90 ]
+
+def summarize_frame(step_columns, viz_cells):
+	"""
+	Computes the summary of a single frame. 'step_columns' can be anything that maps step frame
+	attribute names to arrays (a 'CELL_DTYPE' array or 'PackedCellReader.get_columns()') and
+	'viz_cells' is the cell array of the frame's viz frame. Values that can't be computed for an
+	empty frame are 'None'.
+	"""
+	cell_count = len(step_columns["id"])
+	summary = { "cell_count": cell_count }
+
+	for name in SUMMARY_ATTRIBUTES:
+		values = np.asarray(step_columns[name], dtype=np.float64)
+
+		if cell_count > 0:
+			percentiles = np.percentile(values, SUMMARY_PERCENTILES)
+
+			summary[f"{name}_mean"] = float(values.mean())
+			summary[f"{name}_min"] = float(values.min())
+			summary[f"{name}_max"] = float(values.max())
+
+			for percentile, value in zip(SUMMARY_PERCENTILES, percentiles):
+				summary[f"{name}_p{percentile}"] = float(value)
+		else:
+			for suffix in [ "mean", "min", "max", *[ f"p{percentile}" for percentile in SUMMARY_PERCENTILES ] ]:
+				summary[f"{name}_{suffix}"] = None
+
+	# The bounding box is in the viewer's coordinates (Y is up)
+	if len(viz_cells) > 0:
+		positions = viz_cells["pos"]
+
+		summary["bbox_min"] = positions.min(axis=0).tolist()
+		summary["bbox_max"] = positions.max(axis=0).tolist()
+	else:
+		summary["bbox_min"] = None
+		summary["bbox_max"] = None
+
+	cell_types, type_counts = np.unique(np.asarray(step_columns["cell_type"]), return_counts=True)
+	summary["cell_types"] = { str(cell_type): int(count) for cell_type, count in zip(cell_types, type_counts) }
+
+	return summary
+
+def load_stats_series(sim_root: str):
+	"""
+	Returns the summaries of a simulation as a series: one list per summary field, with an entry
+	for every frame.
+	"""
+	entries, _ = read_frame_log(os.path.join(sim_root, STATS_LOG_FILE))
+
+	series = {}
+
+	for entry in entries:
+		for key in entry.keys():
+			if not key in series:
+				# Fields that were added later are missing from the earlier frames
+				series[key] = [ None ] * (entry["index"])
+
+		for key, values in series.items():
+			values.append(entry.get(key, None))
+
+	return series
+
+class StatsLogWriter:
+	"""
+	Appends frame summaries to the stats log of a simulation. Like 'archiver.SimIndexWriter', only
+	the simulation instance that owns the simulation directory should create one of these.
+	"""
+	def __init__(self, sim_root: str):
+		log_path = os.path.join(sim_root, STATS_LOG_FILE)
+		entries, valid_length = read_frame_log(log_path)
+
+		self.num_entries = len(entries)
+		self.log_file = open(log_path, "ab")
+
+		if self.log_file.tell() != valid_length:
+			self.log_file.truncate(valid_length)
+			self.log_file.seek(valid_length)
+
+	def add_entry(self, frame_index: int, summary: dict):
+		# A simulation that was restarted after crashing could have frames without summaries, and
+		# the summaries have to line up with the frames
+		if frame_index != self.num_entries:
+			return
+
+		entry = { "index": frame_index, **summary }
+
+		self.log_file.write((json.dumps(entry) + "\n").encode("utf-8"))
+		self.log_file.flush()
+
+		self.num_entries += 1
+
+	def close(self):
+		self.log_file.close()
@@ -0,0 +1,484 @@
+from django.test import SimpleTestCase, RequestFactory
+
+from . import archiver as sv_archiver
+from .archiver import SaveArchiver, SimIndexWriter
+from .container import FrameContainerWriter, FrameLocation, VIZ_CONTAINER_FILE, read_frame, close_container_reader
+from .codecs import get_codec
+from .format import CELL_DTYPE, VIZ_CELL_DTYPE, PackedCell, PackedCellWriter, ColumnarCellWriter, PackedCellReader, unpack_viz_frame
+from .framecache import FrameCache
+from .spatial import SpatialGrid
+from .vizdelta import VizDeltaEncoder, VizFrameReconstructor, pack_full_frame, is_delta_frame, drop_reconstructor
+from .views import _parse_vector, _accepts_encoding, frame_range, FRAME_RANGE_HEADER
+
+import os
+import json
+import zlib
+import tempfile
+
+import numpy as np
+
+def _make_colony(cell_count, seed=0):
+	rng = np.random.default_rng(seed)
+
+	cells = np.zeros(cell_count, dtype=VIZ_CELL_DTYPE)
+	cells["pos"][:, 0] = rng.uniform(-100.0, 100.0, cell_count)
+	cells["pos"][:, 2] = rng.uniform(-100.0, 100.0, cell_count)
+	cells["dir"][:, 0] = 1.0
+	cells["length"] = 2.0
+	cells["radius"] = 0.5
+
+	return cells
+
+def _make_step_cells(cell_count, seed=0):
+	rng = np.random.default_rng(seed)
+
+	cells = np.zeros(cell_count, dtype=CELL_DTYPE)
+	cells["id"] = rng.permutation(cell_count * 2)[:cell_count]
+	cells["radius"] = rng.uniform(0.4, 0.6, cell_count)
+	cells["length"] = rng.uniform(1.0, 3.0, cell_count)
+	cells["cell_age"] = rng.integers(0, 100, cell_count)
+	cells["cell_type"] = rng.integers(0, 4, cell_count)
+
+	return cells
+
+class CodecTests(SimpleTestCase):
+	def test_round_trip(self):
+		data = _make_colony(1000).tobytes()
+
+		for name in [ "zlib-1", "zlib-9", "deflate", "deflate-6", "lzma", "lzma-1", "bz2", "bz2-1", "store" ]:
+			codec = get_codec(name)
+			self.assertEqual(codec.decompress(codec.compress(data)), data, name)
+
+	def test_content_encoding(self):
+		self.assertEqual(get_codec().content_encoding, "deflate")
+		self.assertEqual(zlib.decompress(get_codec("zlib-6").compress(b"frame")), b"frame")
+
+		for name in [ "deflate", "lzma", "bz2", "store" ]:
+			self.assertIsNone(get_codec(name).content_encoding, name)
+
+	def test_invalid_names(self):
+		for name in [ "gzip", "zlib-x", "zlib-20", "bz2-0" ]:
+			with self.assertRaises(ValueError):
+				get_codec(name)
+
+class FrameContainerTests(SimpleTestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.temp_dir.name, VIZ_CONTAINER_FILE)
+
+	def tearDown(self):
+		close_container_reader(self.path)
+		self.temp_dir.cleanup()
+
+	def test_round_trip(self):
+		frames = [ os.urandom(size) for size in [ 1, 100, 10000 ] ]
+
+		writer = FrameContainerWriter(self.path)
+		locations = [ FrameLocation(self.path, *writer.append(index, frame)) for index, frame in enumerate(frames) ]
+
+		# Frames appended after the container was mapped have to be readable too
+		self.assertEqual(read_frame(locations[0]), frames[0])
+
+		locations.append(FrameLocation(self.path, *writer.append(len(frames), b"last")))
+		frames.append(b"last")
+
+		writer.close()
+
+		for location, frame in zip(locations, frames):
+			self.assertEqual(read_frame(location), frame)
+
+	def test_read_past_end(self):
+		writer = FrameContainerWriter(self.path)
+		offset, size = writer.append(0, b"frame")
+		writer.close()
+
+		with self.assertRaises(IndexError):
+			read_frame(FrameLocation(self.path, offset, size + 1))
+
+class StepFormatTests(SimpleTestCase):
+	def setUp(self):
+		self.cells = _make_step_cells(500)
+
+	def assertColumnsEqual(self, reader, cells):
+		order = np.argsort(cells["id"])
+		columns = reader.get_columns()
+		reader_order = np.argsort(columns["id"])
+
+		for name in CELL_DTYPE.names:
+			np.testing.assert_array_equal(columns[name][reader_order], cells[name][order], name)
+
+	def assertFindsEveryCell(self, reader, cells):
+		for cell in cells[:50]:
+			packed_cell = reader.find_cell_with_id(int(cell["id"]))
+
+			self.assertEqual(packed_cell.id, cell["id"])
+			self.assertAlmostEqual(packed_cell.length, float(cell["length"]), places=5)
+			self.assertEqual(packed_cell.cell_type, cell["cell_type"])
+
+		# The ids are below twice the cell count, so these are never used
+		for missing_id in [ len(cells) * 2, len(cells) * 3 ]:
+			self.assertEqual(reader.find_row_with_id(missing_id), -1)
+			self.assertIsNone(reader.find_cell_with_id(missing_id))
+
+		missing_ids = sorted(set(range(len(cells) * 2)) - set(cells["id"].tolist()))
+		self.assertEqual(reader.find_row_with_id(missing_ids[0]), -1)
+
+	def test_columnar_round_trip(self):
+		for codec in [ get_codec(), get_codec("lzma"), get_codec("store") ]:
+			reader = PackedCellReader(ColumnarCellWriter(self.cells).compress(codec), codec)
+
+			self.assertEqual(reader.version, 2)
+			self.assertTrue(reader.sorted_by_id)
+			self.assertEqual(reader.cell_count, len(self.cells))
+
+			self.assertColumnsEqual(reader, self.cells)
+			self.assertFindsEveryCell(reader, self.cells)
+			self.assertIsNone(reader.id_index)
+
+	def test_row_round_trip(self):
+		writer = PackedCellWriter()
+		writer.write_header(len(self.cells))
+
+		for row in range(len(self.cells)):
+			writer.write_cell(PackedCell.from_columns(self.cells, row))
+
+		reader = PackedCellReader(writer.compress())
+
+		self.assertEqual(reader.version, 1)
+		self.assertFalse(reader.sorted_by_id)
+
+		self.assertColumnsEqual(reader, self.cells)
+		self.assertFindsEveryCell(reader, self.cells)
+
+	def test_empty_frame(self):
+		reader = PackedCellReader(ColumnarCellWriter(np.zeros(0, dtype=CELL_DTYPE)).compress())
+
+		self.assertEqual(reader.cell_count, 0)
+		self.assertEqual(reader.find_row_with_id(0), -1)
+
+class VizDeltaTests(SimpleTestCase):
+	def make_frames(self, count):
+		rng = np.random.default_rng(0)
+
+		cells = _make_colony(200)
+		ids = np.arange(len(cells), dtype="<u8")
+		next_id = len(cells)
+
+		frames = []
+
+		for _ in range(count):
+			# Cells move and grow a bit, a few of them divide (removed and replaced by two new ones)
+			cells["pos"] += rng.normal(0.0, 0.1, cells["pos"].shape).astype(np.float32)
+			cells["length"] += 0.01
+
+			divided = rng.choice(len(cells), 5, replace=False)
+			kept = np.ones(len(cells), dtype=bool)
+			kept[divided] = False
+
+			children = np.repeat(cells[divided], 2)
+			children["length"] = 1.0
+
+			cells = np.concatenate([ cells[kept], children ])
+			ids = np.concatenate([ ids[kept], np.arange(next_id, next_id + len(children), dtype="<u8") ])
+			next_id += len(children)
+
+			frames.append(pack_full_frame(cells, ids))
+
+		return frames
+
+	def assertFrameMatches(self, data, expected):
+		cells, ids = unpack_viz_frame(data)
+		expected_cells, expected_ids = unpack_viz_frame(expected)
+
+		# Reconstructed frames don't keep the order of the cells, so they are compared by id
+		order = np.argsort(ids)
+		expected_order = np.argsort(expected_ids)
+
+		np.testing.assert_array_equal(ids[order], expected_ids[expected_order])
+
+		cells = cells[order]
+		expected_cells = expected_cells[expected_order]
+
+		np.testing.assert_allclose(cells["pos"], expected_cells["pos"], atol=1e-3)
+		np.testing.assert_allclose(cells["dir"], expected_cells["dir"], atol=1e-4)
+		np.testing.assert_allclose(cells["length"], expected_cells["length"], atol=1e-4)
+		np.testing.assert_array_equal(cells["color"], expected_cells["color"])
+
+	def test_round_trip(self):
+		frames = self.make_frames(12)
+
+		encoder = VizDeltaEncoder(5)
+		stored = [ encoder.encode(frame) for frame in frames ]
+
+		self.assertEqual([ index for index, data in enumerate(stored) if not is_delta_frame(data) ], [ 0, 5, 10 ])
+
+		# Reading forwards applies one delta at a time, jumping around starts from the keyframe
+		for order in [ range(len(frames)), [ 7, 3, 11, 4, 9, 0, 8 ] ]:
+			reconstructor = VizFrameReconstructor(lambda index: stored[index])
+
+			for index in order:
+				self.assertFrameMatches(reconstructor.reconstruct(index), frames[index])
+
+	def test_errors_do_not_accumulate(self):
+		frames = self.make_frames(50)
+
+		encoder = VizDeltaEncoder(len(frames))
+		stored = [ encoder.encode(frame) for frame in frames ]
+
+		reconstructor = VizFrameReconstructor(lambda index: stored[index])
+		self.assertFrameMatches(reconstructor.reconstruct(len(frames) - 1), frames[-1])
+
+class FrameCacheTests(SimpleTestCase):
+	def test_evicts_least_recently_used(self):
+		cache = FrameCache(100)
+
+		for index in range(4):
+			cache.put(("sim", "step", index), index, 30)
+
+		self.assertIsNone(cache.get(("sim", "step", 0)))
+		self.assertEqual(cache.get(("sim", "step", 1)), 1)
+
+		# Frame 1 was just used, so frame 2 is the one that goes
+		cache.put(("sim", "step", 4), 4, 30)
+
+		self.assertIsNone(cache.peek(("sim", "step", 2)))
+		self.assertEqual(cache.peek(("sim", "step", 1)), 1)
+
+		stats = cache.get_stats()
+		self.assertEqual((stats["entries"], stats["bytes"], stats["evictions"]), (3, 90, 2))
+
+	def test_skips_values_larger_than_cache(self):
+		cache = FrameCache(100)
+		cache.put(("sim", "step", 0), 0, 50)
+		cache.put(("sim", "step", 1), 1, 101)
+
+		self.assertEqual(cache.get_stats()["entries"], 1)
+		self.assertEqual(cache.peek(("sim", "step", 0)), 0)
+
+	def test_invalidate_simulation(self):
+		cache = FrameCache(100)
+		cache.put(("first", "step", 0), 0, 10)
+		cache.put(("second", "step", 0), 0, 20)
+
+		cache.invalidate_simulation("first")
+
+		self.assertIsNone(cache.peek(("first", "step", 0)))
+		self.assertEqual(cache.get_stats()["bytes"], 20)
+
+class SpatialGridTests(SimpleTestCase):
+	def setUp(self):
+		self.cells = _make_colony(5000)
+		self.grid = SpatialGrid(self.cells)
+
+	def assertRowsEqual(self, rows, expected):
+		self.assertEqual(sorted(rows.tolist()), sorted(expected.tolist()))
+
+	def test_box_matches_brute_force(self):
+		box_min = np.array([ -20.0, -1.0, -30.0 ])
+		box_max = np.array([ 40.0, 1.0, 10.0 ])
+
+		positions = self.grid.positions
+		extents = self.grid.extents[:, np.newaxis]
+		expected = np.nonzero(np.all((positions + extents >= box_min) & (positions - extents <= box_max), axis=1))[0]
+
+		self.assertRowsEqual(self.grid.query_box(box_min, box_max), expected)
+
+	def test_one_sided_box(self):
+		everything = np.arange(len(self.cells))
+		inf = float("inf")
+
+		self.assertRowsEqual(self.grid.query_box([ -inf ] * 3, [ 0.0, inf, inf ]),
+			np.nonzero(self.grid.positions[:, 0] - self.grid.extents <= 0.0)[0])
+		self.assertRowsEqual(self.grid.query_box([ -1000.0 ] * 3, [ inf ] * 3), everything)
+		self.assertRowsEqual(self.grid.query_box([ -inf ] * 3, [ 1000.0 ] * 3), everything)
+
+	def test_very_large_box(self):
+		everything = np.arange(len(self.cells))
+
+		self.assertRowsEqual(self.grid.query_box([ -1e30 ] * 3, [ 1e30 ] * 3), everything)
+		self.assertRowsEqual(self.grid.query_box([ -1e6 ] * 3, [ 1e6 ] * 3), everything)
+
+	def test_box_outside_grid(self):
+		self.assertEqual(len(self.grid.query_box([ 1e30 ] * 3, [ float("inf") ] * 3)), 0)
+
+class ParseVectorTests(SimpleTestCase):
+	def test_rejects_non_finite_values(self):
+		for text in [ "inf,0,0", "0,-inf,0", "0,0,nan", "1e400,0,0" ]:
+			with self.assertRaises(ValueError):
+				_parse_vector(text)
+
+	def test_component_count(self):
+		self.assertEqual(_parse_vector("1,2", 2), [ 1.0, 2.0 ])
+
+		with self.assertRaises(ValueError):
+			_parse_vector("1,2")
+
+class AcceptEncodingTests(SimpleTestCase):
+	def accepts_deflate(self, header):
+		return _accepts_encoding(RequestFactory().get("/", HTTP_ACCEPT_ENCODING=header), "deflate")
+
+	def test_accepted(self):
+		for header in [ "deflate", "gzip, deflate, br", "gzip;q=1.0, deflate;q=0.5", "*", "gzip, *;q=0.1" ]:
+			self.assertTrue(self.accepts_deflate(header), header)
+
+	def test_not_accepted(self):
+		for header in [ "", "gzip", "x-deflate", "deflate;q=0", "gzip, deflate;q=0.0", "*, deflate;q=0", "*;q=0" ]:
+			self.assertFalse(self.accepts_deflate(header), header)
+
+class SaveArchiverTests(SimpleTestCase):
+	def setUp(self):
+		self.working_dir = os.getcwd()
+		self.temp_dir = tempfile.TemporaryDirectory()
+
+		os.chdir(self.temp_dir.name)
+
+	def tearDown(self):
+		os.chdir(self.working_dir)
+		self.temp_dir.cleanup()
+
+	def test_catalogue_catches_up_with_frame_log(self):
+		archiver = SaveArchiver()
+		paths = archiver.register_simulation("sim", "./sim", "Test", False)
+
+		# Only the first frame reaches the server before it goes away
+		index_writer = SimIndexWriter(paths.root_path)
+		archiver.update_step_data("sim", [ index_writer.add_entry("step-0.cm5_step", "viz-0.cm5_viz") ])
+
+		for index in range(1, 3):
+			index_writer.add_entry(f"step-{index}.cm5_step", f"viz-{index}.cm5_viz")
+
+		index_writer.close()
+		archiver.connection.close()
+
+		archiver = SaveArchiver()
+
+		self.assertEqual(archiver.get_sim_index_data("sim")["num_frames"], 3)
+		self.assertTrue(archiver.get_sim_bin_frame("sim", 2).path.endswith("viz-2.cm5_viz"))
+
+		archiver.connection.close()
+
+	def test_continue_legacy_simulation(self):
+		os.mkdir("sim")
+
+		with open(os.path.join("sim", sv_archiver.SIM_HEADER_FILE), "w") as index_file:
+			index_file.write(json.dumps({ "name": "Legacy",
+				"stepframes": { str(index): f"step-{index}.cm5_step" for index in range(2) },
+				"vizframes": { str(index): f"viz-{index}.cm5_viz" for index in range(2) } }))
+
+		index_writer = SimIndexWriter("sim")
+		entry = index_writer.add_entry("step-2.cm5_step", "viz-2.cm5_viz")
+		index_writer.close()
+
+		self.assertEqual(entry["index"], 2)
+
+		entries, _ = sv_archiver.read_frame_log(os.path.join("sim", sv_archiver.FRAME_LOG_FILE))
+		self.assertEqual([ entry["vizframe"] for entry in entries ], [ "viz-0.cm5_viz", "viz-1.cm5_viz", "viz-2.cm5_viz" ])
+
+		sim_data = sv_archiver.load_sim_index("sim")
+		self.assertEqual(sim_data["num_frames"], 3)
+		self.assertEqual(sim_data["stepframes"][2], "step-2.cm5_step")
+
+		# Opening the log again doesn't copy the frames a second time
+		index_writer = SimIndexWriter("sim")
+		self.assertEqual(index_writer.num_frames, 3)
+		index_writer.close()
+
+class FrameRangeTests(SimpleTestCase):
+	def setUp(self):
+		self.working_dir = os.getcwd()
+		self.temp_dir = tempfile.TemporaryDirectory()
+
+		os.chdir(self.temp_dir.name)
+
+		# The views use the global archiver, which has to be created inside the temporary directory
+		sv_archiver.global__save_archiver = None
+		archiver = sv_archiver.get_save_archiver()
+		paths = archiver.register_simulation("sim", "./sim", "Test", False)
+
+		self.container_path = os.path.join(paths.cache_path, VIZ_CONTAINER_FILE)
+		codec = get_codec()
+
+		# Every other frame is a delta frame, so both stored and reconstructed frames get streamed
+		encoder = VizDeltaEncoder(2)
+		container = FrameContainerWriter(self.container_path)
+		index_writer = SimIndexWriter(paths.root_path)
+
+		cells = _make_colony(100)
+		ids = np.arange(len(cells), dtype="<u8")
+
+		self.frames = []
+
+		for index in range(4):
+			cells["pos"][:, 0] += 0.25
+			frame = pack_full_frame(cells, ids)
+
+			offset, size = container.append(index, codec.compress(encoder.encode(frame)))
+			viz_entry = { "file": os.path.join(paths.relative_cache_path, VIZ_CONTAINER_FILE), "offset": offset, "size": size }
+
+			archiver.update_step_data("sim", [ index_writer.add_entry(f"step-{index}.cm5_step", viz_entry) ])
+			self.frames.append(frame)
+
+		container.close()
+		index_writer.close()
+
+	def tearDown(self):
+		close_container_reader(self.container_path)
+		drop_reconstructor("sim")
+
+		sv_archiver.global__save_archiver.connection.close()
+		sv_archiver.global__save_archiver = None
+
+		os.chdir(self.working_dir)
+		self.temp_dir.cleanup()
+
+	def get_frames(self, **params):
+		response = frame_range(RequestFactory().get("/", { "uuid": "sim", **params }))
+		self.assertEqual(response.status_code, 200)
+
+		content = b"".join(response.streaming_content)
+		frames = []
+		offset = 0
+
+		while offset < len(content):
+			index, size = FRAME_RANGE_HEADER.unpack_from(content, offset)
+			offset += FRAME_RANGE_HEADER.size
+
+			frames.append((index, content[offset:offset + size]))
+			offset += size
+
+		self.assertEqual(int(response["X-Frame-Count"]), len(frames))
+
+		return response["X-Frame-Encoding"], frames
+
+	def assertFrameMatches(self, data, expected):
+		self.assertFalse(is_delta_frame(data))
+
+		cells, ids = unpack_viz_frame(data)
+		expected_cells, expected_ids = unpack_viz_frame(expected)
+
+		# Delta frames are quantized, so reconstructed frames are only approximately the same
+		np.testing.assert_array_equal(ids, expected_ids)
+		np.testing.assert_allclose(cells["pos"], expected_cells["pos"], atol=1e-3)
+		np.testing.assert_array_equal(cells["color"], expected_cells["color"])
+
+	def test_deflate(self):
+		encoding, frames = self.get_frames(start=0, end=4)
+
+		self.assertEqual(encoding, "deflate")
+		self.assertEqual([ index for index, _ in frames ], [ 0, 1, 2, 3 ])
+
+		for index, data in frames:
+			self.assertFrameMatches(zlib.decompress(data), self.frames[index])
+
+	def test_identity(self):
+		encoding, frames = self.get_frames(start=1, end=10, stride=2, encoding="identity")
+
+		self.assertEqual(encoding, "identity")
+		self.assertEqual([ index for index, _ in frames ], [ 1, 3 ])
+
+		for index, data in frames:
+			self.assertFrameMatches(data, self.frames[index])
+
+	def test_rejects_unknown_encoding(self):
+		response = frame_range(RequestFactory().get("/", { "uuid": "sim", "start": 0, "end": 4, "encoding": "gzip" }))
+		self.assertEqual(response.status_code, 400)
@@ -4,5 +4,11 @@ from . import views
 
 urlpatterns = [
     path("framedata", views.frame_data),
+    path("framerange", views.frame_range),
+    path("frameculled", views.culled_frame_data),
     path("cellinfoindex", views.cell_info_from_index),
+    path("cellhistory", views.cell_history),
+    path("pick", views.pick_cell),
+    path("simstats", views.sim_stats),
+    path("cachestats", views.frame_cache_stats),
 ]
\ No newline at end of file
@@ -1,11 +1,138 @@
-from django.http import HttpResponse, FileResponse, HttpResponseBadRequest, HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, StreamingHttpResponse
 
 from . import archiver as sv_archiver
-from .format import PackedCellReader
+from .container import read_frame
+from .format import PackedCellReader, CELL_DTYPE, unpack_viz_frame
+from .frames import get_frame_codec, read_viz_frame, read_ring_frame, read_deflated_viz_frame, can_send_stored_frame
+from .vizdelta import pack_full_frame
+from .httpcache import ResourceValidators, immutable_resource, timestamp_to_datetime
+from .framecache import get_frame_cache
+from .spatial import SpatialGrid, decimate_rows
+from .stats import load_stats_series
+from .executor import run_blocking, stream_bytes, STREAM_THRESHOLD
 
+import os
 import json
+import math
+import zlib
+import struct
 
-def frame_data(request):
+import numpy as np
+
+def _get_step_frame_reader(sim_id, index):
+	"""
+	Returns a 'PackedCellReader' for a step frame. Decompressed frames are shared between requests
+	through the frame cache.
+	"""
+	def load_frame():
+		location = sv_archiver.get_save_archiver().get_sim_step_frame(sim_id, index)
+		return PackedCellReader(read_frame(location), codec=get_frame_codec(sim_id))
+
+	return get_frame_cache().get_or_load((sim_id, "step", int(index)), load_frame, PackedCellReader.get_byte_size)
+
+def _get_viz_frame_grid(sim_id, index, codec):
+	"""
+	Returns the cells and ids of a viz frame, along with a spatial grid over its cells. The grid
+	is built the first time it is needed and kept in the frame cache.
+	"""
+	def load_grid():
+		cells, ids = unpack_viz_frame(read_viz_frame(sim_id, index, codec))
+		return cells, ids, SpatialGrid(cells)
+
+	def get_size(entry):
+		cells, ids, grid = entry
+		return cells.nbytes + ids.nbytes + grid.get_byte_size()
+
+	return get_frame_cache().get_or_load((sim_id, "grid", int(index)), load_grid, get_size)
+
+def _parse_vector(text, component_count=3):
+	values = [ float(value) for value in text.split(",") ]
+
+	if len(values) != component_count:
+		raise ValueError(f"Expected {component_count} components, got {len(values)}")
+
+	if not all(math.isfinite(value) for value in values):
+		raise ValueError("Expected finite components")
+
+	return values
+
+def _accepts_encoding(request, encoding):
+	"""
+	Checks if 'Accept-Encoding' allows the given content encoding, either by name or through
+	'*'. Encodings with a q-value of 0 are not accepted.
+	"""
+	qualities = {}
+
+	for item in request.headers.get("Accept-Encoding", "").split(","):
+		name, *params = [ part.strip() for part in item.split(";") ]
+
+		quality = 1.0
+
+		for param in params:
+			key, _, value = param.partition("=")
+
+			if key.strip().lower() == "q":
+				try:
+					quality = float(value)
+				except ValueError:
+					quality = 0.0
+
+		if len(name) > 0:
+			qualities[name.lower()] = quality
+
+	return qualities.get(encoding, qualities.get("*", 0.0)) > 0.0
+
+def _get_frame_validators(sim_id, frame_location, *tags):
+	# The location of a frame is unique to it, so it can be used instead of hashing the frame
+	archiver = sv_archiver.get_save_archiver()
+	created = archiver.get_sim_index_data(sim_id)["created"]
+
+	etag = "-".join([ sim_id, str(frame_location.offset), *[ str(tag) for tag in tags ] ])
+
+	return ResourceValidators(etag, timestamp_to_datetime(created))
+
+def _frame_data_validators(request):
+	try:
+		sim_id = request.GET["uuid"]
+		index = int(request.GET["index"])
+
+		location = sv_archiver.get_save_archiver().get_sim_bin_frame(sim_id, index)
+	except (KeyError, ValueError, IndexError):
+		return ResourceValidators()
+
+	encoding = "deflate" if _accepts_encoding(request, "deflate") else "identity"
+
+	return _get_frame_validators(sim_id, location, "viz", index, encoding)
+
+def _load_frame_data(request, sim_id, index):
+	"""
+	Reads a viz frame the way that 'frame_data' sends it. Returns the body of the response and its
+	content encoding (or 'None'). This blocks on file I/O and decompression.
+	"""
+	if _accepts_encoding(request, "deflate"):
+		data = read_ring_frame(sim_id, index)
+
+		if not data is None:
+			return data, "deflate"
+
+	codec = get_frame_codec(sim_id)
+
+	# If the browser can decode the frame by itself, we can send it exactly as it was stored
+	if not codec.content_encoding is None and _accepts_encoding(request, codec.content_encoding):
+		frame = read_frame(sv_archiver.get_save_archiver().get_sim_bin_frame(sim_id, index))
+
+		if can_send_stored_frame(frame, codec):
+			return frame, codec.content_encoding
+
+	data = read_viz_frame(sim_id, index, codec)
+
+	if _accepts_encoding(request, "deflate"):
+		return zlib.compress(data, 1), "deflate"
+
+	return data, None
+
+@immutable_resource(_frame_data_validators)
+async def frame_data(request):
 	if not "index" in request.GET:
 		return HttpResponseBadRequest("No frame index provided")
 
@@ -16,14 +143,166 @@ def frame_data(request):
 	sim_id = request.GET["uuid"]
 	index = request.GET["index"]
 
-	selected_frame = sv_archiver.get_save_archiver().get_sim_bin_file(sim_id, index)
+	data, content_encoding = await run_blocking(_load_frame_data, request, sim_id, index)
+
+	if len(data) > STREAM_THRESHOLD:
+		response = StreamingHttpResponse(stream_bytes(data), content_type="application/octet-stream")
+		response["Content-Length"] = len(data)
+	else:
+		response = HttpResponse(data, content_type="application/octet-stream")
+
+	if not content_encoding is None:
+		response["Content-Encoding"] = content_encoding
+
+	return response
+
+# Maximum number of cells sent by 'culled_frame_data' if the request doesn't set a budget
+DEFAULT_CELL_BUDGET = 250000
+
+def _culled_frame_validators(request):
+	try:
+		sim_id = request.GET["uuid"]
+		index = int(request.GET["index"])
+
+		location = sv_archiver.get_save_archiver().get_sim_bin_frame(sim_id, index)
+	except (KeyError, ValueError, IndexError):
+		return ResourceValidators()
+
+	encoding = "deflate" if _accepts_encoding(request, "deflate") else "identity"
+	view = [ request.GET.get(name, "") for name in [ "min", "max", "budget" ] ]
+
+	return _get_frame_validators(sim_id, location, "culled", index, encoding, *view)
+
+@immutable_resource(_culled_frame_validators)
+def culled_frame_data(request):
+	"""
+	Same as 'frame_data', but only sends the cells that overlap the box between 'min' and 'max'
+	(given as 'x,y,z' in the viewer's coordinates, where Y is up). If there are more cells in the
+	box than 'budget', the cells are thinned out evenly over the box instead.
+	"""
+	if not "index" in request.GET:
+		return HttpResponseBadRequest("No frame index provided")
+
+	if not "uuid" in request.GET:
+		return HttpResponseBadRequest("No simulation UUID provided")
+
+	sim_id = request.GET["uuid"]
+
+	try:
+		index = int(request.GET["index"])
+		budget = int(request.GET.get("budget", DEFAULT_CELL_BUDGET))
+
+		box_min = _parse_vector(request.GET["min"]) if "min" in request.GET else None
+		box_max = _parse_vector(request.GET["max"]) if "max" in request.GET else None
+	except ValueError:
+		return HttpResponseBadRequest("Invalid view box or cell budget")
+
+	cells, ids, grid = _get_viz_frame_grid(sim_id, index, get_frame_codec(sim_id))
+
+	if box_min is None and box_max is None:
+		rows = grid.order
+	else:
+		rows = grid.query_box(box_min or [ -float("inf") ] * 3, box_max or [ float("inf") ] * 3)
+
+	visible_count = len(rows)
+	rows = decimate_rows(rows, max(budget, 0))
+
+	data = pack_full_frame(cells[rows], ids[rows])
+
+	if _accepts_encoding(request, "deflate"):
+		response = HttpResponse(zlib.compress(data, 1), content_type="application/octet-stream")
+		response["Content-Encoding"] = "deflate"
+	else:
+		response = HttpResponse(data, content_type="application/octet-stream")
+
+	response["X-Total-Cell-Count"] = len(cells)
+	response["X-Visible-Cell-Count"] = visible_count
+	response["X-Sent-Cell-Count"] = len(rows)
+
+	return response
+
+# Every frame in a frame range response is preceded by its index and its size in bytes
+FRAME_RANGE_HEADER = struct.Struct("<II")
+
+# Upper limit on the number of frames that can be requested at once
+MAX_FRAME_RANGE_COUNT = 256
+
+def frame_range(request):
+	"""
+	Streams every viz frame in '[start, end)' (optionally every 'stride'-th frame) in a single
+	response. Each frame is preceded by a 'FRAME_RANGE_HEADER'. The frames are zlib streams, unless
+	'encoding=identity' is requested. The 'X-Frame-Encoding' header tells which one was used.
+	"""
+	if not "uuid" in request.GET:
+		return HttpResponseBadRequest("No simulation UUID provided")
+
+	if not "start" in request.GET or not "end" in request.GET:
+		return HttpResponseBadRequest("No frame range provided")
+
+	try:
+		start = int(request.GET["start"])
+		end = int(request.GET["end"])
+		stride = int(request.GET.get("stride", 1))
+	except ValueError:
+		return HttpResponseBadRequest("Invalid frame range")
+
+	if start < 0 or end < start or stride < 1:
+		return HttpResponseBadRequest("Invalid frame range")
+
+	encoding = request.GET.get("encoding", "deflate")
+
+	if not encoding in [ "deflate", "identity" ]:
+		return HttpResponseBadRequest(f"Unsupported frame encoding: {encoding}")
+
+	sim_id = request.GET["uuid"]
+	archiver = sv_archiver.get_save_archiver()
+
+	if not archiver.has_simulation(sim_id):
+		return HttpResponseNotFound("Simulation not found")
+
+	codec = get_frame_codec(sim_id)
+
+	end = min(end, start + stride * MAX_FRAME_RANGE_COUNT)
+	frames = archiver.get_sim_bin_frame_range(sim_id, start, end, stride)
+
+	def stream_frames():
+		for index, location in frames:
+			frame = read_frame(location)
 
-	response = FileResponse(open(selected_frame, "rb"))
-	response["Content-Encoding"] = "deflate"
+			if encoding == "deflate":
+				data = read_deflated_viz_frame(sim_id, index, codec, frame)
+			else:
+				data = read_viz_frame(sim_id, index, codec, frame)
+
+			yield FRAME_RANGE_HEADER.pack(index, len(data))
+			yield data
+
+	response = StreamingHttpResponse(stream_frames(), content_type="application/octet-stream")
+	response["X-Frame-Encoding"] = encoding
+	response["X-Frame-Count"] = len(frames)
 
 	return response
 
-def cell_info_from_index(request):
+def _cell_info_validators(request):
+	try:
+		sim_id = request.GET["uuid"]
+		index = int(request.GET["frameindex"])
+		cell_id = int(request.GET["cellid"])
+
+		location = sv_archiver.get_save_archiver().get_sim_step_frame(sim_id, index)
+	except (KeyError, ValueError, IndexError):
+		return ResourceValidators()
+
+	return _get_frame_validators(sim_id, location, "cell", index, cell_id)
+
+def _load_cell_info(sim_id, frameindex, cellid):
+	frame_reader = _get_step_frame_reader(sim_id, frameindex)
+	cell_data = frame_reader.find_cell_with_id(int(cellid))
+
+	return json.dumps(_cell_to_dict(cell_data))
+
+@immutable_resource(_cell_info_validators)
+async def cell_info_from_index(request):
 	if not "cellid" in request.GET:
 		return HttpResponseBadRequest("No cell index provided")
 
@@ -38,14 +317,14 @@ def cell_info_from_index(request):
 	frameindex = request.GET["frameindex"]
 	cellid = request.GET["cellid"]
 
-	selected_frame = sv_archiver.get_save_archiver().get_sim_step_file(sim_id, frameindex)
-
-	with open(selected_frame, "rb") as frame_file:
-		frame_reader = PackedCellReader(frame_file)
+	response_content = await run_blocking(_load_cell_info, sim_id, frameindex, cellid)
+	response = HttpResponse(response_content, content_type="application/json")
+	response["Content-Length"] = len(response_content)
 
-	cell_data = frame_reader.find_cell_with_id(int(cellid))
+	return response
 
-	data = {
+def _cell_to_dict(cell_data):
+	return {
 		"Inde": cell_data.id,
 		"Radius": cell_data.radius,
 		"Length": cell_data.length,
@@ -60,8 +339,157 @@ def cell_info_from_index(request):
 		"Start volume": cell_data.start_volume,
 	}
 
-	response_content = json.dumps(data)
-	response = HttpResponse(response_content, content_type="application/json")
-	response["Content-Length"] = len(response_content)
+def pick_cell(request):
+	"""
+	Finds the first cell hit by a ray ('origin' and 'dir', both 'x,y,z') or the top-most cell at a
+	point on the ground plane ('point', as 'x,z'). Coordinates are in the viewer's space, where Y
+	is up. A cell can also be looked up by its id ('cellid'), which is how the viewer finds the
+	cell it has selected in a new frame. The response has the id of the cell, its row in the viz
+	frame (the instance that the viewer draws it with) and its attributes.
+	"""
+	if not "index" in request.GET:
+		return HttpResponseBadRequest("No frame index provided")
+
+	if not "uuid" in request.GET:
+		return HttpResponseBadRequest("No simulation UUID provided")
+
+	sim_id = request.GET["uuid"]
+
+	try:
+		index = int(request.GET["index"])
+
+		if "cellid" in request.GET:
+			cell_id = int(request.GET["cellid"])
+		elif "point" in request.GET:
+			point = _parse_vector(request.GET["point"], 2)
+		else:
+			origin = _parse_vector(request.GET["origin"])
+			direction = _parse_vector(request.GET["dir"])
+	except (KeyError, ValueError):
+		return HttpResponseBadRequest("Invalid ray, point or cell id")
+
+	cells, ids, grid = _get_viz_frame_grid(sim_id, index, get_frame_codec(sim_id))
+
+	if "cellid" in request.GET:
+		rows = np.flatnonzero(ids == cell_id)
+		row, distance = (int(rows[0]) if len(rows) > 0 else -1), None
+	elif "point" in request.GET:
+		row, distance = grid.pick_point(point[0], point[1])
+	else:
+		row, distance = grid.pick_ray(origin, direction)
+
+	data = { "hit": row >= 0 }
+
+	if row >= 0:
+		cell_id = int(ids[row])
+		cell_data = _get_step_frame_reader(sim_id, index).find_cell_with_id(cell_id)
+
+		data.update({
+			"id": cell_id,
+			"row": row,
+			"distance": distance,
+			"cell": None if cell_data is None else _cell_to_dict(cell_data),
+		})
+
+	return HttpResponse(json.dumps(data), content_type="application/json")
+
+# Number of frames that are sent in each line of a cell history response
+CELL_HISTORY_CHUNK_SIZE = 128
+
+def cell_history(request):
+	"""
+	Streams the attributes of a single cell over the frames in '[start, end)' as newline-delimited
+	JSON. Every line holds a chunk of the time series in columns: 'frame' has the index of each frame
+	and there is one list for every step frame attribute. Frames where the cell doesn't exist (yet)
+	are left out.
+	"""
+	if not "uuid" in request.GET:
+		return HttpResponseBadRequest("No simulation UUID provided")
+
+	if not "cellid" in request.GET:
+		return HttpResponseBadRequest("No cell id provided")
+
+	sim_id = request.GET["uuid"]
+	archiver = sv_archiver.get_save_archiver()
+
+	if not archiver.has_simulation(sim_id):
+		return HttpResponseNotFound("Simulation not found")
+
+	try:
+		cell_id = int(request.GET["cellid"])
+		start = int(request.GET.get("start", 0))
+		end = int(request.GET.get("end", archiver.get_sim_index_data(sim_id)["num_frames"]))
+	except ValueError:
+		return HttpResponseBadRequest("Invalid cell id or frame range")
+
+	codec = get_frame_codec(sim_id)
+	cache = get_frame_cache()
+
+	frames = archiver.get_sim_step_frame_range(sim_id, max(start, 0), end)
+
+	def read_step_frame(index, location):
+		# Frames that are already cached are reused, but a long history would push everything
+		# else out of the cache, so the frames that get loaded here aren't added to it (and they
+		# don't count as cache misses either)
+		reader = cache.peek((sim_id, "step", index))
+
+		if reader is None:
+			reader = PackedCellReader(read_frame(location), codec=codec)
+
+		return reader
+
+	def new_chunk():
+		return { "frame": [], **{ name: [] for name in CELL_DTYPE.names } }
+
+	def stream_history():
+		chunk = new_chunk()
+		sent_chunk = False
+
+		for index, location in frames:
+			reader = read_step_frame(index, location)
+			row = reader.find_row_with_id(cell_id)
+
+			if row < 0:
+				continue
+
+			columns = reader.get_columns()
+
+			chunk["frame"].append(index)
+
+			for name in CELL_DTYPE.names:
+				chunk[name].append(columns[name][row].item())
+
+			if len(chunk["frame"]) >= CELL_HISTORY_CHUNK_SIZE:
+				yield json.dumps(chunk) + "\n"
+
+				chunk = new_chunk()
+				sent_chunk = True
+
+		if len(chunk["frame"]) > 0 or not sent_chunk:
+			yield json.dumps(chunk) + "\n"
+
+	return StreamingHttpResponse(stream_history(), content_type="application/x-ndjson")
+
+def sim_stats(request):
+	"""
+	Returns the per-frame summaries of a simulation as a series (one list per summary field, see
+	'saveviewer.stats'). Simulations created before the summaries were introduced have no series.
+	"""
+	if not "uuid" in request.GET:
+		return HttpResponseBadRequest("No simulation UUID provided")
+
+	sim_id = request.GET["uuid"]
+	archiver = sv_archiver.get_save_archiver()
+
+	if not archiver.has_simulation(sim_id):
+		return HttpResponseNotFound("Simulation not found")
+
+	sim_data = archiver.get_sim_index_data(sim_id)
+	series = load_stats_series(os.path.join(archiver.archive_root, sim_data["path"]))
+
+	data = { "uuid": sim_id, "num_frames": sim_data["num_frames"], "series": series }
+
+	return HttpResponse(json.dumps(data), content_type="application/json")
 
-	return response
\ No newline at end of file
+def frame_cache_stats(request):
+	return HttpResponse(json.dumps(get_frame_cache().get_stats()), content_type="application/json")
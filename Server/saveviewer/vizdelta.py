@@ -0,0 +1,233 @@
+import struct
+import threading
+import collections
+
+import numpy as np
+
+from .format import VIZ_CELL_DTYPE, allocate_viz_frame, unpack_viz_frame
+
+# Consecutive viz frames are almost identical, so instead of storing every frame in full, we can
+# store a full frame (keyframe) every N frames and only store the changes in between. A delta frame
+# is relative to the frame right before it, and it contains:
+#  - The rows (in the previous frame) of the cells that were removed
+#  - The quantized change in position, direction and size of every cell that is still there
+#  - The color of every cell that is still there (mostly identical, so it compresses very well)
+#  - Every cell that was added, stored in full
+#
+# The cells that are still there keep the order they had in the previous frame and new cells are
+# appended to the end, so a reconstructed frame is not necessarily in the same order as the frame
+# that was encoded. This is fine, since the viewer only uses the order to look up cell ids.
+#
+# Delta frames start with 'DELTA_FRAME_MAGIC', while keyframes are regular viz frames.
+DELTA_FRAME_MAGIC = b"CMVD"
+
+# Magic, Keyframe index, Cell count of previous frame, Removed count, Added count, Position step, Direction step, Size step
+DELTA_HEADER = struct.Struct("<4sIIIIfff")
+
+POSITION_STEP = 1e-3
+DIRECTION_STEP = 1e-4
+SIZE_STEP = 1e-4
+
+def is_delta_frame(data):
+	return bytes(data[:len(DELTA_FRAME_MAGIC)]) == DELTA_FRAME_MAGIC
+
+def get_keyframe_index(data):
+	return DELTA_HEADER.unpack_from(data, 0)[1]
+
+def pack_full_frame(cells, ids):
+	buffer, frame_cells, frame_ids = allocate_viz_frame(len(cells))
+
+	frame_cells[:] = cells
+	frame_ids[:] = ids
+
+	return buffer.tobytes()
+
+def apply_delta(cells, ids, data):
+	"""
+	Applies a delta frame to the cells (and ids) of the frame before it. The encoder uses this
+	same function to track what the decoder will see, so quantization errors never accumulate.
+	"""
+	(_, _, previous_count, removed_count, added_count, position_step, direction_step, size_step) = DELTA_HEADER.unpack_from(data, 0)
+
+	if previous_count != len(cells):
+		raise ValueError(f"Delta frame expects {previous_count} cells, but the previous frame has {len(cells)}")
+
+	offset = DELTA_HEADER.size
+
+	def read_array(dtype, count):
+		nonlocal offset
+
+		array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+		offset += array.nbytes
+
+		return array
+
+	removed_rows = read_array("<u4", removed_count)
+
+	kept = np.ones(previous_count, dtype=bool)
+	kept[removed_rows] = False
+
+	kept_cells = cells[kept]
+	kept_ids = ids[kept]
+	kept_count = len(kept_cells)
+
+	position_delta = read_array("<i4", 3 * kept_count).reshape(3, kept_count).T
+	direction_delta = read_array("<i4", 3 * kept_count).reshape(3, kept_count).T
+	length_delta = read_array("<i4", kept_count)
+	radius_delta = read_array("<i4", kept_count)
+
+	kept_cells["pos"] += position_delta.astype(np.float32) * np.float32(position_step)
+	kept_cells["dir"] += direction_delta.astype(np.float32) * np.float32(direction_step)
+	kept_cells["length"] += length_delta.astype(np.float32) * np.float32(size_step)
+	kept_cells["radius"] += radius_delta.astype(np.float32) * np.float32(size_step)
+	kept_cells["color"] = read_array("<u4", kept_count)
+
+	added_cells = read_array(VIZ_CELL_DTYPE, added_count)
+	added_ids = read_array("<u8", added_count)
+
+	return np.concatenate([ kept_cells, added_cells ]), np.concatenate([ kept_ids, added_ids ])
+
+class VizDeltaEncoder:
+	def __init__(self, keyframe_interval):
+		self.keyframe_interval = keyframe_interval
+
+		self.frame_index = 0
+		self.keyframe_index = 0
+
+		# What the decoder will have reconstructed for the previous frame
+		self.cells = None
+		self.ids = None
+
+	def encode(self, frame):
+		"""
+		Takes an uncompressed viz frame and returns what should be stored in its place (either
+		the frame itself, if its a keyframe, or a delta frame).
+		"""
+		cells, ids = unpack_viz_frame(frame)
+
+		if self.cells is None or self.frame_index - self.keyframe_index >= self.keyframe_interval:
+			self.keyframe_index = self.frame_index
+			self.cells = cells.copy()
+			self.ids = ids.copy()
+
+			encoded = frame
+		else:
+			encoded = self._make_delta(cells, ids)
+			self.cells, self.ids = apply_delta(self.cells, self.ids, encoded)
+
+		self.frame_index += 1
+
+		return encoded
+
+	def _make_delta(self, cells, ids):
+		# Find where each cell of the previous frame is in the current frame
+		order = np.argsort(ids, kind="stable")
+		sorted_ids = ids[order]
+
+		positions = np.minimum(np.searchsorted(sorted_ids, self.ids), max(len(sorted_ids) - 1, 0))
+		found = (sorted_ids[positions] == self.ids) if len(sorted_ids) > 0 else np.zeros(len(self.ids), dtype=bool)
+
+		removed_rows = np.nonzero(~found)[0].astype("<u4")
+
+		reference = self.cells[found]
+		current = cells[order[positions[found]]]
+
+		def quantize(current_values, reference_values, step):
+			delta = current_values.astype(np.float64) - reference_values.astype(np.float64)
+			return np.rint(delta / step).astype("<i4")
+
+		position_delta = quantize(current["pos"], reference["pos"], POSITION_STEP)
+		direction_delta = quantize(current["dir"], reference["dir"], DIRECTION_STEP)
+		length_delta = quantize(current["length"], reference["length"], SIZE_STEP)
+		radius_delta = quantize(current["radius"], reference["radius"], SIZE_STEP)
+
+		added = ~np.isin(ids, self.ids)
+
+		header = DELTA_HEADER.pack(DELTA_FRAME_MAGIC, self.keyframe_index, len(self.cells), len(removed_rows), int(np.count_nonzero(added)),
+			POSITION_STEP, DIRECTION_STEP, SIZE_STEP)
+
+		# Storing each component separately groups the (mostly zero) high bytes together,
+		# which helps the compressor a lot
+		return b"".join([
+			header,
+			removed_rows.tobytes(),
+			np.ascontiguousarray(position_delta.T).tobytes(),
+			np.ascontiguousarray(direction_delta.T).tobytes(),
+			length_delta.tobytes(),
+			radius_delta.tobytes(),
+			np.ascontiguousarray(current["color"]).astype("<u4").tobytes(),
+			cells[added].tobytes(),
+			ids[added].astype("<u8").tobytes(),
+		])
+
+class VizFrameReconstructor:
+	"""
+	Rebuilds full viz frames from keyframes and delta frames. 'read_frame' should take a frame index
+	and return the uncompressed frame that was stored for it. The last reconstructed frame is kept,
+	so that playing a simulation forwards only needs one delta to be applied per frame.
+	"""
+	def __init__(self, read_frame):
+		self.read_frame = read_frame
+		self.lock = threading.Lock()
+
+		self.last_index = None
+		self.last_cells = None
+		self.last_ids = None
+
+	def reconstruct(self, index, data=None):
+		if data is None:
+			data = self.read_frame(index)
+
+		if not is_delta_frame(data):
+			return data
+
+		keyframe_index = get_keyframe_index(data)
+
+		with self.lock:
+			if not self.last_index is None and keyframe_index <= self.last_index < index:
+				start = self.last_index + 1
+				cells, ids = self.last_cells, self.last_ids
+			else:
+				start = keyframe_index + 1
+				cells, ids = unpack_viz_frame(self.read_frame(keyframe_index))
+
+			for frame_index in range(start, index + 1):
+				frame = data if frame_index == index else self.read_frame(frame_index)
+				cells, ids = apply_delta(cells, ids, frame)
+
+			self.last_index = index
+			self.last_cells = cells
+			self.last_ids = ids
+
+		return pack_full_frame(cells, ids)
+
+# One reconstructor is kept for every simulation that was viewed recently
+MAX_RECONSTRUCTORS = 16
+
+global__reconstructors = collections.OrderedDict()
+global__reconstructor_lock = threading.Lock()
+
+def get_reconstructor(uuid: str, read_frame):
+	global global__reconstructors
+	global global__reconstructor_lock
+
+	with global__reconstructor_lock:
+		reconstructor = global__reconstructors.get(uuid, None)
+
+		if reconstructor is None:
+			reconstructor = VizFrameReconstructor(read_frame)
+			global__reconstructors[uuid] = reconstructor
+
+			if len(global__reconstructors) > MAX_RECONSTRUCTORS:
+				global__reconstructors.popitem(last=False)
+		else:
+			global__reconstructors.move_to_end(uuid)
+
+	return reconstructor
+
+def drop_reconstructor(uuid: str):
+	global global__reconstructors
+	global global__reconstructor_lock
+
+	with global__reconstructor_lock:
+		global__reconstructors.pop(uuid, None)
@@ -1,4 +1,7 @@
-import zlib
+import os
+
+from saveviewer.container import FrameContainerWriter, STEP_CONTAINER_FILE, VIZ_CONTAINER_FILE
+from saveviewer.codecs import get_codec, DEFAULT_CODEC
 
 class BackendParameters:
 	def __init__(self):
@@ -15,13 +18,40 @@ class BackendParameters:
 
 		self.backend_version = None
 
-class SimulationBackend:
-	STEP_COMPRESSION_LEVEL_ZLIB = 2
+		# Store a full viz frame every N frames and deltas in between (0 stores every frame in full)
+		self.viz_keyframe_interval = 0
+
+		# Name of the codec used to compress the frames (see 'saveviewer.codecs')
+		self.frame_codec = DEFAULT_CODEC
+
+		# Cores that the simulation is pinned to, and the number of threads that its libraries
+		# should use (set by the scheduler, see 'simrunner.instances.scheduler')
+		self.cpu_cores = None
+		self.thread_count = None
+
+class FrameSnapshot:
+	"""
+	The state of a single frame, as captured by the simulation thread. Nothing in a snapshot should
+	be shared with the simulation, because the snapshot is packed and written on another thread
+	while the simulation keeps on stepping.
+	"""
+	def __init__(self, step_index, step_data, viz_data):
+		self.step_index = step_index
+		self.step_data = step_data
+		self.viz_data = viz_data
 
+		# The viz frame as it is sent to the viewers (see 'SimulationBackend.get_wire_viz_frame')
+		self.wire_viz_data = None
+
+class SimulationBackend:
 	def __init__(self, params):
 		assert isinstance(params, BackendParameters)
 
 		self.params = params
+		self.codec = get_codec(params.frame_codec)
+
+		self.step_container = None
+		self.viz_container = None
 
 	def initialize(self, name, source):
 		pass
@@ -32,11 +62,66 @@ class SimulationBackend:
 	def write_step_pickle(self):
 		return ""
 
+	def capture_frame(self):
+		"""
+		Takes a snapshot of the current frame. This is called from the simulation thread, so it
+		should do as little work as possible (packing and compression belong in 'write_frame').
+		"""
+		raise NotImplementedError()
+
+	def write_frame(self, snapshot):
+		"""
+		Packs a snapshot and writes it to the frame containers. This is called from the frame writer
+		thread, in the same order in which the snapshots were captured.
+		Returns the location of each frame, which is what should be added to the frame log.
+		"""
+		raise NotImplementedError()
+
+	def write_step_files(self):
+		return self.write_frame(self.capture_frame())
+
+	def summarize_frame(self, snapshot):
+		"""
+		Returns the summary of a snapshot (see 'saveviewer.stats.summarize_frame'), or 'None' if the
+		backend can't summarize its frames. Like 'write_frame', this runs on the frame writer thread.
+		"""
+		return None
+
+	def get_wire_viz_frame(self, snapshot):
+		"""
+		Returns the viz frame of a snapshot the way that it is sent to the viewers: the full frame
+		(not a delta) as a zlib stream. This is called on the frame writer thread, after the snapshot
+		has been written. Returns 'None' if the backend can't provide it.
+		"""
+		return snapshot.wire_viz_data
+
 	def compress_step(self, data):
-		return zlib.compress(data, self.STEP_COMPRESSION_LEVEL_ZLIB)
+		return self.codec.compress(data)
+
+	def write_frame_data(self, step_index, step_data, viz_data):
+		"""
+		Appends a (compressed) step frame and viz frame to the simulation's frame containers.
+		Returns the location of each frame, which is what should be added to the frame log.
+		"""
+		if self.step_container is None:
+			self.step_container = FrameContainerWriter(os.path.join(self.params.sim_root_dir, STEP_CONTAINER_FILE))
+			self.viz_container = FrameContainerWriter(os.path.join(self.params.cache_dir, VIZ_CONTAINER_FILE))
+
+		step_offset, step_size = self.step_container.append(step_index, step_data)
+		viz_offset, viz_size = self.viz_container.append(step_index, viz_data)
+
+		step_location = { "file": os.path.join(".", STEP_CONTAINER_FILE), "offset": step_offset, "size": step_size }
+		viz_location = { "file": os.path.join(self.params.cache_relative_prefix, VIZ_CONTAINER_FILE), "offset": viz_offset, "size": viz_size }
+
+		return step_location, viz_location
 
 	def is_running(self):
 		return True
 
 	def shutdown(self):
-		pass
\ No newline at end of file
+		if not self.step_container is None:
+			self.step_container.close()
+			self.viz_container.close()
+
+			self.step_container = None
+			self.viz_container = None
\ No newline at end of file
@@ -1,10 +1,15 @@
-from .backend import SimulationBackend
+from .backend import SimulationBackend, FrameSnapshot
 
 from saveviewer.format import *
+from saveviewer.vizdelta import VizDeltaEncoder
+from saveviewer.stats import summarize_frame
 
-import struct
-import io
 import os
+import zlib
+import operator
+import itertools
+
+import numpy as np
 
 import importlib
 
@@ -14,6 +19,11 @@ class CellModeller4Backend(SimulationBackend):
 
 		self.params = params
 		self.simulation = None
+
+		self.viz_encoder = None
+
+		if params.viz_keyframe_interval > 1:
+			self.viz_encoder = VizDeltaEncoder(params.viz_keyframe_interval)
 	
 	def initialize(self):
 		# Load module
@@ -48,67 +58,89 @@ class CellModeller4Backend(SimulationBackend):
 	def step(self):
 		self.simulation.step()
 
-	def _write_step_frame(self, path):
-		cell_states = self.simulation.cellStates
+	def _gather_attribute(self, states, name, dtype):
+		return np.fromiter(map(operator.attrgetter(name), states), dtype=dtype, count=len(states))
+
+	def _gather_vector(self, states, name):
+		# Some models use RGBA colors, so we can't assume that every vector has 3 components
+		width = len(getattr(states[0], name)) if len(states) > 0 else 3
+		values = itertools.chain.from_iterable(map(operator.attrgetter(name), states))
+
+		return np.fromiter(values, dtype=np.float64, count=width * len(states)).reshape(len(states), width)[:, :3]
 
-		writer = PackedCellWriter()
-		writer.write_header(len(cell_states))
+	def _gather_step_cells(self, states):
+		# Maps each field of the step frame to the name of the attribute in the CellModeller4 cell state
+		state_attributes = {
+			"id": "id", "radius": "radius", "length": "length", "growth_rate": "growthRate",
+			"cell_age": "cellAge", "eff_growth": "effGrowth", "cell_type": "cellType", "cell_adhesion": "cellAdh",
+			"target_volume": "targetVol", "volume": "volume", "strain_rate": "strainRate", "start_volume": "startVol",
+		}
 
-		for it in cell_states.keys():
-			state = cell_states[it]
+		cells = np.empty(len(states), dtype=CELL_DTYPE)
 
-			writer.write_cell(PackedCell.from_cellmodeller4(state))
+		for field, attribute in state_attributes.items():
+			cells[field] = self._gather_attribute(states, attribute, CELL_DTYPE.fields[field][0])
 
-		with open(path, "wb") as out_file:
-			writer.flush_to_file(out_file)
+		return cells
 
-	def _write_viz_frame(self, path):
-		cell_states = self.simulation.cellStates
+	def _gather_viz_frame(self, states):
+		buffer, cells, ids = allocate_viz_frame(len(states))
 
-		byte_buffer = io.BytesIO()
-		byte_buffer.write(struct.pack("<i", len(cell_states)))
+		# The viewer uses Y as the up axis, so the Y and Z axes need to be swapped
+		cells["pos"] = self._gather_vector(states, "pos")[:, [0, 2, 1]]
+		cells["dir"] = self._gather_vector(states, "dir")[:, [0, 2, 1]]
 
-		for it in cell_states.keys():
-			state = cell_states[it]
+		radius = self._gather_attribute(states, "radius", np.float64)
 
-			color_r = int(255.0 * min(state.color[0], 1.0))
-			color_g = int(255.0 * min(state.color[1], 1.0))
-			color_b = int(255.0 * min(state.color[2], 1.0))
-			packed_color = 0xFF000000 | (color_b << 16) | (color_g << 8) | color_r
+		# The length is computed differenty in CellModeller4 and CellModeller5. The front-end 
+		# expects that the length will be calculated based on how its done in CM5.
+		cells["length"] = self._gather_attribute(states, "length", np.float64) + 1.0 - 2.0 * radius
+		cells["radius"] = radius
 
-			# The length is computed differenty in CellModeller4 and CellModeller5. The front-end 
-			# expects that the length will be calculated based on how its done in CM5.
-			final_length = state.length + 1.0 - 2.0 * state.radius
+		color = (255.0 * np.clip(self._gather_vector(states, "color"), 0.0, 1.0)).astype(np.uint32)
+		cells["color"] = 0xFF000000 | (color[:, 2] << 16) | (color[:, 1] << 8) | color[:, 0]
 
-			byte_buffer.write(struct.pack("<fff", state.pos[0], state.pos[2], state.pos[1]))
-			byte_buffer.write(struct.pack("<fff", state.dir[0], state.dir[2], state.dir[1]))
-			byte_buffer.write(struct.pack("<ffI", final_length, state.radius, packed_color))
+		ids[:] = self._gather_attribute(states, "id", np.uint64)
 
-		for it in cell_states.keys():
-			state = cell_states[it]
+		return buffer
 
-			byte_buffer.write(struct.pack("<Q", int(state.id)))
+	def _pack_step_frame(self, cells):
+		return self.compress_step(ColumnarCellWriter(cells).to_bytes())
 
-		with open(path, "wb") as out_file:
-			out_file.write(self.compress_step(byte_buffer.getbuffer()))
+	def _pack_viz_frame(self, buffer):
+		if not self.viz_encoder is None:
+			return self.compress_step(self.viz_encoder.encode(buffer))
 
-	def write_step_files(self):
-		base_file_name = "step-%05i" % self.simulation.stepNum
+		return self.compress_step(buffer)
 
-		pickle_path = os.path.join(self.simulation.outputDirPath, f"{base_file_name}.cm5_step")
-		viz_bin_path = os.path.join(self.params.cache_dir, f"{base_file_name}.cm5_viz")
+	def capture_frame(self):
+		# Gathering the cell states into arrays copies them, so the simulation can keep on
+		# stepping while the arrays are being compressed
+		states = list(self.simulation.cellStates.values())
 
-		pickle_file_relative = os.path.join(".", f"{base_file_name}.cm5_step")
-		cached_file_relative = os.path.join(self.params.cache_relative_prefix, f"{base_file_name}.cm5_viz")
+		return FrameSnapshot(self.simulation.stepNum, self._gather_step_cells(states), self._gather_viz_frame(states))
 
-		# Write pickle
-		self._write_step_frame(pickle_path)
+	def write_frame(self, snapshot):
+		viz_frame = self._pack_viz_frame(snapshot.viz_data)
 
-		# Write binary finle
-		self._write_viz_frame(viz_bin_path)
+		# Full frames that were compressed with zlib can be sent to the viewers as they are
+		if self.viz_encoder is None and self.codec.content_encoding == "deflate":
+			snapshot.wire_viz_data = viz_frame
 
-		return pickle_file_relative, cached_file_relative
+		return self.write_frame_data(snapshot.step_index, self._pack_step_frame(snapshot.step_data), viz_frame)
+
+	def get_wire_viz_frame(self, snapshot):
+		if snapshot.wire_viz_data is None:
+			snapshot.wire_viz_data = zlib.compress(snapshot.viz_data, 1)
+
+		return snapshot.wire_viz_data
+
+	def summarize_frame(self, snapshot):
+		viz_cells, _ = unpack_viz_frame(snapshot.viz_data)
+		return summarize_frame(snapshot.step_data, viz_cells)
 
 	def shutdown(self):
+		super().shutdown()
+
 		del self.simulation
 		self.simulation = None
\ No newline at end of file
@@ -1,6 +1,11 @@
-from .backend import SimulationBackend
+from .backend import SimulationBackend, FrameSnapshot
+
+from saveviewer.codecs import is_zlib_codec, get_codec
+from saveviewer.format import PackedCellReader, unpack_viz_frame
+from saveviewer.stats import summarize_frame
 
 import os
+import zlib
 import importlib
 import sys
 import time
@@ -17,32 +22,70 @@ class CellModeller5Backend(SimulationBackend):
 		module = importlib.import_module("cellmodeller5")
 
 		self.simulator = module.Simulator()
+
+		# The native module always writes zlib streams. If the simulation uses a different codec,
+		# the frames have to be re-encoded after the native module writes them.
+		self.transcode_frames = not is_zlib_codec(self.codec)
+
+		if not self.transcode_frames:
+			self.simulator.set_compression_level(self.codec.level)
 	
 	def step(self):
 		self.simulator.step()
 
 		time.sleep(0.12)
 
-	def write_step_files(self):
-		base_file_name = "step-%05i" % self.simulator.get_step_index()
+	def _dump_frame(self, dump_func, path):
+		# The native module can only write frames to files, so we have to dump each frame to a
+		# temporary file and then move its contents into the frame container
+		dump_func(str(path))
+
+		if not os.path.isfile(path):
+			raise RuntimeError(f"The simulator did not write a frame to '{path}'")
+
+		with open(path, "rb") as frame_file:
+			data = frame_file.read()
+
+		os.remove(path)
 
-		step_path = os.path.join(self.params.sim_root_dir, f"{base_file_name}.cm5_step")
-		viz_bin_path = os.path.join(self.params.cache_dir, f"{base_file_name}.cm5_viz")
+		return data
 
-		step_file_relative = os.path.join(".", f"{base_file_name}.cm5_step")
-		cached_file_relative = os.path.join(self.params.cache_relative_prefix, f"{base_file_name}.cm5_viz")
+	def _transcode_frame(self, data):
+		if self.transcode_frames:
+			data = self.codec.compress(zlib.decompress(data))
 
-		# Write step file
-		self.simulator.dump_to_step_file(str(step_path))
+		return data
 
-		# Write viz file
-		self.simulator.dump_to_viz_file(str(viz_bin_path))
+	def capture_frame(self):
+		# The native module compresses the frames while dumping them, so only transcoding (if
+		# a different codec was requested) is left for the writer thread
+		step_path = os.path.join(self.params.sim_root_dir, "current.cm5_step")
+		viz_bin_path = os.path.join(self.params.cache_dir, "current.cm5_viz")
 
-		return step_file_relative, cached_file_relative
+		step_data = self._dump_frame(self.simulator.dump_to_step_file, step_path)
+		viz_data = self._dump_frame(self.simulator.dump_to_viz_file, viz_bin_path)
+
+		return FrameSnapshot(self.simulator.get_step_index(), step_data, viz_data)
+
+	def write_frame(self, snapshot):
+		return self.write_frame_data(snapshot.step_index, self._transcode_frame(snapshot.step_data), self._transcode_frame(snapshot.viz_data))
+
+	def get_wire_viz_frame(self, snapshot):
+		# The native module already compresses the full frame with zlib
+		return snapshot.viz_data
+
+	def summarize_frame(self, snapshot):
+		# The snapshot still holds the frames as the native module compressed them (with zlib)
+		step_columns = PackedCellReader(snapshot.step_data, codec=get_codec("zlib")).get_columns()
+		viz_cells, _ = unpack_viz_frame(zlib.decompress(snapshot.viz_data))
+
+		return summarize_frame(step_columns, viz_cells)
 
 	def is_running(self):
 		return self.simulator.is_running
 
 	def shutdown(self):
+		super().shutdown()
+
 		del self.simulator
 		self.simulator = None
\ No newline at end of file
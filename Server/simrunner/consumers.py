@@ -1,5 +1,7 @@
 from multiprocessing.connection import Client
 from channels.generic.websocket import WebsocketConsumer
+import threading
+import asyncio
 import json
 
 from saveviewer import archiver as sv_archiver
@@ -7,6 +9,24 @@ from saveviewer import archiver as sv_archiver
 from . import websocket_groups as wsgroups
 from .instances.manager import is_simulation_running, send_message_to_simulation, kill_simulation
 from .instances.siminstance import ClientAction, ClientMessage
+from .instances.scheduler import get_simulation_scheduler
+
+# What happens to a message that is sent to a client whose outbox is full. Only the latest frame
+# count matters, but errors and state changes have to reach the client.
+CLIENT_OVERFLOW_POLICIES = {
+	ClientAction.NEW_FRAME: wsgroups.OverflowPolicy.REPLACE,
+	ClientAction.SIM_HEADER: wsgroups.OverflowPolicy.KEEP,
+	ClientAction.ERROR_MESSAGE: wsgroups.OverflowPolicy.KEEP,
+	ClientAction.INFO_LOG: wsgroups.OverflowPolicy.DROP,
+	ClientAction.CLOSE_INFO_LOG: wsgroups.OverflowPolicy.KEEP,
+	ClientAction.RELOAD_DONE: wsgroups.OverflowPolicy.KEEP,
+	ClientAction.SIM_STOPPED: wsgroups.OverflowPolicy.KEEP,
+	ClientAction.SIM_QUEUED: wsgroups.OverflowPolicy.REPLACE,
+	ClientAction.SIM_STARTED: wsgroups.OverflowPolicy.KEEP,
+}
+
+# Outbox key of the binary frame messages (see 'push_frame')
+FRAME_PUSH_KEY = "frame"
 
 class UserCommsConsumer(WebsocketConsumer):
 	def __init__(self, custom_action_callback=None, *args, **kwargs):
@@ -14,22 +34,43 @@ class UserCommsConsumer(WebsocketConsumer):
 
 		self.custom_action_callback = custom_action_callback
 
+		self.outbox = None
+
+		self.subscribed_to_frames = False
+		self.frame_push_lock = threading.Lock()
+		self.latest_frame_index = -1
+
+	async def __call__(self, scope, receive, send):
+		# Messages are sent from the event loop instead of going through 'self.send', which would
+		# block the thread that sends them until the message has been sent
+		self.outbox = wsgroups.ClientOutbox(asyncio.get_running_loop(), send)
+
+		await super().__call__(scope, receive, send)
+
 	def connect(self):
 		self.sim_uuid = None
 		self.accept()
 
+	def disconnect(self, close_code):
+		self.subscribed_to_frames = False
+		self.outbox.close()
+
+		if not self.sim_uuid is None:
+			wsgroups.remove_websocket_from_group(f"simcomms/{self.sim_uuid}", self)
+
 	def receive(self, text_data):
 		msg_data = json.loads(text_data)
 
 		if msg_data["action"] == "connectto":
-			all_sims = sv_archiver.get_save_archiver().get_all_sim_data()
-
-			if msg_data["data"] in all_sims:
+			if sv_archiver.get_save_archiver().has_simulation(msg_data["data"]):
 				if not self.sim_uuid == None:
 					wsgroups.remove_websocket_from_group(f"simcomms/{self.sim_uuid}", self)
 
 				self.sim_uuid = msg_data["data"]
 
+				with self.frame_push_lock:
+					self.latest_frame_index = -1
+
 				wsgroups.add_websocket_to_group(f"simcomms/{self.sim_uuid}", self)
 
 				self.send_sim_header()
@@ -37,6 +78,8 @@ class UserCommsConsumer(WebsocketConsumer):
 				self.close(code=4101)
 		elif msg_data["action"] == "getheader":
 			self.send_sim_header()
+		elif msg_data["action"] == "subscribeframes":
+			self.subscribed_to_frames = bool(msg_data["data"])
 		elif msg_data["action"] == "stop":
 			kill_simulation(self.sim_uuid)
 		elif msg_data["action"] == "msgtoinstance":
@@ -56,26 +99,35 @@ class UserCommsConsumer(WebsocketConsumer):
 			"uuid": self.sim_uuid,
 			"name": sim_data["name"],
 			"frameCount": sim_data["num_frames"],
-			"isOnline": is_online
+			"isOnline": is_online,
+			"queuePosition": get_simulation_scheduler().get_queue_position(self.sim_uuid) if is_online else None
 		}
 
 		self.send_client_message(ClientMessage(ClientAction.SIM_HEADER, response_data))
 
 	def send_client_message(self, message):
-		action_names = {
-			ClientAction.NEW_FRAME: "newframe",
-			ClientAction.SIM_HEADER: "simheader",
-			ClientAction.ERROR_MESSAGE: "error_message",
-			ClientAction.INFO_LOG: "infolog",
-			ClientAction.CLOSE_INFO_LOG: "closeinfolog",
-			ClientAction.RELOAD_DONE: "reloaddone",
-			ClientAction.SIM_STOPPED: "simstopped",
-		}
-
-		data = {} if message.data is None else message.data
-
-		message_json = { "action": action_names[message.action], "data": data }
-		self.send(text_data=json.dumps(message_json))
+		self.send_encoded_message(message.action, message.encode())
+
+	def send_encoded_message(self, action, encoded_message):
+		"""
+		Queues a message that was encoded with 'ClientMessage.encode'. This doesn't block.
+		"""
+		self.outbox.put(action, { "type": "websocket.send", "text": encoded_message }, CLIENT_OVERFLOW_POLICIES[action])
+
+	def push_frame(self, frame_index, message):
+		"""
+		Queues a binary frame message (see 'siminstance.FRAME_PUSH_HEADER') to be sent to the client.
+		This doesn't block. If an older frame is still waiting to be sent, it is replaced, so a
+		client that can't keep up skips frames.
+		"""
+		with self.frame_push_lock:
+			# Frames are read on a thread pool, so they can arrive out of order
+			if frame_index <= self.latest_frame_index:
+				return
+
+			self.latest_frame_index = frame_index
+
+		self.outbox.put(FRAME_PUSH_KEY, { "type": "websocket.send", "bytes": message }, wsgroups.OverflowPolicy.REPLACE)
 
 	def on_websocket_group_closed(self):
 		self.send_client_message(ClientMessage(ClientAction.SIM_STOPPED, None))
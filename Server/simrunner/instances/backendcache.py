@@ -0,0 +1,162 @@
+import threading
+import hashlib
+import shutil
+import time
+import os
+
+import git
+
+from django.conf import settings
+
+from saveviewer import archiver as sv_archiver
+
+# Every simulation with a custom backend used to clone the backend's repository into its own
+# directory, so the same repository was downloaded (and stored) again for every simulation.
+#
+# The cache keeps a bare mirror of every repository that has been used, named after a hash of its
+# URL, and only fetches from the remote when the mirror is older than
+# 'SIMULATION_BACKEND_CACHE_MAX_AGE' seconds (see 'VizToolServer/settings.py'). The commit that a
+# simulation needs is checked out as a worktree of the mirror. Worktrees are named after the commit,
+# so simulations that use the same commit share the same checkout, even if they came from
+# different forks.
+#
+# NOTE: Simulations must not write to their backend directory, since it is shared.
+BACKEND_CACHE_DIR = "backend-cache"
+BACKEND_CACHE_MAX_AGE = 5 * 60
+
+# Time of the last fetch, stored in the mirror directory
+LAST_FETCH_FILE = "last-fetch"
+
+class BackendCache:
+	def __init__(self, root_path: str, max_age: float=BACKEND_CACHE_MAX_AGE):
+		self.mirrors_path = os.path.join(root_path, "mirrors")
+		self.worktrees_path = os.path.join(root_path, "worktrees")
+		self.max_age = max_age
+
+		os.makedirs(self.mirrors_path, exist_ok=True)
+		os.makedirs(self.worktrees_path, exist_ok=True)
+
+		# Only one thread can work with a mirror (and its worktrees) at a time
+		self.lock = threading.Lock()
+		self.mirror_locks = {}
+
+	def get_mirror_path(self, url: str):
+		url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()[:24]
+		return os.path.abspath(os.path.join(self.mirrors_path, f"{url_hash}.git"))
+
+	def get_worktree_path(self, commit: str):
+		return os.path.abspath(os.path.join(self.worktrees_path, commit))
+
+	def _get_mirror_lock(self, mirror_path: str):
+		with self.lock:
+			if not mirror_path in self.mirror_locks:
+				self.mirror_locks[mirror_path] = threading.Lock()
+
+			return self.mirror_locks[mirror_path]
+
+	def _get_last_fetch_time(self, mirror_path: str):
+		try:
+			with open(os.path.join(mirror_path, LAST_FETCH_FILE), "r") as time_file:
+				return float(time_file.read())
+		except (OSError, ValueError):
+			return 0.0
+
+	def _set_last_fetch_time(self, mirror_path: str):
+		with open(os.path.join(mirror_path, LAST_FETCH_FILE), "w") as time_file:
+			time_file.write(str(time.time()))
+
+	def _update_mirror(self, url: str, mirror_path: str, progress=None):
+		# Must be called while holding the mirror's lock
+		if not os.path.isfile(os.path.join(mirror_path, LAST_FETCH_FILE)):
+			# The mirror either doesn't exist, or the clone didn't finish
+			shutil.rmtree(mirror_path, ignore_errors=True)
+
+			repo = git.Repo.clone_from(url, mirror_path, progress=progress, mirror=True)
+		else:
+			repo = git.Repo(mirror_path)
+			repo.git.fetch("--prune", "origin")
+
+		self._set_last_fetch_time(mirror_path)
+
+		return repo
+
+	def _refresh_mirror(self, url: str, mirror_path: str, progress=None):
+		# Must be called while holding the mirror's lock. Unlike '_update_mirror', a failed fetch
+		# isn't fatal if there is already a mirror, since it might have what the simulation needs.
+		try:
+			return self._update_mirror(url, mirror_path, progress)
+		except git.GitCommandError as e:
+			if not os.path.isfile(os.path.join(mirror_path, LAST_FETCH_FILE)):
+				raise
+
+			print(f"Could not fetch '{url}', using the cached mirror instead: {e}")
+
+			return git.Repo(mirror_path)
+
+	def _resolve_commit(self, repo, ref: str):
+		try:
+			return repo.git.rev_parse("--verify", "--quiet", f"{ref}^{{commit}}")
+		except git.GitCommandError:
+			return None
+
+	def checkout(self, url: str, ref: str, progress=None):
+		"""
+		Returns the path of a checkout of 'ref' (a branch, tag or commit) from the repository at
+		'url', and the commit that was checked out. The repository is only fetched if the mirror is
+		stale, or if it doesn't contain 'ref'. If a stale mirror can't be fetched, the mirror is used
+		as it is.
+		"""
+		# Neither of these should ever be mistaken for a command line option
+		if url.startswith("-") or ref.startswith("-"):
+			raise ValueError(f"Invalid backend repository: '{url}' @ '{ref}'")
+
+		mirror_path = self.get_mirror_path(url)
+
+		with self._get_mirror_lock(mirror_path):
+			is_fresh = time.time() - self._get_last_fetch_time(mirror_path) < self.max_age
+
+			if is_fresh:
+				repo = git.Repo(mirror_path)
+			else:
+				repo = self._refresh_mirror(url, mirror_path, progress)
+
+			commit = self._resolve_commit(repo, ref)
+
+			# The ref might have been created (or the branch might have been moved) since the last fetch
+			if commit is None and is_fresh:
+				repo = self._update_mirror(url, mirror_path, progress)
+				commit = self._resolve_commit(repo, ref)
+
+			if commit is None:
+				raise ValueError(f"'{ref}' does not exist in '{url}'")
+
+			worktree_path = self.get_worktree_path(commit)
+
+			# Worktrees are shared by every mirror, so two mirrors could try to create the same one.
+			# Worktrees are only ever created for a full commit hash, so an existing one is always
+			# up to date.
+			with self.lock:
+				if not os.path.isfile(os.path.join(worktree_path, ".git")):
+					shutil.rmtree(worktree_path, ignore_errors=True)
+
+					# Removes the records of worktrees that don't exist anymore
+					repo.git.worktree("prune")
+					repo.git.worktree("add", "--detach", worktree_path, commit)
+
+		return worktree_path, commit
+
+global__backend_cache = None
+global__backend_cache_lock = threading.Lock()
+
+def get_backend_cache():
+	global global__backend_cache
+	global global__backend_cache_lock
+
+	with global__backend_cache_lock:
+		if global__backend_cache is None:
+			root_path = os.path.join(sv_archiver.get_save_archiver().archive_root, BACKEND_CACHE_DIR)
+			max_age = getattr(settings, "SIMULATION_BACKEND_CACHE_MAX_AGE", BACKEND_CACHE_MAX_AGE)
+
+			global__backend_cache = BackendCache(root_path, max_age)
+
+	return global__backend_cache
@@ -1,3 +1,5 @@
+import multiprocessing as mp
+import multiprocessing.connection as mp_connection
 import threading
 import queue
 import traceback
@@ -7,82 +9,110 @@ from enum import Enum
 class PipeEndpointSignal(Enum):
 	# Sent when one endpoint wants to tell the other that it was been closed
 	CLOSE_NOTIFICATION = 1
-	# Sent when one endpoint wants to tell the other that it has received the close 
+	# Sent when one endpoint wants to tell the other that it has received the close
 	# notification and has closed iteself successfully
 	CLOSE_CONFIRMATION = 2
 
-# Used to send and receive messages accross a pipe. You cannot read and write to the
-# same 'Connection' object returned by 'mp.Pipe()' at the same time. This means that
-# you cannot have a listener thread that's always receiving data from the pipe, and also
-# send data over the pipe from other threads. We could have used two pipes, or a'mp.Queue',
-# but they both seem like inefficient solutions.
+# Used to send and receive messages accross a pipe. Two threads must never read from (or write to)
+# the same 'Connection' object returned by 'mp.Pipe()' at the same time, otherwise the messages get
+# corrupted. We could have used two pipes, or a'mp.Queue', but they both seem like inefficient solutions.
 #
-# 'DuplexPipeEndpoint' allows you to both read and write at the same time using only one pipe.
-# Instead of waiting for messages to be received constantly, it will do so periodically. This
-# way, it can send messages down the pipe without there being a chance of data corruption
+# 'DuplexPipeEndpoint' allows you to both read and write at the same time using only one pipe. It has
+# a reader thread, which is the only thread that receives from the pipe, and a writer thread, which
+# is the only thread that sends to it ('Connection.send' already frames every message). Both threads
+# sleep until there is something to do: the reader waits for the pipe (or for the endpoint to stop)
+# with 'mp.connection.wait', and the writer waits for the message queue.
+#
+# NOTE: The endpoint used to do both on a single thread that polled the pipe every 100 ms.
+# Apart from the delay, that could deadlock: if both sides were sending more than the pipe can hold,
+# neither of them would read from the pipe again.
 class DuplexPipeEndpoint:
-	def __init__(self, conn, receive_callback, close_callback=None, poll_period=0.1):
+	def __init__(self, conn, receive_callback, close_callback=None):
 		self.connection = conn
 		self.receive_callback = receive_callback
 		self.close_callback = close_callback
 
 		self.msg_queue = queue.Queue()
-		self.poll_period = poll_period
 
-		self.auto_shutdown = False
+		# Wakes the reader thread up when the endpoint is stopped
+		self.stop_reader, self.stop_writer = mp.Pipe(duplex=False)
+
 		self.running = False
 		self.thread = threading.Thread(target=self.run)
-		self.queue_cond = threading.Condition()
+		self.reader_thread = threading.Thread(target=self.run_reader)
 
 		self.close_confirmed = False
 		self.shutdown_cond = threading.Condition()
 
 	def run(self):
 		while self.running:
-			# Wait for either the queue to not be empty or until the timeout expires
-			def wait_predicate():
-				return not self.msg_queue.empty()
+			item = self.msg_queue.get()
 
-			self.queue_cond.acquire()
-			self.queue_cond.wait_for(wait_predicate, timeout=self.poll_period)
+			if not self.running:
+				break
 
 			try:
-				# Receive items
-				while self.connection.poll():
-					item = self.connection.recv()
-					self.receive_message(item)
-
-				# Send items
-				while not self.msg_queue.empty():
-					item = self.msg_queue.get()
-					self.connection.send(item)
+				self.connection.send(item)
 
-					self.msg_queue.task_done()
-
-				# We want to send the close notification
-				if self.auto_shutdown:
-					self.connection.send(PipeEndpointSignal.CLOSE_CONFIRMATION)
+				# We have told the other endpoint that we have closed
+				if item is PipeEndpointSignal.CLOSE_CONFIRMATION:
 					self.running = False
-			except BrokenPipeError as e:
+			except (BrokenPipeError, ConnectionError) as e:
 				print(traceback.format_exc())
 				print("Shutting down pipe endpoint because of exception")
 				self.running = False
 			except Exception as e:
 				print(traceback.format_exc())
 
-			self.queue_cond.release()
+		self._stop()
+		self.reader_thread.join()
+
+		self.stop_reader.close()
+		self.stop_writer.close()
 
 		if self.close_callback:
 			self.close_callback()
 
 		return
 
+	def run_reader(self):
+		while self.running:
+			ready = mp_connection.wait([ self.connection, self.stop_reader ])
+
+			if self.stop_reader in ready:
+				break
+
+			try:
+				item = self.connection.recv()
+				self.receive_message(item)
+			except (EOFError, ConnectionError) as e:
+				print(traceback.format_exc())
+				print("Shutting down pipe endpoint because of exception")
+				break
+			except Exception as e:
+				print(traceback.format_exc())
+
+		self._stop()
+
+	def _stop(self):
+		self.running = False
+
+		# 'None' wakes the writer thread up, since it is never sent
+		self.msg_queue.put(None)
+
+		try:
+			self.stop_writer.send_bytes(b"\0")
+		except OSError:
+			# The endpoint has already been stopped and the pipe has been closed
+			pass
+
 	def start(self):
 		self.running = True
 		self.thread.start()
-	
+		self.reader_thread.start()
+
 	def close(self):
-		if not self.running:
+		if not self.thread.is_alive():
 			return
 
 		# NOTE(Jason): I don't think we should wait for the message queue to be
@@ -90,14 +120,14 @@ class DuplexPipeEndpoint:
 		# processing any more messages anyway
 		# self.msg_queue.join()
 
-		self.running = False
+		self._stop()
 		self.thread.join()
 
 	# Use this to gracefully close both endpoints of the pipe
 	def shutdown(self, block_timeout=1.0):
 		if not self.running:
 			return
-		
+
 		self.send_item(PipeEndpointSignal.CLOSE_NOTIFICATION)
 
 		def wait_predicate():
@@ -113,14 +143,14 @@ class DuplexPipeEndpoint:
 		if not self.running:
 			return
 
-		with self.queue_cond:
-			self.msg_queue.put(item)
-			self.queue_cond.notify_all()
+		self.msg_queue.put(item)
 
 	def receive_message(self, msg):
 		if isinstance(msg, PipeEndpointSignal):
 			if msg == PipeEndpointSignal.CLOSE_NOTIFICATION:
-				self.auto_shutdown = True
+				# The confirmation is queued after everything that we were already going to send,
+				# and the writer thread stops once it has been sent
+				self.msg_queue.put(PipeEndpointSignal.CLOSE_CONFIRMATION)
 			elif msg == PipeEndpointSignal.CLOSE_CONFIRMATION:
 				with self.shutdown_cond:
 					self.close_confirmed = True
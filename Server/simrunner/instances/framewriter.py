@@ -0,0 +1,90 @@
+import threading
+import traceback
+import queue
+
+# Compressing frames and writing them to disk can take almost as long as taking a step in the
+# simulation, so instead of doing everything on the simulation thread, the simulation only takes
+# a snapshot of each frame and hands it to a writer thread. The writer thread packs the frames,
+# appends them to the frame containers and the frame log and then notifies the server (by passing
+# the new frame log entry and the snapshot to 'on_frame_written').
+#
+# Frames are written in the order in which they were captured (delta-encoded viz frames depend on
+# that), so there is a single writer thread. The queue is bounded, which means that if the writer
+# falls behind, the simulation will wait for it instead of filling up memory with snapshots.
+DEFAULT_MAX_PENDING_FRAMES = 4
+
+class FrameWriterPipeline:
+	def __init__(self, backend, index_writer, on_frame_written, stats_writer=None, max_pending=DEFAULT_MAX_PENDING_FRAMES):
+		self.backend = backend
+		self.index_writer = index_writer
+		self.stats_writer = stats_writer
+		self.on_frame_written = on_frame_written
+
+		self.queue = queue.Queue(maxsize=max(max_pending, 1))
+		self.error = None
+
+		self.thread = threading.Thread(target=self._writer_thread, daemon=True)
+		self.thread.start()
+
+	def submit(self, snapshot):
+		"""
+		Queues a snapshot (see 'SimulationBackend.capture_frame') to be written. Blocks while the
+		queue is full. If the writer thread has failed, the exception is re-raised here, so that
+		the simulation loop shuts down the same way it would if the write happened on its thread.
+		"""
+		self._raise_writer_error()
+		self.queue.put(snapshot)
+
+	def close(self):
+		"""
+		Waits until every queued snapshot has been written and stops the writer thread. This has
+		to be called before the backend is shut down, since the backend owns the frame containers.
+		"""
+		if self.thread is None:
+			return
+
+		self.queue.put(None)
+		self.thread.join()
+		self.thread = None
+
+		self._raise_writer_error()
+
+	def _raise_writer_error(self):
+		if not self.error is None:
+			error = self.error
+			self.error = None
+
+			raise error
+
+	def _writer_thread(self):
+		while True:
+			snapshot = self.queue.get()
+
+			if snapshot is None:
+				break
+
+			# NOTE: Once a frame fails to write, every frame after it is dropped (but we still
+			# need to take them out of the queue, otherwise 'submit' could block forever)
+			if not self.error is None:
+				continue
+
+			try:
+				step_frame, viz_frame = self.backend.write_frame(snapshot)
+				entry = self.index_writer.add_entry(step_frame, viz_frame)
+
+				if not self.stats_writer is None:
+					self._write_summary(entry["index"], snapshot)
+
+				self.on_frame_written(entry, snapshot)
+			except Exception as e:
+				self.error = e
+
+	def _write_summary(self, frame_index, snapshot):
+		# The summaries are only informational, so failing to compute one shouldn't stop the simulation
+		try:
+			summary = self.backend.summarize_frame(snapshot)
+
+			if not summary is None:
+				self.stats_writer.add_entry(frame_index, summary)
+		except Exception:
+			traceback.print_exc()
@@ -1,9 +1,12 @@
 import threading
+import traceback
 import git
 
 from simrunner import websocket_groups as wsgroups
 
 from .siminstance import ClientAction, ClientMessage
+from .scheduler import get_simulation_scheduler
+from .backendcache import get_backend_cache
 
 # NOTE(Jason): Yes, I know that globals are considered bad practice, but I couldn't find another way to do it.
 # This isn't "just some data that you can save in a database", so all solutions that invlove persistent
@@ -13,6 +16,10 @@ from .siminstance import ClientAction, ClientMessage
 global__active_instances = {}
 global__instance_lock = threading.Lock()
 
+# Simulations that were killed after they were reserved, but before they were spawned (e.g. while
+# their backend was being checked out). They are never spawned (see 'spawn_simulation').
+global__cancelled_simulations = set()
+
 class CloneProgress(git.remote.RemoteProgress):
 	def __init__(self, uuid: str):
 		super().__init__()
@@ -23,43 +30,91 @@ class CloneProgress(git.remote.RemoteProgress):
 		wsgroups.send_message_to_websocket_group(f"simcomms/{self.sim_uuid}", ClientMessage(ClientAction.INFO_LOG, self._cur_line))
 
 def spawn_simulation(uuid: str, proc_class: type, proc_args: tuple=None, should_create_ws_group: bool=True):
+	"""
+	Creates the simulation's instance. Returns 'False' if the simulation was killed before it could
+	be spawned, in which case nothing is started.
+	"""
 	global global__active_instances
+	global global__cancelled_simulations
 	global global__instance_lock
 
 	if should_create_ws_group:
 		wsgroups.create_websocket_group(f"simcomms/{uuid}")
 
 	with global__instance_lock:
-		if proc_args is None:
+		is_cancelled = uuid in global__cancelled_simulations
+
+		if is_cancelled:
+			global__cancelled_simulations.discard(uuid)
+		elif proc_args is None:
 			global__active_instances[uuid] = proc_class()
 		else:
 			global__active_instances[uuid] = proc_class(*proc_args)
 
-	return
+	if is_cancelled:
+		print(f"[SIMULATION RUNNER]: Simulation was killed before it started: {uuid}")
+
+		wsgroups.close_websocket_group(f"simcomms/{uuid}")
+		get_simulation_scheduler().release(uuid)
+
+		return False
+
+	# Custom backends are checked out before the simulation is spawned, so this is the first point
+	# where every simulation is actually running
+	wsgroups.send_message_to_websocket_group(f"simcomms/{uuid}", ClientMessage(ClientAction.SIM_STARTED, None))
+
+	return True
 
 def __spawn_deferred(uuid: str, backend_args, proc_class: type, proc_args: tuple=None):
-	backend_url, backend_branch, backend_dir = backend_args
+	global global__cancelled_simulations
+	global global__instance_lock
 
-	print(f"[SIMULATION RUNNER]: Cloning repository ({backend_url} @ {backend_branch}) for simulation: {uuid}")
+	backend_url, backend_branch, backend_params = backend_args
+
+	print(f"[SIMULATION RUNNER]: Checking out repository ({backend_url} @ {backend_branch}) for simulation: {uuid}")
 	
 	try:
-		git.Repo.clone_from(backend_url, backend_dir, branch=backend_branch, progress=CloneProgress(uuid))
+		# The repository is only cloned (or fetched) if the backend cache doesn't have an up to date
+		# copy of it, and simulations that use the same commit share the same checkout
+		backend_params.backend_dir, commit = get_backend_cache().checkout(backend_url, backend_branch, progress=CloneProgress(uuid))
 	except Exception as e:
-		print(f"[SIMULATION RUNNER]: Failed to close repository for: {uuid}")
+		print(f"[SIMULATION RUNNER]: Failed to check out repository for: {uuid}")
 
 		message = "===== Clone Error =====\n" + str(e)
 		wsgroups.send_message_to_websocket_group(f"simcomms/{uuid}", ClientMessage(ClientAction.INFO_LOG, message))
 		wsgroups.send_message_to_websocket_group(f"simcomms/{uuid}", ClientMessage(ClientAction.CLOSE_INFO_LOG, None))
+
+		# The simulation is never going to start, so its place can be given to another one
+		get_simulation_scheduler().release(uuid)
+
+		with global__instance_lock:
+			global__cancelled_simulations.discard(uuid)
 	else:
-		print(f"[SIMULATION RUNNER]: Completed cloning for simulation: {uuid}")
+		print(f"[SIMULATION RUNNER]: Completed checkout of {commit} for simulation: {uuid}")
+
+		wsgroups.send_message_to_websocket_group(f"simcomms/{uuid}", ClientMessage(ClientAction.INFO_LOG, f"Using backend commit {commit}"))
+
+		# The scheduler can't catch this one, since it happens after 'start_func' has returned. If the
+		# simulation was killed during the checkout, it isn't spawned at all.
+		try:
+			spawn_simulation(uuid, proc_class, proc_args, False)
+		except Exception:
+			print(f"[SIMULATION RUNNER]: Failed to start simulation: {uuid}")
+			traceback.print_exc()
+
+			get_simulation_scheduler().release(uuid)
 
-		spawn_simulation(uuid, proc_class, proc_args, False)
 		wsgroups.send_message_to_websocket_group(f"simcomms/{uuid}", ClientMessage(ClientAction.CLOSE_INFO_LOG, None))
 
 	return
 
-def spawn_simulation_from_branch(uuid: str, backend_url, backend_branch, backend_dir, proc_class: type, proc_args: tuple=None):
-	backend_args = (backend_url, backend_branch, backend_dir)
+def reserve_simulation(uuid: str):
+	"""
+	Marks a simulation as active before its instance has been created (e.g. while it is waiting in
+	the scheduler's queue), so clients can connect to it.
+	"""
+	global global__active_instances
+	global global__instance_lock
 
 	# There needs to be an entry in global__active_instances so that the manager can
 	# detect that the simulation is active, even if the entry is None
@@ -68,23 +123,49 @@ def spawn_simulation_from_branch(uuid: str, backend_url, backend_branch, backend
 
 	wsgroups.create_websocket_group(f"simcomms/{uuid}")
 
+def spawn_simulation_from_branch(uuid: str, backend_url, backend_branch, backend_params, proc_class: type, proc_args: tuple=None, should_create_ws_group: bool=True):
+	"""
+	Checks out the backend (a branch, tag or commit of the repository at 'backend_url') on another
+	thread and then starts the simulation. 'backend_params.backend_dir' is set to the checkout.
+	"""
+	backend_args = (backend_url, backend_branch, backend_params)
+
+	if should_create_ws_group:
+		reserve_simulation(uuid)
+
 	threading.Thread(target=__spawn_deferred, args=(uuid, backend_args, proc_class, proc_args), daemon=True).start()
 
 def kill_simulation(uuid: str, remove_only=False):
 	global global__active_instances
+	global global__cancelled_simulations
 	global global__instance_lock
 
 	with global__instance_lock:
+		# Reserved simulations don't have an instance yet (see 'reserve_simulation')
+		is_reserved = (uuid in global__active_instances) and (global__active_instances[uuid] is None)
 		sim_instance = global__active_instances.pop(uuid, None)
 
-		if sim_instance is None:
-			return False
-		
-		if not remove_only:
+		if is_reserved:
+			global__cancelled_simulations.add(uuid)
+		elif (not sim_instance is None) and (not remove_only):
 			print(f"[Simulation Runner]: Stopping simulation '{uuid}'")
 
 			sim_instance.close()
 
+	if is_reserved:
+		scheduler = get_simulation_scheduler()
+
+		# The simulation might still be waiting in the scheduler's queue, in which case it will never
+		# get to 'spawn_simulation'. Otherwise, it is about to be spawned (or its backend is being
+		# checked out), and its cores can be given to the next simulation right away.
+		if scheduler.cancel(uuid):
+			with global__instance_lock:
+				global__cancelled_simulations.discard(uuid)
+		else:
+			scheduler.release(uuid)
+	elif sim_instance is None:
+		return False
+
 	wsgroups.close_websocket_group(f"simcomms/{uuid}")
 
 	return True
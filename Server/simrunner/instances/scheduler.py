@@ -0,0 +1,288 @@
+import threading
+import itertools
+import traceback
+import heapq
+import os
+
+from django.conf import settings
+
+from simrunner import websocket_groups as wsgroups
+
+from .siminstance import ClientAction, ClientMessage
+
+# Simulations used to be started as soon as they were created, so a handful of users starting
+# simulations at the same time would oversubscribe the machine and slow every one of them down.
+# The scheduler only lets a limited number of simulations run at once. The others wait in a queue
+# (the viewers of a queued simulation are told where it is in the queue) and are started when a
+# running simulation closes.
+#
+# Every running simulation is given its own set of cores. The simulation process pins all of its
+# threads to them and limits the number of threads that OpenMP, BLAS and OpenCL (pocl) use to the
+# number of cores (see 'apply_core_placement').
+#
+# The scheduler is configured with these settings (see 'VizToolServer/settings.py'):
+#	SIMULATION_MAX_RUNNING: number of simulations that can run at once (None runs one simulation
+#		per set of cores)
+#	SIMULATION_CORES_PER_INSTANCE: number of cores that each simulation gets
+#	SIMULATION_PIN_CORES: whether simulations are pinned to their cores
+#	SIMULATION_QUEUE_POLICY: "fifo" starts simulations in the order that they were created,
+#		"priority" starts the ones with the highest priority first (and is FIFO otherwise)
+SCHEDULER_MAX_RUNNING = None
+SCHEDULER_CORES_PER_INSTANCE = 2
+SCHEDULER_PIN_CORES = True
+SCHEDULER_QUEUE_POLICY = "fifo"
+
+# Environment variables that limit the number of threads used by the libraries that a simulation
+# might use. They only affect libraries that start their threads after the variables are set.
+THREAD_COUNT_VARIABLES = [ "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS", "POCL_MAX_PTHREAD_COUNT" ]
+
+# BLAS and OpenMP are loaded (by NumPy and the backends) long before a simulation is started, and
+# pooled workers load them before they know which simulation they will run, so the variables above
+# come too late for them. If threadpoolctl is installed, their thread pools are limited at runtime.
+try:
+	from threadpoolctl import threadpool_limits
+except ImportError:
+	threadpool_limits = None
+
+def get_available_cores():
+	if hasattr(os, "sched_getaffinity"):
+		return sorted(os.sched_getaffinity(0))
+
+	return list(range(os.cpu_count() or 1))
+
+def split_cores(cores, cores_per_set):
+	"""
+	Splits the cores into sets of 'cores_per_set' cores. Cores that are left over aren't used. If
+	there aren't enough cores for a single set, every core goes into one set.
+	"""
+	if len(cores) <= cores_per_set:
+		return [ tuple(cores) ]
+
+	return [ tuple(cores[it:it + cores_per_set]) for it in range(0, len(cores) - cores_per_set + 1, cores_per_set) ]
+
+class CorePlacement:
+	"""
+	What 'apply_core_placement' changed, so that 'restore_core_placement' can undo it.
+	"""
+	def __init__(self):
+		self.previous_cores = None
+		self.previous_variables = {}
+		self.thread_limits = None
+
+def _get_thread_ids():
+	# Every thread of the process, including the ones that libraries started on their own
+	try:
+		return [ int(name) for name in os.listdir("/proc/self/task") ]
+	except OSError:
+		return [ 0 ]
+
+def _set_process_affinity(cores):
+	for thread_id in _get_thread_ids():
+		try:
+			os.sched_setaffinity(thread_id, cores)
+		except OSError:
+			# The thread has exited since the list was read
+			pass
+
+def apply_core_placement(params):
+	"""
+	Pins every thread of the process (and the threads that are started from now on) to the
+	simulation's cores and limits the number of threads that OpenMP, BLAS and OpenCL use. Returns
+	a 'CorePlacement' that should be passed to 'restore_core_placement' once the simulation is over.
+	"""
+	placement = CorePlacement()
+
+	if (not params.cpu_cores is None) and hasattr(os, "sched_setaffinity"):
+		try:
+			placement.previous_cores = os.sched_getaffinity(0)
+			_set_process_affinity(params.cpu_cores)
+		except OSError:
+			traceback.print_exc()
+			placement.previous_cores = None
+
+	if not params.thread_count is None:
+		for name in THREAD_COUNT_VARIABLES:
+			placement.previous_variables[name] = os.environ.get(name, None)
+			os.environ[name] = str(params.thread_count)
+
+		if not threadpool_limits is None:
+			try:
+				placement.thread_limits = threadpool_limits(limits=params.thread_count)
+			except Exception:
+				traceback.print_exc()
+
+	return placement
+
+def restore_core_placement(placement):
+	if not placement.thread_limits is None:
+		placement.thread_limits.restore_original_limits()
+
+	for name, value in placement.previous_variables.items():
+		if value is None:
+			os.environ.pop(name, None)
+		else:
+			os.environ[name] = value
+
+	if not placement.previous_cores is None:
+		_set_process_affinity(placement.previous_cores)
+
+class QueuedSimulation:
+	def __init__(self, uuid: str, params, start_func, priority: int, sequence: int):
+		self.uuid = uuid
+		self.params = params
+		self.start_func = start_func
+		self.priority = priority
+		self.sequence = sequence
+
+	def __lt__(self, other):
+		# Higher priorities go first, and simulations with the same priority are started in the
+		# order that they were queued
+		return (-self.priority, self.sequence) < (-other.priority, other.sequence)
+
+class SimulationScheduler:
+	def __init__(self, max_running=SCHEDULER_MAX_RUNNING, cores_per_instance=SCHEDULER_CORES_PER_INSTANCE, pin_cores=SCHEDULER_PIN_CORES, queue_policy=SCHEDULER_QUEUE_POLICY):
+		if not queue_policy in [ "fifo", "priority" ]:
+			raise ValueError(f"Unknown simulation queue policy: '{queue_policy}'")
+
+		self.cores_per_instance = max(1, cores_per_instance)
+		self.core_sets = split_cores(get_available_cores(), self.cores_per_instance)
+
+		self.max_running = max(1, max_running if not max_running is None else len(self.core_sets))
+		self.pin_cores = pin_cores
+		self.queue_policy = queue_policy
+
+		self.lock = threading.Lock()
+
+		self.queue = []
+		self.sequence = itertools.count()
+
+		# Maps the UUID of every running simulation to the index of its core set (or 'None' if
+		# there weren't any free core sets)
+		self.running = {}
+		self.free_core_sets = list(range(len(self.core_sets)))
+
+	def submit(self, uuid: str, params, start_func, priority: int=0):
+		"""
+		Starts the simulation (by calling 'start_func') if there is room for it, otherwise queues it.
+		The core placement is stored in 'params' before the simulation is started. The viewers are
+		told that the simulation started by 'manager.spawn_simulation', since 'start_func' might only
+		start checking out the simulation's backend.
+		"""
+		if self.queue_policy == "fifo":
+			priority = 0
+
+		entry = QueuedSimulation(uuid, params, start_func, priority, next(self.sequence))
+
+		with self.lock:
+			if len(self.running) < self.max_running:
+				core_set = self._reserve(uuid)
+			else:
+				heapq.heappush(self.queue, entry)
+				entry = None
+
+		if entry is None:
+			self._report_queue_positions()
+		else:
+			self._start(entry, core_set)
+
+	def release(self, uuid: str):
+		"""
+		Frees the resources of a simulation that has closed and starts the simulations that were
+		waiting for them. Does nothing if the simulation wasn't started by the scheduler.
+		"""
+		started = []
+
+		with self.lock:
+			if not uuid in self.running:
+				return
+
+			core_set = self.running.pop(uuid)
+
+			if not core_set is None:
+				self.free_core_sets.append(core_set)
+
+			while len(self.queue) > 0 and len(self.running) < self.max_running:
+				entry = heapq.heappop(self.queue)
+				started.append((entry, self._reserve(entry.uuid)))
+
+		for entry, core_set in started:
+			self._start(entry, core_set)
+
+		if len(started) > 0:
+			self._report_queue_positions()
+
+	def cancel(self, uuid: str):
+		"""
+		Removes a simulation from the queue. Returns 'False' if it wasn't queued.
+		"""
+		with self.lock:
+			remaining = [ entry for entry in self.queue if not entry.uuid == uuid ]
+
+			if len(remaining) == len(self.queue):
+				return False
+
+			heapq.heapify(remaining)
+			self.queue = remaining
+
+		self._report_queue_positions()
+
+		return True
+
+	def get_queue_position(self, uuid: str):
+		"""
+		Returns the position (starting at 1) of a simulation in the queue, or 'None' if it isn't queued.
+		"""
+		with self.lock:
+			for position, entry in enumerate(sorted(self.queue)):
+				if entry.uuid == uuid:
+					return position + 1
+
+		return None
+
+	def _reserve(self, uuid: str):
+		# Must be called while holding the lock
+		core_set = None
+
+		if self.pin_cores and len(self.free_core_sets) > 0:
+			core_set = self.free_core_sets.pop(0)
+
+		self.running[uuid] = core_set
+
+		return core_set
+
+	def _start(self, entry, core_set):
+		entry.params.cpu_cores = None if core_set is None else self.core_sets[core_set]
+		entry.params.thread_count = self.cores_per_instance if core_set is None else len(self.core_sets[core_set])
+
+		try:
+			entry.start_func()
+		except Exception:
+			print(f"[SIMULATION SCHEDULER]: Failed to start simulation: {entry.uuid}")
+			traceback.print_exc()
+
+			self.release(entry.uuid)
+
+	def _report_queue_positions(self):
+		with self.lock:
+			queue = sorted(self.queue)
+
+		for position, entry in enumerate(queue):
+			data = { "position": position + 1, "queueLength": len(queue) }
+			wsgroups.send_message_to_websocket_group(f"simcomms/{entry.uuid}", ClientMessage(ClientAction.SIM_QUEUED, data))
+
+global__simulation_scheduler = None
+global__simulation_scheduler_lock = threading.Lock()
+
+def get_simulation_scheduler():
+	global global__simulation_scheduler
+	global global__simulation_scheduler_lock
+
+	with global__simulation_scheduler_lock:
+		if global__simulation_scheduler is None:
+			global__simulation_scheduler = SimulationScheduler(
+				getattr(settings, "SIMULATION_MAX_RUNNING", SCHEDULER_MAX_RUNNING),
+				getattr(settings, "SIMULATION_CORES_PER_INSTANCE", SCHEDULER_CORES_PER_INSTANCE),
+				getattr(settings, "SIMULATION_PIN_CORES", SCHEDULER_PIN_CORES),
+				getattr(settings, "SIMULATION_QUEUE_POLICY", SCHEDULER_QUEUE_POLICY))
+
+	return global__simulation_scheduler
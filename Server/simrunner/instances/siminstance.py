@@ -1,7 +1,12 @@
 import json
+import struct
+import traceback
 from enum import Enum
 
 from saveviewer import archiver as sv_archiver
+from saveviewer.executor import get_frame_executor
+from saveviewer.framering import get_frame_ring
+from saveviewer.frames import read_deflated_viz_frame
 from simrunner import websocket_groups as wsgroups
 
 class InstanceAction(Enum):
@@ -27,11 +32,43 @@ class ClientAction(Enum):
 
 	RELOAD_DONE = 7
 
+	SIM_QUEUED = 8
+	SIM_STARTED = 9
+
+CLIENT_ACTION_NAMES = {
+	ClientAction.NEW_FRAME: "newframe",
+	ClientAction.SIM_HEADER: "simheader",
+	ClientAction.ERROR_MESSAGE: "error_message",
+	ClientAction.INFO_LOG: "infolog",
+	ClientAction.CLOSE_INFO_LOG: "closeinfolog",
+	ClientAction.RELOAD_DONE: "reloaddone",
+	ClientAction.SIM_STOPPED: "simstopped",
+	ClientAction.SIM_QUEUED: "simqueued",
+	ClientAction.SIM_STARTED: "simstarted",
+}
+
 class ClientMessage:
 	def __init__(self, action: ClientAction, data=None):
 		self.action = action
 		self.data = data
 
+		self.encoded = None
+
+	def encode(self):
+		"""
+		Returns the JSON text that is sent to the clients. A message that is sent to a whole group
+		is only encoded once.
+		"""
+		if self.encoded is None:
+			data = {} if self.data is None else self.data
+			self.encoded = json.dumps({ "action": CLIENT_ACTION_NAMES[self.action], "data": data })
+
+		return self.encoded
+
+# Clients that subscribe to frames get every new viz frame as a binary message: the frame's index
+# and the number of frames in the simulation (both uint32), followed by the frame as a zlib stream
+FRAME_PUSH_HEADER = struct.Struct("<II")
+
 class ISimulationInstance:
 	def __init__(self, uuid):
 		self.is_alive = True
@@ -43,6 +80,31 @@ class ISimulationInstance:
 	def send_item_to_clients(self, item):
 		wsgroups.send_message_to_websocket_group(f"simcomms/{self.uuid}", item)
 
+	def push_frame_to_clients(self, frame_index, frame_count, ring_sequence=None):
+		group_name = f"simcomms/{self.uuid}"
+
+		if not wsgroups.has_frame_subscribers(group_name):
+			return
+
+		# The frame is read once for all of the subscribers. This happens on the frame executor,
+		# since this is called from the thread that receives messages from the simulation.
+		def push_frame():
+			try:
+				ring = get_frame_ring(self.uuid)
+				data = ring.read_frame(ring_sequence) if not ring is None else None
+
+				# The frame wasn't in shared memory (or it has already been overwritten)
+				if data is None:
+					data = read_deflated_viz_frame(str(self.uuid), frame_index)
+
+				message = FRAME_PUSH_HEADER.pack(frame_index, frame_count) + data
+
+				wsgroups.push_frame_to_websocket_group(group_name, frame_index, message)
+			except Exception:
+				traceback.print_exc()
+
+		get_frame_executor().submit(push_frame)
+
 	def process_message_from_instance(self, message):
 		if not isinstance(message, InstanceMessage):
 			return
@@ -50,17 +112,22 @@ class ISimulationInstance:
 		# Process the message from the child process and make
 		# the message that will be sent to the clients
 		if message.action == InstanceAction.NEW_FRAME:
-			new_step_data = json.loads(message.data["new_data"])
 			frame_count = message.data["frame_count"]
+			entry = message.data["entry"]
 
-			sv_archiver.get_save_archiver().update_step_data(str(self.params.uuid), new_step_data)
+			sv_archiver.get_save_archiver().update_step_data(str(self.params.uuid), [ entry ])
 
 			self.send_item_to_instance(InstanceMessage(InstanceAction.STEP_FILE_ADDED, None))
 
 			self.send_item_to_clients(ClientMessage(ClientAction.NEW_FRAME, { "frameCount": frame_count }))
+			self.push_frame_to_clients(entry["index"], entry["index"] + 1, message.data.get("ring_sequence", None))
 		elif message.action == InstanceAction.ERROR_MESSAGE:
 			self.send_item_to_clients(ClientMessage(ClientAction.ERROR_MESSAGE, str(message.data)))
 		elif message.action == InstanceAction.CLOSE:
+			# Every frame has been written by now. If any of the frame messages got lost, the
+			# archive catches up with the frame log here.
+			sv_archiver.get_save_archiver().resync_step_data(str(self.params.uuid))
+
 			self.close()
 
 	def close(self):
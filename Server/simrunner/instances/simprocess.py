@@ -3,6 +3,9 @@ import traceback
 import sys, os
 
 from .duplex_pipe_endpoint import DuplexPipeEndpoint
+from .framewriter import FrameWriterPipeline
+from .workerpool import get_worker_pool
+from .scheduler import get_simulation_scheduler, apply_core_placement, restore_core_placement
 
 from .manager import kill_simulation
 from .siminstance import ISimulationInstance, InstanceAction, InstanceMessage
@@ -10,6 +13,8 @@ from .siminstance import ISimulationInstance, InstanceAction, InstanceMessage
 from simrunner.backends.cellmodeller4 import CellModeller4Backend
 from simrunner.backends.cellmodeller5 import CellModeller5Backend
 from saveviewer import archiver as sv_archiver
+from saveviewer.stats import StatsLogWriter
+from saveviewer.framering import FrameRingReader, FrameRingWriter, register_frame_ring, unregister_frame_ring
 
 class SimulationProcess(ISimulationInstance):
 	def __init__(self, params):
@@ -29,9 +34,31 @@ class SimulationProcess(ISimulationInstance):
 
 		self.pipes = (parent_pipe, child_pipe)
 
-		# Create a new process and start it
-		self.process = ctx.Process(target=instance_control_thread, args=(child_pipe,params), daemon=True)
-		self.process.start()
+		# The newest viz frames are passed to the server through shared memory (see 'framering')
+		self.frame_ring = FrameRingReader()
+		register_frame_ring(params.uuid, self.frame_ring)
+
+		# If one of the pre-started workers is idle, it can run the simulation straight away (see
+		# 'workerpool'). Simulations with custom backends always get a new process, since the
+		# backend is imported from the simulation's own directory.
+		self.worker = None
+
+		if type(params.backend_version) is str:
+			self.worker = get_worker_pool().acquire()
+
+		if (not self.worker is None) and (not self.worker.run_simulation(child_pipe, params, self.frame_ring.name)):
+			self.worker = None
+
+		if self.worker is None:
+			# Create a new process and start it
+			self.process = ctx.Process(target=instance_control_thread, args=(child_pipe, params, self.frame_ring.name), daemon=True)
+			self.process.start()
+		else:
+			self.process = self.worker.process
+
+		# NOTE: The child has its own copy of its end of the pipe now. If we kept ours open,
+		# we would never find out that the pipe was closed if the child process died.
+		child_pipe.close()
 
 		# We also need to create a thread to communicate with the instance process
 		self.endpoint = DuplexPipeEndpoint(parent_pipe, self.on_message_from_instance, self.on_endpoint_closed)
@@ -54,9 +81,24 @@ class SimulationProcess(ISimulationInstance):
 	def on_endpoint_closed(self):
 		kill_simulation(self.params.uuid, True)
 
+		# If the process died without sending a close message, some of its frames might not have
+		# made it into the archive
+		try:
+			sv_archiver.get_save_archiver().resync_step_data(str(self.params.uuid))
+		except Exception:
+			traceback.print_exc()
+
+		# The process isn't going to write to the ring buffer anymore (even if it died without
+		# closing it), so we can free it. Frames are read from disk from now on.
+		unregister_frame_ring(self.params.uuid)
+		self.frame_ring.close()
+
 		self.pipes[0].close()
 		self.pipes[1].close()
 
+		# The simulation's cores can be given to the next simulation in the queue
+		get_simulation_scheduler().release(str(self.params.uuid))
+
 		# I don't think joining the child process would be a good idea because it might take a long time
 		# for it to actually shutdown (when simulation steps get long)
 		# self.process.join()
@@ -75,7 +117,7 @@ class SimulationProcess(ISimulationInstance):
 
 # This is what actually runs the simulation
 # !!! It runs in a child process !!!
-def instance_control_thread(pipe, params):
+def instance_control_thread(pipe, params, frame_ring_name=None):
 	# We don't want the simulation's output to go to the output of the main process, 
 	# because that will quickly get very messy. Instead, we can redirect the print
 	# streams to a file.
@@ -90,6 +132,13 @@ def instance_control_thread(pipe, params):
 	sys.stdout = log_stream
 	sys.stderr = log_stream
 
+	# The threads that already exist are pinned as well, but this should still happen before the
+	# simulation starts any threads of its own.
+	# NOTE: The thread count variables only affect libraries that start their threads after
+	# this (e.g. pocl, which starts them when the OpenCL context is created). BLAS and OpenMP have
+	# already been loaded by the time we get here, so they are limited through threadpoolctl.
+	core_placement = apply_core_placement(params)
+
 	# Create pipe endpoint
 	out_stream.write(f"[INSTANCE PROCESS]: Creating instance process\n")
 
@@ -118,6 +167,14 @@ def instance_control_thread(pipe, params):
 	endpoint = DuplexPipeEndpoint(pipe, got_user_message, endpoint_callback)
 	endpoint.start()
 
+	backend = None
+	index_writer = None
+	stats_writer = None
+	writer_pipeline = None
+	frame_ring = None
+
+	abrupt = False
+
 	# This is more of a "sanity try-catch". It is here to make sure that
 	# if any exceptions occur, we still properly clean up the simulation instance
 	try:
@@ -128,20 +185,34 @@ def instance_control_thread(pipe, params):
 
 		backend.initialize()
 
+		# Its better if we update the index file from the simulation process because, otherwise,
+		# some message might get lost when closing the pipe and some step files might not get added
+		# to the index file
+		index_writer = sv_archiver.SimIndexWriter(params.sim_root_dir)
+		stats_writer = StatsLogWriter(params.sim_root_dir)
+
+		if not frame_ring_name is None:
+			frame_ring = FrameRingWriter(frame_ring_name)
+
+		# Only the new frame's entry is sent to the server (see 'SaveArchiver.update_step_data'). The
+		# frame itself goes into the ring buffer, and the server is told where to find it.
+		def frame_written(entry, snapshot):
+			ring_sequence = None
+
+			if not frame_ring is None:
+				ring_sequence = frame_ring.write_frame(entry["index"], backend.get_wire_viz_frame(snapshot))
+
+			endpoint.send_item(InstanceMessage(InstanceAction.NEW_FRAME, { "frame_count": entry["index"], "entry": entry, "ring_sequence": ring_sequence }))
+
+		# Frames are packed and written on a separate thread, while the simulation takes the next step
+		writer_pipeline = FrameWriterPipeline(backend, index_writer, frame_written, stats_writer)
+
 		while running and backend.is_running():
 			# Take another step in the simulation
 			backend.step()
 
-			# Write step files
-			step_path, viz_bin_path = backend.write_step_files()
-
-			# Its better if we update the index file from the simulation process because, otherwise,
-			# some message might get lost when closing the pipe and some step files might not get added
-			# to the index file
-			index_path = os.path.join(params.sim_root_dir, "index.json")
-			sim_data_str, frame_count = sv_archiver.add_entry_to_sim_index(index_path, step_path, viz_bin_path)
-
-			endpoint.send_item(InstanceMessage(InstanceAction.NEW_FRAME, { "frame_count": frame_count, "new_data": sim_data_str }))
+			# Queue the step files to be written (this blocks if the writer thread is falling behind)
+			writer_pipeline.submit(backend.capture_frame())
 
 			# NOTE(Jason): The stream won't write the results to a file immediately after getting some data.
 			# If we close Django from the terminal (with Ctrl+C or Ctrl+Break), then the simulation
@@ -150,20 +221,53 @@ def instance_control_thread(pipe, params):
 			# a small amount of print output, but its better than nothing).
 			log_stream.flush()
 
-		backend.shutdown()
-
-		# Clean up instance
-		out_stream.write(f"[INSTANCE PROCESS]: Closing instance process\n")
-
-		endpoint.send_item(InstanceMessage(InstanceAction.CLOSE, { "abrupt": False }))
-		endpoint.shutdown()
+		# Write every frame that is still queued before the frame containers are closed
+		writer_pipeline.close()
 	except Exception as e:
+		abrupt = True
+
 		exc_message = traceback.format_exc()
 		out_stream.write(exc_message)
 		out_stream.write(f"[INSTANCE PROCESS]: Instance process terminated due to exception\n")
 
+		# The frames that were captured before the exception are still valid, so we should try
+		# to write them out anyway
+		if not writer_pipeline is None:
+			try:
+				writer_pipeline.close()
+			except Exception:
+				out_stream.write(traceback.format_exc())
+
 		endpoint.send_item(InstanceMessage(InstanceAction.ERROR_MESSAGE, str(exc_message)))
-		endpoint.send_item(InstanceMessage(InstanceAction.CLOSE, { "abrupt": True }))
-		endpoint.shutdown()
+	finally:
+		# The process might be a worker that runs another simulation after this one, so the frame
+		# containers and logs have to be closed even if the simulation failed
+		if not backend is None:
+			try:
+				backend.shutdown()
+			except Exception:
+				out_stream.write(traceback.format_exc())
+
+		if not index_writer is None:
+			index_writer.close()
+
+		if not stats_writer is None:
+			stats_writer.close()
+
+	# Clean up instance
+	if not abrupt:
+		out_stream.write(f"[INSTANCE PROCESS]: Closing instance process\n")
+
+	endpoint.send_item(InstanceMessage(InstanceAction.CLOSE, { "abrupt": abrupt }))
+	endpoint.shutdown()
+
+	if not frame_ring is None:
+		frame_ring.close()
+
+	# The process might be a worker that runs another simulation after this one
+	restore_core_placement(core_placement)
+
+	sys.stdout = out_stream
+	sys.stderr = err_stream
 
 	log_stream.close()
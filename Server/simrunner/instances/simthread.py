@@ -1,13 +1,14 @@
 import threading
 import traceback
-import os
 import queue
 
+from .framewriter import FrameWriterPipeline
 from .manager import kill_simulation
 from .siminstance import ISimulationInstance, InstanceAction, InstanceMessage
 
 from simrunner.backends.cellmodeller5 import CellModeller5Backend
 from saveviewer import archiver as sv_archiver
+from saveviewer.stats import StatsLogWriter
 
 class SimulationThread(ISimulationInstance):
 	def __init__(self, params):
@@ -33,10 +34,28 @@ class SimulationThread(ISimulationInstance):
 def instance_control_thread(params, msg_queue, send_func):
 	running = True
 
+	backend = None
+	index_writer = None
+	stats_writer = None
+	writer_pipeline = None
+
 	try:
 		backend = CellModeller5Backend(params)
 		backend.initialize()
 
+		# Its better if we update the index file from the simulation process because, otherwise,
+		# some message might get lost when closing the pipe and some step files might not get added
+		# to the index file
+		index_writer = sv_archiver.SimIndexWriter(params.sim_root_dir)
+		stats_writer = StatsLogWriter(params.sim_root_dir)
+
+		# Only the new frame's entry is sent to the server (see 'SaveArchiver.update_step_data')
+		def frame_written(entry, snapshot):
+			send_func(InstanceMessage(InstanceAction.NEW_FRAME, { "frame_count": entry["index"], "entry": entry }))
+
+		# Frames are packed and written on a separate thread, while the simulation takes the next step
+		writer_pipeline = FrameWriterPipeline(backend, index_writer, frame_written, stats_writer)
+
 		while running and backend.is_running():
 			# Process incoming messages
 			try:
@@ -58,19 +77,33 @@ def instance_control_thread(params, msg_queue, send_func):
 			# Take another step in the simulation
 			backend.step()
 
-			# Write step files
-			step_path, viz_bin_path = backend.write_step_files()
-
-			# Its better if we update the index file from the simulation process because, otherwise,
-			# some message might get lost when closing the pipe and some step files might not get added
-			# to the index file
-			index_path = os.path.join(params.sim_root_dir, "index.json")
-			sim_data_str, frame_count = sv_archiver.add_entry_to_sim_index(index_path, step_path, viz_bin_path)
-
-			send_func(InstanceMessage(InstanceAction.NEW_FRAME, { "frame_count": frame_count, "new_data": sim_data_str }))
+			# Queue the step files to be written (this blocks if the writer thread is falling behind)
+			writer_pipeline.submit(backend.capture_frame())
 
-		backend.shutdown()
+		# Write every frame that is still queued before the frame containers are closed
+		writer_pipeline.close()
 	except Exception as e:
 		traceback.print_exc()
 
+		# The frames that were captured before the exception are still valid, so we should try
+		# to write them out anyway
+		if not writer_pipeline is None:
+			try:
+				writer_pipeline.close()
+			except Exception:
+				traceback.print_exc()
+	finally:
+		# The frame containers and logs have to be closed even if the simulation failed
+		if not backend is None:
+			try:
+				backend.shutdown()
+			except Exception:
+				traceback.print_exc()
+
+		if not index_writer is None:
+			index_writer.close()
+
+		if not stats_writer is None:
+			stats_writer.close()
+
 	kill_simulation(params.uuid, True)
\ No newline at end of file
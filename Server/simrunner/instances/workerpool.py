@@ -0,0 +1,290 @@
+import multiprocessing as mp
+import collections
+import threading
+import traceback
+import importlib
+import gc
+import os
+
+from enum import Enum
+
+from django.conf import settings
+
+# Starting a simulation used to mean starting a new python interpreter, importing the server's
+# modules and then importing the backend (which, for CellModeller4, also imports pyopencl and
+# friends). All of that happened before the first step was taken, so the user had to wait for it
+# every time they started a simulation.
+#
+# The pool keeps a few worker processes around that have already done the imports. Starting a
+# simulation hands its 'BackendParameters' (and the pipe to the server) to an idle worker, which
+# runs 'instance_control_thread' just like a freshly spawned process would. Workers run one
+# simulation at a time and are replaced after a number of simulations, or when their memory use
+# has grown too much, since the backends don't necessarily clean up after themselves.
+#
+# The pool is configured with these settings (see 'VizToolServer/settings.py'):
+#	SIMULATION_WORKER_POOL_SIZE: number of idle workers to keep around (0 disables the pool)
+#	SIMULATION_WORKER_MAX_SIMULATIONS: number of simulations a worker runs before it is replaced
+#	SIMULATION_WORKER_MAX_MEMORY_GROWTH: bytes that a worker's memory use can grow by (compared to
+#		right after the imports) before it is replaced (0 disables the check)
+WORKER_POOL_SIZE = 2
+WORKER_MAX_SIMULATIONS = 8
+WORKER_MAX_MEMORY_GROWTH = 512 * 1024 * 1024
+
+# Modules that are imported by the workers before they are handed a simulation. The backends
+# import these on their own, so it's fine if some of them aren't installed.
+PRELOADED_BACKEND_MODULES = [ "CellModeller.Simulator", "cellmodeller5" ]
+
+class WorkerSignal(Enum):
+	# Sent when the worker has imported everything and can be given a simulation
+	READY = 1
+	# Sent when the worker has finished running a simulation
+	DONE = 2
+
+def get_resident_memory():
+	"""
+	Returns the number of bytes of memory that the current process is using, or 0 if that can't
+	be found out on this platform.
+	"""
+	try:
+		with open("/proc/self/statm", "r") as statm:
+			return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except (OSError, ValueError, AttributeError):
+		return 0
+
+def preload_simulation_modules():
+	from . import simprocess
+
+	for name in PRELOADED_BACKEND_MODULES:
+		try:
+			importlib.import_module(name)
+		except Exception:
+			pass
+
+# This is what the worker processes run
+# !!! It runs in a child process !!!
+def worker_main(control_pipe):
+	preload_simulation_modules()
+
+	from .simprocess import instance_control_thread
+
+	control_pipe.send((WorkerSignal.READY, get_resident_memory()))
+
+	while True:
+		try:
+			job = control_pipe.recv()
+		except (EOFError, ConnectionError):
+			# The server has gone away
+			break
+
+		# 'None' means that the worker should exit
+		if job is None:
+			break
+
+		pipe, params, frame_ring_name = job
+
+		try:
+			instance_control_thread(pipe, params, frame_ring_name)
+		except Exception:
+			traceback.print_exc()
+
+		# NOTE: This is how the server finds out that the simulation is over if the endpoints
+		# couldn't shut down properly
+		pipe.close()
+
+		# Whatever the simulation left behind shouldn't count towards the memory growth
+		gc.collect()
+
+		try:
+			control_pipe.send((WorkerSignal.DONE, get_resident_memory()))
+		except (BrokenPipeError, ConnectionError):
+			break
+
+class SimulationWorker:
+	def __init__(self, pool):
+		self.pool = pool
+
+		parent_pipe, child_pipe = mp.Pipe(duplex=True)
+		self.control_pipe = parent_pipe
+
+		self.process = mp.get_context("spawn").Process(target=worker_main, args=(child_pipe,), daemon=True)
+		self.process.start()
+
+		# See 'SimulationProcess' for why we close the child's end
+		child_pipe.close()
+
+		self.simulation_count = 0
+		self.base_memory = 0
+		self.is_ready = False
+
+		# The thread is the only one that receives from the control pipe
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def run(self):
+		while True:
+			try:
+				signal, memory = self.control_pipe.recv()
+			except (EOFError, ConnectionError, OSError):
+				break
+
+			if signal == WorkerSignal.READY:
+				self.base_memory = memory
+				self.is_ready = True
+				self.pool.on_worker_ready(self)
+			elif signal == WorkerSignal.DONE:
+				self.simulation_count += 1
+				self.pool.on_worker_done(self, memory)
+
+		self.control_pipe.close()
+		self.pool.on_worker_exited(self)
+
+	def run_simulation(self, pipe, params, frame_ring_name):
+		"""
+		Hands a simulation to the worker. 'pipe' is the child's end of the pipe to the server, which
+		can be closed once this returns. Returns 'False' if the worker has exited.
+		"""
+		try:
+			self.control_pipe.send((pipe, params, frame_ring_name))
+		except (OSError, ValueError):
+			return False
+
+		return True
+
+	def stop(self):
+		try:
+			self.control_pipe.send(None)
+		except (OSError, ValueError):
+			pass
+
+class SimulationWorkerPool:
+	def __init__(self, size=WORKER_POOL_SIZE, max_simulations=WORKER_MAX_SIMULATIONS, max_memory_growth=WORKER_MAX_MEMORY_GROWTH):
+		self.size = size
+		self.max_simulations = max_simulations
+		self.max_memory_growth = max_memory_growth
+
+		self.lock = threading.Lock()
+
+		# Every worker that belongs to the pool, including the ones that are still starting up
+		self.workers = set()
+		self.idle_workers = collections.deque()
+		self.busy_workers = set()
+
+		self.is_closed = False
+
+	def start(self):
+		self._refill()
+
+	def _refill(self):
+		with self.lock:
+			if self.is_closed:
+				return
+
+			missing = self.size - (len(self.workers) - len(self.busy_workers))
+
+			for _ in range(missing):
+				self.workers.add(SimulationWorker(self))
+
+	def _refill_async(self):
+		# Starting a process takes a while, and there is no reason to make the caller wait for it
+		threading.Thread(target=self._refill, daemon=True).start()
+
+	def acquire(self):
+		"""
+		Returns an idle worker, which will only be used by the caller from now on, or 'None' if no
+		worker is ready. The pool starts a new worker to take its place.
+		"""
+		with self.lock:
+			if self.is_closed or len(self.idle_workers) == 0:
+				return None
+
+			worker = self.idle_workers.popleft()
+			self.busy_workers.add(worker)
+
+		self._refill_async()
+
+		return worker
+
+	def on_worker_ready(self, worker):
+		with self.lock:
+			if worker in self.workers:
+				self.idle_workers.append(worker)
+				return
+
+		worker.stop()
+
+	def on_worker_done(self, worker, memory):
+		memory_growth = memory - worker.base_memory
+
+		with self.lock:
+			self.busy_workers.discard(worker)
+
+			is_worn_out = (worker.simulation_count >= self.max_simulations) or (self.max_memory_growth > 0 and memory_growth > self.max_memory_growth)
+
+			if (not self.is_closed) and (worker in self.workers) and (not is_worn_out):
+				self.idle_workers.append(worker)
+				return
+
+			self.workers.discard(worker)
+
+		if is_worn_out:
+			print(f"[WORKER POOL]: Replacing worker after {worker.simulation_count} simulation(s) ({memory_growth // (1024 * 1024)} MB memory growth)")
+
+		worker.stop()
+		self._refill_async()
+
+	def on_worker_exited(self, worker):
+		with self.lock:
+			if not worker in self.workers:
+				return
+
+			# The worker died (or was killed)
+			self.workers.discard(worker)
+			self.busy_workers.discard(worker)
+
+			if worker in self.idle_workers:
+				self.idle_workers.remove(worker)
+
+			# NOTE: If the worker couldn't even get through the imports, its replacement
+			# won't either, and we would just keep on starting new processes. Simulations get their
+			# own processes from now on.
+			if not worker.is_ready:
+				print("[WORKER POOL]: Worker exited while starting up, disabling the worker pool")
+				self.size = 0
+				return
+
+		self._refill_async()
+
+	def close(self):
+		with self.lock:
+			self.is_closed = True
+
+			idle_workers = list(self.idle_workers)
+			self.idle_workers.clear()
+
+			# Busy workers are stopped once they have finished their simulations
+			self.workers = set(self.busy_workers)
+
+		for worker in idle_workers:
+			worker.stop()
+
+global__worker_pool = None
+global__worker_pool_lock = threading.Lock()
+
+def get_worker_pool():
+	"""
+	Returns the server's worker pool. The pool is created (and its workers are started) the first
+	time that this is called.
+	"""
+	global global__worker_pool
+	global global__worker_pool_lock
+
+	with global__worker_pool_lock:
+		if global__worker_pool is None:
+			global__worker_pool = SimulationWorkerPool(
+				getattr(settings, "SIMULATION_WORKER_POOL_SIZE", WORKER_POOL_SIZE),
+				getattr(settings, "SIMULATION_WORKER_MAX_SIMULATIONS", WORKER_MAX_SIMULATIONS),
+				getattr(settings, "SIMULATION_WORKER_MAX_MEMORY_GROWTH", WORKER_MAX_MEMORY_GROWTH))
+
+			global__worker_pool.start()
+
+	return global__worker_pool
@@ -0,0 +1,152 @@
+from django.test import SimpleTestCase
+
+from .websocket_groups import ClientOutbox, OverflowPolicy, OUTBOX_OVERFLOW_CLOSE_CODE
+from .instances.backendcache import BackendCache, LAST_FETCH_FILE
+from .instances.manager import reserve_simulation, spawn_simulation, kill_simulation, is_simulation_running
+
+import os
+import uuid
+import shutil
+import asyncio
+import tempfile
+
+import git
+
+class ClientOutboxTests(SimpleTestCase):
+	def setUp(self):
+		self.event_loop = asyncio.new_event_loop()
+		self.sent = []
+
+	def tearDown(self):
+		self.event_loop.close()
+
+	async def send(self, message):
+		self.sent.append(message)
+
+	def run_event_loop(self):
+		# Lets the outbox's send task go through everything that was queued
+		self.event_loop.run_until_complete(asyncio.sleep(0.01))
+
+	def test_drops_messages_when_full(self):
+		outbox = ClientOutbox(self.event_loop, self.send, max_pending=4)
+
+		results = [ outbox.put("log", index) for index in range(6) ]
+		self.run_event_loop()
+
+		self.assertEqual(results, [ True ] * 4 + [ False ] * 2)
+		self.assertEqual(self.sent, [ 0, 1, 2, 3 ])
+
+	def test_closes_client_when_kept_messages_pile_up(self):
+		outbox = ClientOutbox(self.event_loop, self.send, max_pending=4, max_kept=8)
+
+		results = [ outbox.put("state", index, OverflowPolicy.KEEP) for index in range(10) ]
+		self.run_event_loop()
+
+		self.assertEqual(results, [ True ] * 8 + [ False ] * 2)
+		self.assertEqual(self.sent, [ { "type": "websocket.close", "code": OUTBOX_OVERFLOW_CLOSE_CODE } ])
+		self.assertTrue(outbox.is_closed)
+
+class BackendCacheTests(SimpleTestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+
+		self.source_path = os.path.join(self.temp_dir.name, "source")
+		self.source = git.Repo.init(self.source_path, initial_branch="main")
+		self.url = f"file://{self.source_path}"
+
+		self.first_commit = self.commit_file("main.py", "print('first')")
+
+	def tearDown(self):
+		self.temp_dir.cleanup()
+
+	def commit_file(self, name, contents):
+		with open(os.path.join(self.source_path, name), "w") as source_file:
+			source_file.write(contents)
+
+		self.source.index.add([ name ])
+		return self.source.index.commit(f"Update {name}").hexsha
+
+	def make_cache(self, max_age):
+		return BackendCache(os.path.join(self.temp_dir.name, "cache"), max_age)
+
+	def get_last_fetch(self, cache):
+		with open(os.path.join(cache.get_mirror_path(self.url), LAST_FETCH_FILE), "r") as time_file:
+			return time_file.read()
+
+	def test_reuses_checkout_without_fetching(self):
+		cache = self.make_cache(60)
+
+		path, commit = cache.checkout(self.url, "main")
+		last_fetch = self.get_last_fetch(cache)
+
+		self.assertEqual(commit, self.first_commit)
+		self.assertTrue(os.path.isfile(os.path.join(path, "main.py")))
+
+		self.assertEqual(cache.checkout(self.url, self.first_commit), (path, commit))
+		self.assertEqual(self.get_last_fetch(cache), last_fetch)
+
+	def test_fetches_unknown_refs(self):
+		cache = self.make_cache(60)
+		cache.checkout(self.url, "main")
+
+		self.source.git.checkout("-b", "feature")
+		feature_commit = self.commit_file("feature.py", "print('feature')")
+
+		path, commit = cache.checkout(self.url, "feature")
+
+		self.assertEqual(commit, feature_commit)
+		self.assertTrue(os.path.isfile(os.path.join(path, "feature.py")))
+		self.assertEqual(cache.checkout(self.url, feature_commit)[1], feature_commit)
+
+		with self.assertRaises(ValueError):
+			cache.checkout(self.url, "missing")
+
+	def test_refetches_stale_mirror(self):
+		cache = self.make_cache(0)
+		cache.checkout(self.url, "main")
+
+		second_commit = self.commit_file("main.py", "print('second')")
+
+		self.assertEqual(cache.checkout(self.url, "main")[1], second_commit)
+
+	def test_uses_stale_mirror_when_fetch_fails(self):
+		cache = self.make_cache(0)
+		path, _ = cache.checkout(self.url, "main")
+
+		shutil.rmtree(self.source_path)
+
+		self.assertEqual(cache.checkout(self.url, "main"), (path, self.first_commit))
+
+		with self.assertRaises(ValueError):
+			cache.checkout(self.url, "missing")
+
+	def test_rejects_option_like_arguments(self):
+		cache = self.make_cache(60)
+
+		with self.assertRaises(ValueError):
+			cache.checkout("--upload-pack=touch", "main")
+
+		with self.assertRaises(ValueError):
+			cache.checkout(self.url, "--output=file")
+
+class KillReservedSimulationTests(SimpleTestCase):
+	def setUp(self):
+		self.uuid = str(uuid.uuid4())
+		self.spawned = []
+
+	def spawn(self):
+		return spawn_simulation(self.uuid, self.spawned.append, (self.uuid,), False)
+
+	def test_killed_before_spawn(self):
+		# This is what happens when a simulation is killed while its backend is being checked out
+		reserve_simulation(self.uuid)
+
+		self.assertTrue(kill_simulation(self.uuid))
+		self.assertFalse(is_simulation_running(self.uuid))
+
+		self.assertFalse(self.spawn())
+		self.assertEqual(self.spawned, [])
+		self.assertFalse(is_simulation_running(self.uuid))
+
+	def test_unknown_simulation(self):
+		self.assertFalse(kill_simulation(self.uuid))
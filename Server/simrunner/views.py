@@ -1,14 +1,17 @@
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed
 from django.views.decorators.csrf import csrf_exempt
 
-from .instances.manager import spawn_simulation, spawn_simulation_from_branch, kill_simulation
+from .instances.manager import spawn_simulation, spawn_simulation_from_branch, reserve_simulation, kill_simulation
+from .instances.scheduler import get_simulation_scheduler
 from .instances.simprocess import SimulationProcess
 from .backends.backend import BackendParameters
 
 from saveviewer import archiver as sv_archiver
+from saveviewer.codecs import get_codec, DEFAULT_CODEC
 
 import json
 import uuid
+import functools
 import traceback
 
 @csrf_exempt
@@ -29,23 +32,39 @@ def create_new_simulation(request):
 	sim_name = creation_parameters.get("name", None)
 	sim_source = creation_parameters.get("source", None)
 	sim_backend = creation_parameters.get("backend", None)
+	sim_keyframe_interval = creation_parameters.get("vizKeyframeInterval", 0)
+	sim_codec = creation_parameters.get("frameCodec", DEFAULT_CODEC)
+	sim_priority = creation_parameters.get("priority", 0)
 
 	if sim_name is None: return HttpResponseBadRequest("Simulation name not provided")
 	if sim_source is None: return HttpResponseBadRequest("Simulation source not provided")
 	if sim_backend is None: return HttpResponseBadRequest("Simulation backend not specified")
+	if not type(sim_keyframe_interval) is int: return HttpResponseBadRequest("Invalid viz keyframe interval")
+
+	if not type(sim_codec) is str: return HttpResponseBadRequest("Invalid frame codec")
+	if not type(sim_priority) is int: return HttpResponseBadRequest("Invalid simulation priority")
+
+	try:
+		get_codec(sim_codec)
+	except ValueError as e:
+		return HttpResponseBadRequest(str(e))
 
 	# Register simulation
 	params = BackendParameters()
 	params.uuid = sim_uuid
 	params.name = sim_name
 	params.source = sim_source
+	params.viz_keyframe_interval = sim_keyframe_interval
+	params.frame_codec = sim_codec
 	
 	use_custom_backend = type(sim_backend) is dict
 	id_str = str(sim_uuid)
 
+	# Custom backends are checked out into the backend cache (see 'backendcache'), so simulations
+	# don't need their own backend directory
 	try:
-		extra_vars = { "backend_version": sim_backend }
-		paths = sv_archiver.get_save_archiver().register_simulation(id_str, f"./{id_str}", sim_name, use_custom_backend, extra_init_vars=extra_vars)
+		extra_vars = { "backend_version": sim_backend, "codec": sim_codec }
+		paths = sv_archiver.get_save_archiver().register_simulation(id_str, f"./{id_str}", sim_name, False, extra_init_vars=extra_vars)
 	except Exception as e:
 		traceback.print_exc()
 		return HttpResponseBadRequest(str(e))
@@ -56,7 +75,7 @@ def create_new_simulation(request):
 	params.backend_dir = paths.backend_path
 	params.backend_relative_prefix = paths.relative_backend_path
 
-	# Download backend
+	# Check out backend
 	params.backend_version = sim_backend
 
 	print(f"[SIMULATION RUNNER]: Creating new simulation: {id_str}")
@@ -66,12 +85,18 @@ def create_new_simulation(request):
 		if not "branch" in sim_backend: return HttpResponseBadRequest("Backend branch not provided")
 		if not "version" in sim_backend: return HttpResponseBadRequest("Backend version not provided")
 		
-		spawn_simulation_from_branch(id_str, sim_backend["url"], sim_backend["branch"], paths.backend_path, proc_class=SimulationProcess, proc_args=(params,))
+		start_func = functools.partial(spawn_simulation_from_branch, id_str, sim_backend["url"], sim_backend["branch"], params,
+			proc_class=SimulationProcess, proc_args=(params,), should_create_ws_group=False)
 	elif type(sim_backend) is str:
-		spawn_simulation(id_str, proc_class=SimulationProcess, proc_args=(params,))
+		start_func = functools.partial(spawn_simulation, id_str, proc_class=SimulationProcess, proc_args=(params,), should_create_ws_group=False)
 	else:
 		return HttpResponseBadRequest(f"Invalid backend data type: {type(sim_backend)}")
 
+	# The simulation is started straight away if there is room for it, otherwise it waits in the
+	# scheduler's queue. Clients can connect to it either way.
+	reserve_simulation(id_str)
+	get_simulation_scheduler().submit(id_str, params, start_func, sim_priority)
+
 	return HttpResponse(id_str)
 
 @csrf_exempt
@@ -1,8 +1,15 @@
 import threading
+import collections
+from enum import Enum
 
 # NOTE(Jason): This is basically a simplified, custom version of Django channels. I tired using channels,
 # but for some reason, they were quite slow. I'm not sure if this is because the default, in-memory
 # channel layer is for testing purposes only, or if its because channels are generally a bit slow.
+#
+# Groups are tuples, and adding or removing a client replaces the tuple. Broadcasting only needs the
+# lock to look up the group, so the time that the lock is held doesn't depend on the number of clients,
+# and clients can join or leave while a message is being handed out. Messages are encoded once and put
+# in the outbox of every client (see 'ClientOutbox'), so a slow client doesn't hold up the others.
 global__ws_groups = {}
 global__ws_group_lock = threading.Lock()
 
@@ -19,24 +26,35 @@ def create_websocket_group(group_name: str):
 		if group_name in global__ws_groups:
 			raise KeyError(f"WebSocket group '{group_name}' already exists")
 
-		global__ws_groups[group_name] = []
+		global__ws_groups[group_name] = ()
+
+def _get_group_clients(group_name: str):
+	global global__ws_groups
+	global global__ws_group_lock
+
+	with global__ws_group_lock:
+		group = global__ws_groups.get(group_name, None)
+
+	if (group is None) or (type(group) is __WsGroupCloseMarker):
+		return ()
+
+	return group
 
 def close_websocket_group(group_name: str, close_code=None, close_message=None):
 	global global__ws_groups
 	global global__ws_group_lock
 
 	with global__ws_group_lock:
-		# NOTE(Jason): When we close the connection object, the communication thread will
-		# remove the client from the clients list. This is going to cause a problem, since
-		# we are also iterating over the list of clients. To solve this, we can just create
-		# a copy (shallow copy) of the clients list and iterate over that
+		# NOTE: When we close the connection object, the communication thread will remove the
+		# client from the group. The group is a tuple, so the clients that we iterate over below
+		# aren't affected by that.
 		group = global__ws_groups.get(group_name, None)
 
 		if (group is None) or (type(group) is __WsGroupCloseMarker):
 			return
 
 		global__ws_groups[group_name] = __WsGroupCloseMarker(close_code, close_message)
-		
+
 	for client in group:
 		client.on_websocket_group_closed()
 
@@ -50,7 +68,7 @@ def get_close_parameters(group_name: str):
 		# Return None if the group doesn't exist, or the group is still active
 		if (group is None) or (not type(group) is __WsGroupCloseMarker):
 			return None
-		
+
 	return (group.code, group.message)
 
 def add_websocket_to_group(group_name: str, consumer):
@@ -63,7 +81,7 @@ def add_websocket_to_group(group_name: str, consumer):
 		if (group is None) or (type(group) is __WsGroupCloseMarker):
 			return False
 
-		group.append(consumer)
+		global__ws_groups[group_name] = group + (consumer,)
 
 	return True
 
@@ -78,17 +96,157 @@ def remove_websocket_from_group(group_name: str, consumer):
 			return
 
 		if consumer in group:
-			group.remove(consumer)
+			global__ws_groups[group_name] = tuple(client for client in group if not client is consumer)
 
 def send_message_to_websocket_group(group_name: str, message):
-	global global__ws_groups
-	global global__ws_group_lock
-
-	with global__ws_group_lock:
-		group = global__ws_groups.get(group_name, None)
-
-		if (group is None) or (type(group) is __WsGroupCloseMarker):
-			return
+	clients = _get_group_clients(group_name)
+
+	if len(clients) == 0:
+		return
+
+	encoded_message = message.encode()
+
+	for client in clients:
+		client.send_encoded_message(message.action, encoded_message)
+
+def has_frame_subscribers(group_name: str):
+	return any(client.subscribed_to_frames for client in _get_group_clients(group_name))
+
+def push_frame_to_websocket_group(group_name: str, frame_index: int, message: bytes):
+	"""
+	Sends a binary frame message to every client in the group that subscribed to frames. The same
+	message object is handed to every client. 'push_frame' only queues the message, so clients
+	that are slow to receive don't hold up the others.
+	"""
+	for client in _get_group_clients(group_name):
+		if client.subscribed_to_frames:
+			client.push_frame(frame_index, message)
+
+class OverflowPolicy(Enum):
+	# The message is dropped if the outbox is full
+	DROP = 1
+	# Only the newest message of this type is kept. A message that is still waiting to be sent is
+	# replaced by the new one (which takes its place in the outbox).
+	REPLACE = 2
+	# The message is never dropped, even if the outbox is full. If the client falls so far behind
+	# that even these messages pile up, the connection is closed instead.
+	KEEP = 3
+
+# Number of messages that can be waiting to be sent to a client before messages are dropped
+OUTBOX_MAX_PENDING = 64
+
+# Number of messages that can be waiting to be sent to a client before the connection is closed
+OUTBOX_MAX_KEPT = 4 * OUTBOX_MAX_PENDING
+
+# Close code sent to clients that couldn't keep up with their messages ("Try Again Later")
+OUTBOX_OVERFLOW_CLOSE_CODE = 1013
+
+class ClientOutbox:
+	"""
+	Messages that are waiting to be sent to a single client. Messages can be added from any thread
+	and are sent by a task on the client's event loop ('send' is the ASGI send function).
+	"""
+	def __init__(self, event_loop, send, max_pending=OUTBOX_MAX_PENDING, max_kept=OUTBOX_MAX_KEPT):
+		self.event_loop = event_loop
+		self.send = send
+		self.max_pending = max_pending
+		self.max_kept = max(max_kept, max_pending)
+
+		self.lock = threading.Lock()
+		self.messages = collections.deque()
+		self.replaceable = {}
+		self.is_sending = False
+		self.is_closed = False
+		self.send_task = None
+		self.close_task = None
+
+		self.dropped_count = 0
+
+	def put(self, key, message, policy: OverflowPolicy=OverflowPolicy.DROP):
+		"""
+		Queues an ASGI message to be sent. 'key' identifies the type of the message, which is used
+		by the 'REPLACE' policy. Returns 'False' if the message was dropped. If the outbox is so full
+		that a message which can't be dropped doesn't fit, the connection is closed.
+		"""
+		with self.lock:
+			if self.is_closed:
+				return False
+
+			if policy == OverflowPolicy.REPLACE:
+				entry = self.replaceable.get(key, None)
+
+				if not entry is None:
+					entry[1] = message
+					return True
+
+				entry = [ key, message ]
+				self.replaceable[key] = entry
+			elif policy == OverflowPolicy.DROP and len(self.messages) >= self.max_pending:
+				self.dropped_count += 1
+				return False
+			elif len(self.messages) >= self.max_kept:
+				entry = None
+			else:
+				entry = [ key, message ]
+
+			if entry is None:
+				# The client isn't receiving anything, so there is no point in keeping it connected
+				self.is_closed = True
+				self.messages.clear()
+				self.replaceable.clear()
+			else:
+				self.messages.append(entry)
+
+				if self.is_sending:
+					return True
+
+				self.is_sending = True
+
+		try:
+			self.event_loop.call_soon_threadsafe(self._start_sending if not entry is None else self._start_closing)
+		except RuntimeError:
+			# The event loop has been closed
+			self.close()
+			return False
 
-		for client in group:
-			client.send_client_message(message)
\ No newline at end of file
+		return not entry is None
+
+	def close(self):
+		with self.lock:
+			self.is_closed = True
+			self.messages.clear()
+			self.replaceable.clear()
+
+	def _start_sending(self):
+		# The event loop only keeps a weak reference to its tasks
+		self.send_task = self.event_loop.create_task(self._send_messages())
+
+	def _start_closing(self):
+		self.close_task = self.event_loop.create_task(self._send_close())
+
+	async def _send_close(self):
+		try:
+			await self.send({ "type": "websocket.close", "code": OUTBOX_OVERFLOW_CLOSE_CODE })
+		except Exception:
+			# The connection was already closed
+			pass
+
+	async def _send_messages(self):
+		while True:
+			with self.lock:
+				if len(self.messages) == 0:
+					self.is_sending = False
+					return
+
+				entry = self.messages.popleft()
+				key, message = entry
+
+				if self.replaceable.get(key, None) is entry:
+					del self.replaceable[key]
+
+			try:
+				await self.send(message)
+			except Exception:
+				# The connection was closed, so there is no point in sending anything else
+				self.close()
+				return
@@ -41,11 +41,151 @@ function appendInitLogMessage(message) {
 	textArea.scrollTop = textArea.scrollHeight;
 }
 
+/****** Frame prefetching ******/
+const FRAME_PREFETCH_COUNT = 16;
+const MAX_CACHED_FRAMES = 64;
+
+function getCachedFrame(context, index) {
+	const cache = context["frameCache"];
+	const frameBuffer = cache.get(index);
+
+	//Move the frame to the back of the map, so that it is evicted last
+	if (frameBuffer !== undefined) {
+		cache.delete(index);
+		cache.set(index, frameBuffer);
+	}
+
+	return frameBuffer;
+}
+
+function storeCachedFrame(context, index, frameBuffer) {
+	const cache = context["frameCache"];
+
+	cache.delete(index);
+	cache.set(index, frameBuffer);
+
+	while (cache.size > MAX_CACHED_FRAMES) {
+		cache.delete(cache.keys().next().value);
+	}
+}
+
+async function inflateFrame(data) {
+	const stream = new Blob([ data ]).stream().pipeThrough(new DecompressionStream("deflate"));
+	return await new Response(stream).arrayBuffer();
+}
+
+async function prefetchFrames(context, uuid, start, end, stride = 1) {
+	const response = await fetch(`/api/saveviewer/framerange?uuid=${uuid}&start=${start}&end=${end}&stride=${stride}`);
+
+	if (!response.ok) {
+		return;
+	}
+
+	const isDeflated = response.headers.get("X-Frame-Encoding") === "deflate";
+	const reader = response.body.getReader();
+
+	//Every frame is preceded by its index and size (both uint32), but the chunks we get from
+	//the stream don't line up with the frames, so we have to keep the leftover bytes around
+	let pending = new Uint8Array(0);
+
+	while (true) {
+		const { done, value } = await reader.read();
+
+		if (done) {
+			break;
+		}
+
+		const merged = new Uint8Array(pending.length + value.length);
+		merged.set(pending);
+		merged.set(value, pending.length);
+		pending = merged;
+
+		while (pending.length >= 8) {
+			const header = new DataView(pending.buffer, pending.byteOffset, 8);
+			const index = header.getUint32(0, true);
+			const size = header.getUint32(4, true);
+
+			if (pending.length < 8 + size) {
+				break;
+			}
+
+			const frameData = pending.slice(8, 8 + size);
+			pending = pending.subarray(8 + size);
+
+			//The user might have switched to another simulation in the meantime
+			if (context["simUUID"] !== uuid) {
+				reader.cancel();
+				return;
+			}
+
+			storeCachedFrame(context, index, isDeflated ? await inflateFrame(frameData) : frameData.buffer);
+		}
+	}
+}
+
+function schedulePrefetch(context, uuid, start) {
+	const end = Math.min(start + FRAME_PREFETCH_COUNT, context["simInfo"].frameCount);
+
+	if (context["prefetchInProgress"] || start >= end || context["frameCache"].has(start)) {
+		return;
+	}
+
+	context["prefetchInProgress"] = true;
+
+	prefetchFrames(context, uuid, start, end)
+		.catch((error) => console.log(`Failed to prefetch frames: ${error}`))
+		.finally(() => { context["prefetchInProgress"] = false; });
+}
+
+/****** Pushed frames ******/
+function subscribeToFrames(context) {
+	const socket = context["commsSocket"];
+
+	//While we are following the latest frame, the server sends us every new frame as a
+	//binary message, so we don't have to request them one at a time
+	context["subscribedToFrames"] = context["alwaysUseLatestStep"];
+
+	if (socket && socket.readyState === WebSocket.OPEN) {
+		socket.send(JSON.stringify({ "action": "subscribeframes", "data": context["subscribedToFrames"] }));
+	}
+}
+
+async function receivePushedFrame(context, data) {
+	//The frame is preceded by its index and the number of frames in the simulation (both uint32)
+	const header = new DataView(data, 0, 8);
+	const index = header.getUint32(0, true);
+	const frameCount = Math.max(header.getUint32(4, true), context["simInfo"].frameCount);
+
+	const frameBuffer = await inflateFrame(new Uint8Array(data, 8));
+	storeCachedFrame(context, index, frameBuffer);
+
+	context["simInfo"].frameCount = frameCount;
+	context["timelineSlider"].max = frameCount;
+
+	if (context["alwaysUseLatestStep"]) {
+		await requestFrame(context, context["simUUID"], index);
+
+		context["timelineSlider"].value = index + 1;
+	} else {
+		setSimFrame(context["simInfo"].frameIndex, frameCount);
+	}
+}
+
 async function requestFrame(context, uuid, index) {
 	context["currentIndex"] = index;
-	
-	const frameData = await fetch(`/api/saveviewer/framedata?index=${index}&uuid=${uuid}`);
-	const frameBuffer = await frameData.arrayBuffer();
+
+	let frameBuffer = getCachedFrame(context, index);
+
+	if (frameBuffer === undefined) {
+		const frameData = await fetch(`/api/saveviewer/framedata?index=${index}&uuid=${uuid}`);
+		frameBuffer = await frameData.arrayBuffer();
+	}
+
+	//Fetch the next few frames in a single request, so that playing or scrubbing forwards
+	//doesn't have to wait for a request per frame (the latest frame has nothing after it)
+	if (!context["alwaysUseLatestStep"]) {
+		schedulePrefetch(context, uuid, index + 1);
+	}
 
 	if (context["currentIndex"] != index) {
 		//TODO:
@@ -60,23 +200,11 @@ async function requestFrame(context, uuid, index) {
 	//Update UI
 	const [ cellCount ] = render.pushFrameData(context["gl"], context, frameBuffer)
 
-	//Update the cell index based on the identifier
-	if (context["selectedCellIndex"] >= 0) {
-		context["selectedCellIndex"] = -1;
-
-		const identifier = context["selectedCellIdentifier"];
-
-		for (let i = 0; i < cellCount; i++) {
-			if (render.lookupCellIdentifier(context, i) === identifier) {
-				context["selectedCellIndex"] = i;
-				break;
-			}
-		}
-	}
-
 	document.getElementById("simdets-cellcount").innerText = cellCount;
 
-	await updateCellInfo(context);
+	//The selected cell is probably in a different row of the new frame, so the server finds it
+	//(along with its attributes) by its identifier
+	await updateSelectedCell(context, uuid, index);
 }
 
 function connectToSimulation(context, uuid) {
@@ -89,9 +217,11 @@ function connectToServer(context) {
 		setStatusMessage("Connecting");
 
 		var commsSocket = new WebSocket(`ws://${window.location.host}/ws/usercomms/`);
+		commsSocket.binaryType = "arraybuffer";
 		
 		commsSocket.onopen = function(e) {
 			setStatusMessage("Connected");
+			subscribeToFrames(context);
 			resolve(commsSocket);
 		};
 
@@ -100,6 +230,15 @@ function connectToServer(context) {
 		};
 		
 		commsSocket.onmessage = async function(e) {
+			//Binary messages are always pushed frames
+			if (e.data instanceof ArrayBuffer) {
+				if (context["frameCache"] !== undefined) {
+					await receivePushedFrame(context, e.data);
+				}
+
+				return;
+			}
+
 			const message = JSON.parse(e.data);
 
 			const action = message["action"];
@@ -107,6 +246,7 @@ function connectToServer(context) {
 
 			if (action === "simheader") {
 				context["simUUID"] = data["uuid"];
+				context["frameCache"] = new Map();
 
 				context["simInfo"] = {};
 				context["simInfo"].name = data.name;
@@ -126,7 +266,7 @@ function connectToServer(context) {
 
 				if (data.isOnline) {
 					setButtonContainerDisplay("block");
-					setStatusMessage("Running");
+					setStatusMessage(data.queuePosition == null ? "Running" : `Queued (position ${data.queuePosition})`);
 				}
 			} else if (action === "newframe") {
 				const frameCount = data["frameCount"];
@@ -136,7 +276,8 @@ function connectToServer(context) {
 
 				setSimFrame(context["simInfo"].frameIndex, frameCount);
 
-				if (context["alwaysUseLatestStep"] && frameCount > 0) {
+				//Subscribed clients get the frame itself in a separate message
+				if (context["alwaysUseLatestStep"] && !context["subscribedToFrames"] && frameCount > 0) {
 					requestFrame(context, context["simUUID"], frameCount - 1);
 
 					context["timelineSlider"].value = frameCount;
@@ -153,6 +294,10 @@ function connectToServer(context) {
 				closeInitLogWindow(true);
 			} else if (action === "simstopped") {
 				setStatusMessage("Terminated");
+			} else if (action === "simqueued") {
+				setStatusMessage(`Queued (position ${data["position"]} of ${data["queueLength"]})`);
+			} else if (action === "simstarted") {
+				setStatusMessage("Running");
 			} else if (action === "reloaddone") {
 				commsSocket.send(JSON.stringify({ "action": "connectto", "data": `${data["uuid"]}` }));
 			}
@@ -190,23 +335,39 @@ function processTimelineChange(value, context) {
 	requestFrame(context, context["simUUID"], value - 1);
 }
 
-async function updateCellInfo(context) {
-	const cellIndex = context["selectedCellIndex"];
+async function updateSelectedCell(context, uuid, index) {
+	const cellId = context["selectedCellIdentifier"];
+
+	//The row of the selected cell belongs to the previous frame
+	context["selectedCellIndex"] = -1;
+
+	if (cellId === undefined) {
+		showCellInfo(null);
+		return;
+	}
+
+	const pickData = await fetch(`/api/saveviewer/pick?uuid=${uuid}&index=${index}&cellid=${cellId}`);
+	const pick = await pickData.json();
 
+	//The frame might have changed while we were waiting for the server
+	if (context["currentIndex"] !== index) {
+		return;
+	}
+
+	//The cell stays selected in frames where it doesn't exist, so that it gets highlighted again
+	//once we go back to a frame that has it
+	context["selectedCellIndex"] = pick["hit"] ? pick["row"] : -1;
+	showCellInfo(pick["hit"] ? pick["cell"] : null);
+}
+
+function showCellInfo(cellProps) {
 	const cellDetailsHeader = document.getElementById("cell-details-header");
 	const cellDetailsSection = document.getElementById("cell-details-section");
 
-	if (cellIndex === -1) {
+	if (cellProps === null) {
 		cellDetailsHeader.style.display = "none";
 		cellDetailsSection.style.display = "none";
 	} else {
-		const simUUID = context["simUUID"];
-		const frameIndex = context["currentIndex"];
-		const cellId = context["selectedCellIdentifier"];
-
-		const cellData = await fetch(`/api/saveviewer/cellinfoindex?cellid=${cellId}&frameindex=${frameIndex}&uuid=${simUUID}`);
-		const cellProps = await cellData.json();
-
 		let cellText = "";
 
 		for (const key in cellProps) {
@@ -229,42 +390,7 @@ async function updateCellInfo(context) {
 	}
 }
 
-function doMousePick(context) {
-	// https://iquilezles.org/articles/intersectors/
-	function capIntersect(ro, rd, pa, pb, ra) {
-		const ba = vec3.sub(vec3.create(), pb, pa);
-		const oa = vec3.sub(vec3.create(), ro, pa);
-		const baba = vec3.dot(ba, ba);
-		const bard = vec3.dot(ba, rd);
-		const baoa = vec3.dot(ba, oa);
-		const rdoa = vec3.dot(rd, oa);
-		const oaoa = vec3.dot(oa, oa);
-		let a = baba - bard * bard;
-		let b = baba * rdoa - baoa * bard;
-		let c = baba * oaoa - baoa * baoa - ra * ra * baba;
-		let h = b * b - a * c;
-
-		if (h >= 0.0) {
-			const t = (-b - Math.sqrt(h)) / a;
-			const y = baoa + t * bard;
-
-			// body
-			if (y > 0.0 && y < baba) return t;
-
-			// caps
-			const oc = (y <= 0.0) ? oa : vec3.sub(vec3.create(), ro, pb);
-			b = vec3.dot(rd, oc);
-			c = vec3.dot(oc, oc) - ra * ra;
-			h = b * b - c;
-
-			if (h > 0.0) return -b - Math.sqrt(h);
-		}
-
-		return -1.0;
-	}
-
-	//const t0 = performance.now();
-
+async function doMousePick(context) {
 	const camera = context["camera"];
 	const viewportWidth = camera["width"];
 	const viewportHeight = camera["height"];
@@ -288,58 +414,26 @@ function doMousePick(context) {
 
 	const cameraPos = camera["position"];
 
-	const dataBuffer = context["cellData"];
-	const cellCount = context["cellCount"];
-	const dataView = new DataView(dataBuffer);
-
-	let minIndex = -1;
-	let minDist = Number.MAX_VALUE;
+	//The server keeps a spatial grid for every frame, so the ray doesn't have to be tested
+	//against every cell here (and the cells don't even need to be on the client)
+	const simUUID = context["simUUID"];
+	const frameIndex = context["currentIndex"];
+	const origin = `${cameraPos[0]},${cameraPos[1]},${cameraPos[2]}`;
+	const direction = `${rayDir[0]},${rayDir[1]},${rayDir[2]}`;
 
-	for (let i = 0; i < cellCount; i++) {
-		const baseOffset = render.calcCellVertexOffset(context, i);
+	const pickData = await fetch(`/api/saveviewer/pick?uuid=${simUUID}&index=${frameIndex}&origin=${origin}&dir=${direction}`);
+	const pick = await pickData.json();
 
-		const cellPos = vec3.fromValues(
-			dataView.getFloat32(baseOffset + 0, true),
-			dataView.getFloat32(baseOffset + 4, true),
-			dataView.getFloat32(baseOffset + 8, true),
-		);
-
-		const cellDir = vec3.fromValues(
-			dataView.getFloat32(baseOffset + 12, true),
-			dataView.getFloat32(baseOffset + 16, true),
-			dataView.getFloat32(baseOffset + 20, true),
-		);
-
-		const length = dataView.getFloat32(baseOffset + 24, true);
-		const radius = dataView.getFloat32(baseOffset + 28, true);
-
-		const yaw = Math.atan2(cellDir[0], cellDir[2]);
-		const pitch = Math.acos(cellDir[1]);
-
-		const rotVector = vec3.fromValues(
-			radius * Math.sin(yaw) * Math.sin(pitch),
-			0.5 * Math.cos(pitch),
-			radius * Math.cos(yaw) * Math.sin(pitch)
-		);
-		
-		const cellEnd0 = vec3.scaleAndAdd(vec3.create(), cellPos, rotVector, length);
-		const cellEnd1 = vec3.scaleAndAdd(vec3.create(), cellPos, rotVector, -length);
-
-		const intersectDist = capIntersect(cameraPos, rayDir, cellEnd0, cellEnd1, radius);
-
-		if (intersectDist >= 0 && intersectDist < minDist) {
-			minDist = intersectDist;
-			minIndex = i;
-		}
+	//The frame might have changed while we were waiting for the server
+	if (context["currentIndex"] !== frameIndex) {
+		return;
 	}
 
-	//const t1 = performance.now();
-	//console.log(`Performance: ${t1 - t0}ms (${minIndex}, ${minDist})`);
+	context["selectedCellIndex"] = pick["hit"] ? pick["row"] : -1;
+	context["selectedCellIdentifier"] = pick["hit"] ? BigInt(pick["id"]) : undefined;
 
-	context["selectedCellIndex"] = minIndex;
-	context["selectedCellIdentifier"] = minIndex !== -1 ? render.lookupCellIdentifier(context, minIndex) : undefined;
-
-	updateCellInfo(context);
+	//The pick response already has the attributes of the cell
+	showCellInfo(pick["hit"] ? pick["cell"] : null);
 }
 
 async function initFrame(gl, context) {
@@ -348,6 +442,9 @@ async function initFrame(gl, context) {
 	context["selectedCellIndex"] = -1;
 	context["useThinOutlines"] = false;
 
+	context["frameCache"] = new Map();
+	context["prefetchInProgress"] = false;
+
 	//Initialize camera details
 	context["camera"] = {
 		"orbitCenter": vec3.fromValues(0, 0.0, 0.0),
@@ -400,7 +497,10 @@ async function initFrame(gl, context) {
 	context["timelineSlider"] = timelineSlider;
 
 	const snapToLastCheckbox = document.getElementById("snap-to-last");
-	snapToLastCheckbox.onchange = function(event) { context["alwaysUseLatestStep"] = this.checked; };
+	snapToLastCheckbox.onchange = function(event) {
+		context["alwaysUseLatestStep"] = this.checked;
+		subscribeToFrames(context);
+	};
 
 	context["alwaysUseLatestStep"] = snapToLastCheckbox.checked;
 